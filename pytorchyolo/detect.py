@@ -3,26 +3,37 @@
 from __future__ import division
 
 import os
+import time
 import argparse
 import tqdm
 import random
 import numpy as np
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
 import torch
+import torchvision
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
 from torch.autograd import Variable
 
 from pytorchyolo.models import load_model
+from pytorchyolo.export import load_onnx_model
 from pytorchyolo.utils.utils import load_classes, rescale_boxes, non_max_suppression, to_cpu, print_environment_info
 from pytorchyolo.utils.datasets import ImageFolder
 from pytorchyolo.utils.transforms import Resize, DEFAULT_TRANSFORMS
+from pytorchyolo.utils.render import draw_detections
+from pytorchyolo.utils.tta import dihedral_tta
+from pytorchyolo.utils.prediction_store import PredictionStoreWriter
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import NullLocator
 
 
@@ -40,8 +51,11 @@ class Args:
         self.nms_thres = 0.4
 
 def detect_directory(model_path, weights_path, img_path, classes, output_path,
-                     batch_size=8, img_size=416, n_cpu=8, conf_thres=0.5, nms_thres=0.5):
+                     batch_size=8, img_size=416, n_cpu=8, conf_thres=0.5, nms_thres=0.5, backend="pytorch",
+                     render=True, renderer="pil", n_writers=4, max_in_flight=4, columnar=None, tta=False,
+                     nms_method="greedy", geometry="box", store_path=None, precision="fp32", cache=False):
     """Detects objects on all images in specified directory and saves output images with drawn detections.
+    The labels and images of every batch are written as soon as its detections are available.
 
     :param model_path: Path to model definition file (.cfg)
     :type model_path: str
@@ -63,6 +77,33 @@ def detect_directory(model_path, weights_path, img_path, classes, output_path,
     :type conf_thres: float, optional
     :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
     :type nms_thres: float, optional
+    :param backend: Inference backend, "pytorch" or "onnxruntime" (CPU), defaults to "pytorch"
+    :type backend: str, optional
+    :param render: If True, saves the images with drawn detections next to the labels, defaults to True
+    :type render: bool, optional
+    :param renderer: Renderer of the output images, "pil" or "matplotlib", defaults to "pil"
+    :type renderer: str, optional
+    :param n_writers: Number of threads writing labels and images, matplotlib always uses one, defaults to 4
+    :type n_writers: int, optional
+    :param max_in_flight: Maximum number of detected batches waiting to be written, defaults to 4
+    :type max_in_flight: int, optional
+    :param columnar: Additionally writes all detections of the run to a single "npz" or "parquet" file, defaults to None
+    :type columnar: str, optional
+    :param tta: If True, fuses the detections on all flips and transposes of each image, defaults to False
+    :type tta: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, e.g. "cluster" or "matrix" for dense
+        crater fields, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression, "box" or "circle" for the IoU of the circles inscribed in the boxes,
+        defaults to "box"
+    :type geometry: str, optional
+    :param store_path: Directory to store the raw model outputs in, see `utils.prediction_store`, defaults to None
+    :type store_path: str, optional
+    :param precision: "fp32" or "bf16" for autocast inference of the pytorch backend, defaults to "fp32"
+    :type precision: str, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, see `models.load_model`,
+        defaults to False
+    :type cache: bool, optional
     """
     print(f'Outputting to: {output_path}')
 
@@ -72,40 +113,173 @@ def detect_directory(model_path, weights_path, img_path, classes, output_path,
     os.makedirs(output_path+'/labels/', exist_ok=True)
 
     dataloader = _create_data_loader(img_path, batch_size, img_size, n_cpu)
-    model = load_model(model_path, weights_path)
-    img_detections, imgs = detect(
-        model,
-        dataloader,
-        output_path,
-        img_size,
-        conf_thres,
-        nms_thres)
-    _draw_and_save_output_images(
-        img_detections, imgs, img_size, output_path, classes)
-
-def save_label_predictions(image_path, preds, output_path, cnt):
-    
-    fname = os.path.basename(image_path).rstrip('.png\n')
-    label_file = open(output_path+f'/labels/{fname}.txt', 'w')
-
-    if cnt != 0:
-        
-        for pred in preds:
-            state = pred[4].cpu().numpy()
-            x = pred[0].cpu().numpy()
-            y = pred[1].cpu().numpy()
-            w = pred[2].cpu().numpy()
-            h = pred[3].cpu().numpy()
-            label = '%i %.3f %.3f %.3f %.3f\n' % (state, x, y, w, h)
-            label_file.write(label)
-    
-    label_file.close()
-
-def detect_image(model, image, img_size=416, conf_thres=0.5, nms_thres=0.5):
+    model = _load_backend_model(model_path, weights_path, img_size, backend, precision, cache)
+    store = PredictionStoreWriter(store_path, model, img_size, min(conf_thres, 0.001)) if store_path else None
+
+    # The outputs are written by background threads while the next batches are inferenced.
+    # Waiting for the oldest batch bounds the memory to 'max_in_flight' batches.
+    n_writers = 1 if render and renderer == "matplotlib" else n_writers
+    # The columnar file is written batch by batch as well, no detections are kept in memory
+    columns = ColumnarDetectionWriter(f"{output_path}/detections.{columnar}") if columnar is not None else None
+    with ThreadPoolExecutor(max_workers=n_writers) as executor:
+        pending = deque()
+        for imgs, img_detections in detect_batches(model, dataloader, conf_thres, nms_thres, tta, nms_method,
+                                                       geometry, store):
+            pending.append((imgs, executor.submit(
+                _draw_and_save_output_images, img_detections, imgs, img_size, output_path, classes,
+                renderer if render else None)))
+            while len(pending) > max_in_flight or (pending and pending[0][1].done()):
+                _finish_batch(*pending.popleft(), columns)
+        while pending:
+            _finish_batch(*pending.popleft(), columns)
+    if store is not None:
+        store.close()
+    if columns is not None:
+        columns.close()
+
+def _finish_batch(imgs, future, columns):
+    """Waits for the labels and images of a batch and appends its detections to the columnar file, if any"""
+    host_detections = future.result()
+    if columns is not None:
+        columns.append(imgs, host_detections)
+
+def _load_backend_model(model_path, weights_path, img_size, backend, precision="fp32", cache=False):
+    """Loads the model for the requested inference backend.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights, checkpoint or exported model file (.weights, .pth or .onnx)
+    :type weights_path: str
+    :param img_size: Size of each image dimension for yolo
+    :type img_size: int
+    :param backend: Inference backend, "pytorch" or "onnxruntime"
+    :type backend: str
+    :param precision: Precision of the pytorch backend, "fp32" or "bf16", defaults to "fp32"
+    :type precision: str, optional
+    :param cache: If True, the pytorch model is the shared instance in `models.model_cache`, defaults to False
+    :type cache: bool, optional
+    :return: Returns model
+    :rtype: models.Darknet or export.OnnxRuntimeModel
+    """
+    if backend == "pytorch":
+        return load_model(model_path, weights_path, cache=cache, shared=cache, precision=precision)
+    elif backend == "onnxruntime":
+        if precision != "fp32":
+            raise ValueError("The onnxruntime backend runs the exported float32 model, use the pytorch backend.")
+        return load_onnx_model(model_path, weights_path, img_size)
+    raise ValueError(f"Unknown backend '{backend}'. Please choose between (pytorch, onnxruntime).")
+
+def save_label_predictions(image_path, detections, output_path):
+    """Writes the detections of one image to a label file with one row (class, x1, y1, w, h) per detection.
+
+    :param image_path: Path to input image
+    :type image_path: str
+    :param detections: Detections rescaled to the input image, rows of (x1, y1, x2, y2, conf, cls)
+    :type detections: nd.array
+    :param output_path: Path of output directory
+    :type output_path: str
+    """
+    fname = os.path.splitext(os.path.basename(image_path.rstrip()))[0]
+
+    labels = np.empty((len(detections), 5), dtype=detections.dtype)
+    labels[:, 0] = detections[:, 5]
+    labels[:, 1:3] = detections[:, 0:2]
+    labels[:, 3:5] = detections[:, 2:4] - detections[:, 0:2]
+
+    with open(output_path+f'/labels/{fname}.txt', 'w') as label_file:
+        label_file.write(''.join('%i %.3f %.3f %.3f %.3f\n' % tuple(label) for label in labels.tolist()))
+
+def save_columnar_detections(path, image_paths, img_detections):
+    """Writes the detections of all images to one columnar file with an image index, box, confidence and class column.
+
+    :param path: Path of the .npz or .parquet file, parquet requires pyarrow
+    :type path: str
+    :param image_paths: List of paths to image files
+    :type image_paths: [str]
+    :param img_detections: Detections rescaled to each image, rows of (x1, y1, x2, y2, conf, cls)
+    :type img_detections: [nd.array]
+    """
+    columns = ColumnarDetectionWriter(path)
+    columns.append(image_paths, img_detections)
+    columns.close()
+
+# Columns of the columnar detection files, the image path column follows the image index
+COLUMNAR_DTYPE = np.dtype([("image_index", np.int32), ("x1", np.float32), ("y1", np.float32), ("x2", np.float32),
+                           ("y2", np.float32), ("confidence", np.float32), ("class", np.int32)])
+
+class ColumnarDetectionWriter:
+    """Writes the detections of a run to one columnar file, see `save_columnar_detections`.
+    The rows of every appended batch go to a temporary file, which is converted to the .npz or .parquet file in
+    chunks on close, so the detections of the run are never held in memory at once."""
+
+    def __init__(self, path, chunk_size=1 << 20):
+        """
+        :param path: Path of the .npz or .parquet file, parquet requires pyarrow
+        :type path: str
+        :param chunk_size: Number of rows per parquet row group, defaults to 1 << 20
+        :type chunk_size: int, optional
+        """
+        if not path.endswith((".npz", ".parquet")):
+            raise ValueError(f"Unknown columnar format of '{path}'. Please choose between (npz, parquet).")
+        self.path = path
+        self.chunk_size = chunk_size
+        self.image_paths = []
+        self.n_rows = 0
+        self.file = open(path + ".tmp", "wb")
+
+    def append(self, image_paths, img_detections):
+        """
+        :param image_paths: Paths of the images of the batch
+        :type image_paths: [str]
+        :param img_detections: Detections rescaled to each image, rows of (x1, y1, x2, y2, conf, cls)
+        :type img_detections: [nd.array]
+        """
+        counts = [len(detections) for detections in img_detections]
+        detections = np.concatenate(img_detections, 0) if img_detections else np.zeros((0, 6), dtype=np.float32)
+        rows = np.empty(len(detections), dtype=COLUMNAR_DTYPE)
+        rows["image_index"] = np.repeat(np.arange(len(self.image_paths), len(self.image_paths) + len(counts)), counts)
+        for i, name in enumerate(COLUMNAR_DTYPE.names[1:]):
+            rows[name] = detections[:, i]
+        self.file.write(rows.tobytes())
+        self.image_paths += list(image_paths)
+        self.n_rows += len(rows)
+
+    def close(self):
+        self.file.close()
+        temporary_path = self.path + ".tmp"
+        rows = np.memmap(temporary_path, dtype=COLUMNAR_DTYPE, mode="r", shape=(self.n_rows,)) if self.n_rows \
+            else np.zeros(0, dtype=COLUMNAR_DTYPE)
+        if self.path.endswith(".npz"):
+            # The columns are copied to the archive in buffered chunks
+            np.savez(self.path, image_path=np.array(self.image_paths),
+                     **{name: rows[name] for name in COLUMNAR_DTYPE.names})
+        else:
+            self._write_parquet(rows)
+        del rows
+        os.remove(temporary_path)
+        print(f"Saved {self.n_rows} detections of {len(self.image_paths)} images to: {self.path}")
+
+    def _write_parquet(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # The image paths are a dictionary column, read by pandas as a categorical
+        image_paths = pa.array(self.image_paths, type=pa.string())
+        writer = None
+        for start in range(0, max(len(rows), 1), self.chunk_size):
+            chunk = np.array(rows[start:start + self.chunk_size])
+            columns = {"image_index": chunk["image_index"],
+                       "image_path": pa.DictionaryArray.from_arrays(chunk["image_index"], image_paths)}
+            columns.update((name, chunk[name]) for name in COLUMNAR_DTYPE.names[1:])
+            table = pa.table(columns)
+            writer = writer or pq.ParquetWriter(self.path, table.schema)
+            writer.write_table(table)
+        writer.close()
+
+def detect_image(model, image, img_size=416, conf_thres=0.5, nms_thres=0.5, tta=False):
     """Inferences one image with model.
 
-    :param model: Model for inference
-    :type model: models.Darknet
+    :param model: Model for inference, use `export.load_onnx_model` for the onnxruntime backend
+    :type model: models.Darknet or export.OnnxRuntimeModel
     :param image: Image to inference
     :type image: nd.array
     :param img_size: Size of each image dimension for yolo, defaults to 416
@@ -114,6 +288,8 @@ def detect_image(model, image, img_size=416, conf_thres=0.5, nms_thres=0.5):
     :type conf_thres: float, optional
     :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
     :type nms_thres: float, optional
+    :param tta: If True, fuses the detections on all flips and transposes of the image, defaults to False
+    :type tta: bool, optional
     :return: Detections on image with each detection in the format: [x1, y1, x2, y2, confidence, class]
     :rtype: nd.array
     """
@@ -130,15 +306,292 @@ def detect_image(model, image, img_size=416, conf_thres=0.5, nms_thres=0.5):
 
     # Get detections
     with torch.no_grad():
-        detections = model(input_img)
-        detections = non_max_suppression(detections, conf_thres, nms_thres)
+        if tta:
+            detections = dihedral_tta(model, input_img, conf_thres, nms_thres)
+        else:
+            detections = non_max_suppression(model(input_img), conf_thres, nms_thres)
         detections = rescale_boxes(detections[0], img_size, image.shape[:2])
     return to_cpu(detections).numpy()
 
-def detect(model, dataloader, output_path, img_size, conf_thres, nms_thres):
+def _tile_offsets(length, tile_size, stride):
+    """Returns the start offsets of tiles of 'tile_size' that cover 'length' with at most 'stride' between them."""
+    last = max(length - tile_size, 0)
+    offsets = list(range(0, last + 1, stride))
+    if offsets[-1] != last:
+        offsets.append(last)
+    return offsets
+
+
+def _window_size(length, window, overlap):
+    """Returns the smallest multiple of 32 up to 'window' that covers 'length' with the fewest overlapping windows."""
+    n_windows = max(-(-(length - overlap) // (window - overlap)), 1)
+    return -(-(length + (n_windows - 1) * overlap) // (n_windows * 32)) * 32
+
+
+def _merge_seam_detections(detections, cut, tiles, iou_thres):
+    """Merges the detections of craters cut by the seams between tiles. A cut box is dropped if an uncut box of
+    another tile covers it, that tile sees the whole crater. The remaining cut boxes of a crater too large for any
+    one tile are merged into the box around its parts in the neighbouring tiles.
+
+    :param detections: Detections in scene coordinates as rows of [x1, y1, x2, y2, confidence, class]
+    :type detections: torch.Tensor
+    :param cut: True for the detections that touch a tile edge inside the scene
+    :type cut: torch.Tensor
+    :param tiles: Index of the tile of each detection
+    :type tiles: torch.Tensor
+    :param iou_thres: Fraction of a cut box an uncut box covers to replace it, and IoU along the seam of two parts
+        of the same crater
+    :type iou_thres: float
+    :return: Returns the uncut detections and the merged cut ones
+    :rtype: torch.Tensor
+    """
+    def intersection(a, b):
+        return (torch.min(a[:, None, 2:4], b[None, :, 2:4]) - torch.max(a[:, None, :2], b[None, :, :2])).clamp(0)
+
+    whole, parts, tiles = detections[~cut], detections[cut], tiles[cut]
+    if len(parts) and len(whole):
+        area = (parts[:, 2:4] - parts[:, :2]).prod(1)
+        covered = (intersection(parts, whole).prod(2) >= iou_thres * area[:, None]) & \
+            (parts[:, None, 5] == whole[None, :, 5])
+        parts, tiles = parts[~covered.any(1)], tiles[~covered.any(1)]
+    if not len(parts):
+        return whole
+
+    # Parts of one crater overlap and span the same extent along the seam between them
+    inter = intersection(parts, parts)
+    extent = torch.max(parts[:, None, 2:4], parts[None, :, 2:4]) - torch.min(parts[:, None, :2], parts[None, :, :2])
+    linked = (inter > 0).all(2) & ((inter / extent.clamp(min=1e-6)) >= iou_thres).any(2) & \
+        (parts[:, None, 5] == parts[None, :, 5]) & (tiles[:, None] != tiles[None, :])
+    linked |= torch.eye(len(parts), dtype=torch.bool)
+    # Label every part with the lowest index connected to it, e.g. the four parts of a crater on a tile corner
+    group = torch.arange(len(parts))
+    while True:
+        new_group = torch.where(linked, group[None, :], len(parts)).min(1).values
+        if torch.equal(new_group, group):
+            break
+        group = new_group
+    merged = []
+    for group_i in group.unique():
+        group_parts = parts[group == group_i]
+        merged.append(torch.cat([group_parts[:, :2].min(0).values, group_parts[:, 2:4].max(0).values,
+                                 group_parts[:, 4].max()[None], group_parts[0, 5:6]]))
+    return torch.cat([whole, torch.stack(merged)], 0)
+
+
+def detect_scene(model, scene, img_size=416, tile_size=None, overlap=64, border=2, batch_size=8,
+                 conf_thres=0.5, nms_thres=0.5, window=None):
+    """Inferences a large scene with model by batching overlapping tiles cut from it in memory.
+    The tile detections are mapped to scene coordinates, the parts of craters cut by the seams are merged and
+    the duplicates of neighbouring tiles are removed by a global non-maximum suppression.
+
+    :param model: Model for inference
+    :type model: models.Darknet or export.OnnxRuntimeModel
+    :param scene: Scene as uint8 array, grayscale (HxW) or RGB (HxWx3)
+    :type scene: nd.array
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param tile_size: Size of the tiles in scene pixels, resized to img_size for yolo, defaults to img_size
+    :type tile_size: int, optional
+    :param overlap: Overlap of neighbouring tiles in scene pixels, defaults to 64
+    :type overlap: int, optional
+    :param border: Detections closer than this to a tile edge inside the scene are cut by a seam. They are dropped if
+        a neighbouring tile sees the crater whole and merged with its parts in the neighbouring tiles otherwise,
+        see `_merge_seam_detections`. 0 leaves the cut boxes to the global suppression, defaults to 2
+    :type border: int, optional
+    :param batch_size: Number of tiles per forward pass, defaults to 8
+    :type batch_size: int, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.5
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for the per tile and the global non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param window: If set, the scene is inferenced at native resolution on canvases of this size (a multiple of 32,
+        e.g. 2048) instead of img_size tiles. Canvases shrink along each side to split the scene evenly, so fewer
+        overlap pixels are recomputed. Lower the batch_size accordingly, defaults to None
+    :type window: int, optional
+    :return: Detections on the scene with each detection in the format: [x1, y1, x2, y2, confidence, class]
+    :rtype: nd.array
+    """
+    model.eval()  # Set model to evaluation mode
+
+    if scene.ndim == 2:
+        scene = scene[..., None]
+    height, width = scene.shape[:2]
+    if window is not None:
+        # The network runs on the canvases as they are, which only needs each side to be a multiple of 32
+        assert window % 32 == 0, "The window size must be a multiple of 32."
+        assert 0 <= overlap < window, "The overlap must be smaller than the window size."
+        tile_h, tile_w = _window_size(height, window, overlap), _window_size(width, window, overlap)
+        input_size = (tile_h, tile_w)
+    else:
+        tile_size = tile_size or img_size
+        assert 0 <= overlap < tile_size, "The overlap must be smaller than the tile size."
+        tile_h = tile_w = tile_size
+        input_size = (img_size, img_size)
+    # Scenes smaller than a tile are padded with zeros at the bottom and right
+    if height < tile_h or width < tile_w:
+        padded = np.zeros((max(height, tile_h), max(width, tile_w), scene.shape[2]), dtype=scene.dtype)
+        padded[:height, :width] = scene
+        scene = padded
+
+    tiles = [(y, x)
+             for y in _tile_offsets(scene.shape[0], tile_h, max(tile_h - overlap, 1))
+             for x in _tile_offsets(scene.shape[1], tile_w, max(tile_w - overlap, 1))]
+    scale = torch.tensor([tile_w / input_size[1], tile_h / input_size[0]]).repeat(2)
+
+    scene_detections, scene_cut, scene_tiles = [], [], []
+    for batch_i in tqdm.tqdm(range(0, len(tiles), batch_size), desc="Detecting tiles"):
+        offsets = tiles[batch_i:batch_i + batch_size]
+        # Only the tiles of the current batch are converted to float
+        input_imgs = torch.from_numpy(
+            np.stack([scene[y:y + tile_h, x:x + tile_w] for y, x in offsets])).permute(0, 3, 1, 2).float() / 255
+        input_imgs = input_imgs.expand(-1, 3, -1, -1)
+        if (tile_h, tile_w) != input_size:
+            input_imgs = F.interpolate(input_imgs, size=input_size, mode="nearest")
+        if torch.cuda.is_available():
+            input_imgs = input_imgs.to("cuda")
+
+        with torch.no_grad():
+            detections = model(input_imgs)
+            detections = non_max_suppression(detections, conf_thres, nms_thres)
+
+        for tile_i, ((y, x), tile_detections) in enumerate(zip(offsets, detections), batch_i):
+            tile_detections = to_cpu(tile_detections)
+            tile_detections[:, :4] *= scale
+            # Boxes cut by a seam, only on edges shared with another tile
+            cut = torch.zeros(len(tile_detections), dtype=torch.bool)
+            if border:
+                if x > 0:
+                    cut |= tile_detections[:, 0] <= border
+                if y > 0:
+                    cut |= tile_detections[:, 1] <= border
+                if x + tile_w < scene.shape[1]:
+                    cut |= tile_detections[:, 2] >= tile_w - border
+                if y + tile_h < scene.shape[0]:
+                    cut |= tile_detections[:, 3] >= tile_h - border
+            tile_detections[:, [0, 2]] += x
+            tile_detections[:, [1, 3]] += y
+            scene_detections.append(tile_detections)
+            scene_cut.append(cut)
+            scene_tiles.append(torch.full((len(tile_detections),), tile_i))
+
+    # Merge the duplicates of neighbouring tiles
+    scene_detections = _merge_seam_detections(
+        torch.cat(scene_detections, 0), torch.cat(scene_cut, 0), torch.cat(scene_tiles, 0), nms_thres)
+    keep = torchvision.ops.batched_nms(
+        scene_detections[:, :4], scene_detections[:, 4], scene_detections[:, 5], nms_thres)
+    return scene_detections[keep].numpy()
+
+
+def detect_scene_file(model_path, weights_path, scene_path, output_path, img_size=416, tile_size=None, overlap=64,
+                      batch_size=8, conf_thres=0.5, nms_thres=0.5, backend="pytorch", window=None, precision="fp32",
+                      cache=False):
+    """Detects objects on a whole scene image and writes one label file with scene pixel coordinates.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param scene_path: Path to the scene image, e.g. a HiRISE or CTX product
+    :type scene_path: str
+    :param output_path: Path to output directory, the labels are written to output_path/labels/
+    :type output_path: str
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param tile_size: Size of the tiles in scene pixels, defaults to img_size
+    :type tile_size: int, optional
+    :param overlap: Overlap of neighbouring tiles in scene pixels, defaults to 64
+    :type overlap: int, optional
+    :param batch_size: Number of tiles per forward pass, defaults to 8
+    :type batch_size: int, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.5
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param backend: Inference backend, "pytorch" or "onnxruntime" (CPU), defaults to "pytorch"
+    :type backend: str, optional
+    :param window: Size of the canvases inferenced at native resolution instead of tiles, see `detect_scene`.
+        Needs the pytorch backend, defaults to None
+    :type window: int, optional
+    :param precision: "fp32" or "bf16" for autocast inference of the pytorch backend, defaults to "fp32"
+    :type precision: str, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, see `models.load_model`,
+        defaults to False
+    :type cache: bool, optional
+    :return: Detections on the scene with each detection in the format: [x1, y1, x2, y2, confidence, class]
+    :rtype: nd.array
+    """
+    if window is not None and backend != "pytorch":
+        raise ValueError("Windowed inference needs the pytorch backend, exported models have a fixed input size.")
+    os.makedirs(output_path+'/labels/', exist_ok=True)
+    model = _load_backend_model(model_path, weights_path, img_size, backend, precision, cache)
+
+    # Scenes are far larger than PIL's decompression bomb limit
+    max_image_pixels, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+    try:
+        scene = Image.open(scene_path)
+        # Grayscale scenes stay single channel, the tiles are expanded to RGB batch by batch
+        scene = np.asarray(scene if scene.mode in ("L", "RGB") else scene.convert("RGB"))
+    finally:
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+    detections = detect_scene(
+        model, scene, img_size=img_size, tile_size=tile_size, overlap=overlap, batch_size=batch_size,
+        conf_thres=conf_thres, nms_thres=nms_thres, window=window)
+    save_label_predictions(scene_path, detections, output_path)
+    print(f"{len(detections)} detections on {scene_path}")
+    return detections
+
+def detect_batches(model, dataloader, conf_thres, nms_thres, tta=False, nms_method="greedy", geometry="box",
+                   store=None):
+    """Inferences images with model and yields the detections batch by batch.
+
+    :param model: Model for inference
+    :type model: models.Darknet or export.OnnxRuntimeModel
+    :param dataloader: Dataloader provides the batches of images to inference
+    :type dataloader: DataLoader
+    :param conf_thres: Object confidence threshold
+    :type conf_thres: float
+    :param nms_thres: IOU threshold for non-maximum suppression
+    :type nms_thres: float
+    :param tta: If True, inferences all flips and transposes of a batch in one pass and fuses their detections,
+        defaults to False
+    :type tta: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression, "box" or "circle", defaults to "box"
+    :type geometry: str, optional
+    :param store: Writer the raw model outputs of every batch are appended to, defaults to None
+    :type store: utils.prediction_store.PredictionStoreWriter, optional
+    :return: Yields the input image paths and the detections of each batch. The coordinates are given for the padded image
+        that is provided by the dataloader.
+    :rtype: [str], [Tensor]
+    """
+    if tta and store is not None:
+        raise ValueError("The raw outputs of test-time augmentation can not be stored.")
+    model.eval()  # Set model to evaluation mode
+
+    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+
+    for (img_paths, input_imgs) in tqdm.tqdm(dataloader, desc="Detecting"):
+        # Configure input
+        input_imgs = Variable(input_imgs.type(Tensor))
+
+        # Get detections
+        with torch.no_grad():
+            if tta:
+                detections = dihedral_tta(model, input_imgs, conf_thres, nms_thres)
+            else:
+                outputs = model(input_imgs)
+                if store is not None:
+                    store.append(img_paths, outputs)
+                detections = non_max_suppression(outputs, conf_thres, nms_thres, method=nms_method, geometry=geometry)
+
+        yield img_paths, detections
+
+def detect(model, dataloader, output_path, img_size, conf_thres, nms_thres, tta=False, store_path=None):
     """Inferences images with model.
     :param model: Model for inference
-    :type model: models.Darknet
+    :type model: models.Darknet or export.OnnxRuntimeModel
     :param dataloader: Dataloader provides the batches of images to inference
     :type dataloader: DataLoader
     :param output_path: Path to output directory
@@ -149,6 +602,10 @@ def detect(model, dataloader, output_path, img_size, conf_thres, nms_thres):
     :type conf_thres: float, optional
     :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
     :type nms_thres: float, optional
+    :param tta: If True, fuses the detections on all flips and transposes of each image, defaults to False
+    :type tta: bool, optional
+    :param store_path: Directory to store the raw model outputs in, see `utils.prediction_store`, defaults to None
+    :type store_path: str, optional
     :return: List of detections. The coordinates are given for the padded image that is provided by the dataloader.
         Use `utils.rescale_boxes` to transform them into the desired input image coordinate system before its transformed by the dataloader),
         List of input image paths
@@ -157,29 +614,20 @@ def detect(model, dataloader, output_path, img_size, conf_thres, nms_thres):
     # Create output directory, if missing
     os.makedirs(output_path, exist_ok=True)
 
-    model.eval()  # Set model to evaluation mode
-
-    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
-
     img_detections = []  # Stores detections for each image index
     imgs = []  # Stores image paths
 
-    for (img_paths, input_imgs) in tqdm.tqdm(dataloader, desc="Detecting"):
-        # Configure input
-        input_imgs = Variable(input_imgs.type(Tensor))
-
-        # Get detections
-        with torch.no_grad():
-            detections = model(input_imgs)
-            detections = non_max_suppression(detections, conf_thres, nms_thres)
-
+    store = PredictionStoreWriter(store_path, model, img_size, min(conf_thres, 0.001)) if store_path else None
+    for img_paths, detections in detect_batches(model, dataloader, conf_thres, nms_thres, tta, store=store):
         # Store image and detections
         img_detections.extend(detections)
         imgs.extend(img_paths)
+    if store is not None:
+        store.close()
     return img_detections, imgs
-    
-def _draw_and_save_output_images(img_detections, imgs, img_size, output_path, classes):
-    """Draws detections in output images and stores them.
+
+def _draw_and_save_output_images(img_detections, imgs, img_size, output_path, classes, renderer="pil"):
+    """Writes the label files and optionally draws detections in output images and stores them.
 
     :param img_detections: List of detections
     :type img_detections: [Tensor]
@@ -191,59 +639,91 @@ def _draw_and_save_output_images(img_detections, imgs, img_size, output_path, cl
     :type output_path: str
     :param classes: List of class names
     :type classes: [str]
+    :param renderer: Renderer of the output images, "pil", "matplotlib" or None to only write labels, defaults to "pil"
+    :type renderer: str, optional
+    :return: Detections rescaled to each image
+    :rtype: [nd.array]
     """
+    # Move the whole batch to the host at once
+    counts = [len(detections) for detections in img_detections]
+    batch_detections = to_cpu(torch.cat(img_detections, 0)).numpy()
+    img_detections = np.split(batch_detections, np.cumsum(counts)[:-1])
 
-    # Iterate through images and save plot of detections
+    # Iterate through images and save labels and plot of detections
     for (image_path, detections) in zip(imgs, img_detections):
         print(f"Image {image_path}:")
-        _draw_and_save_output_image(
-            image_path, detections, img_size, output_path, classes)
+        img = Image.open(image_path)
+        # Rescale boxes to original image
+        detections = rescale_boxes(detections, img_size, (img.height, img.width))
+
+        for conf, cls_pred in detections[:, 4:6].tolist():
+            print(f"\t+ Label: {classes[int(cls_pred)]} | Confidence: {conf:0.4f}")
+        save_label_predictions(image_path, detections, output_path)
 
-def _draw_and_save_output_image(image_path, detections, img_size, output_path, classes):
-    """Draws detections in output image and stores this.
+        if renderer == "pil":
+            _render_and_save_output_image(img, image_path, detections, output_path, classes)
+        elif renderer == "matplotlib":
+            _draw_and_save_output_image(np.array(img), image_path, detections, output_path, classes)
+    return img_detections
+
+def _output_image_path(image_path, output_path):
+    filename = os.path.basename(image_path).split(".")[0]
+    return output_path + f"/images/{filename}.png"
 
+def _render_and_save_output_image(img, image_path, detections, output_path, classes):
+    """Draws detections directly into the output image at its native resolution and stores it.
+
+    :param img: Input image
+    :type img: PIL.Image or nd.array
     :param image_path: Path to input image
     :type image_path: str
-    :param detections: List of detections on image
-    :type detections: [Tensor]
-    :param img_size: Size of each image dimension for yolo
-    :type img_size: int
+    :param detections: Detections on image, rescaled to the input image
+    :type detections: nd.array
+    :param output_path: Path of output directory
+    :type output_path: str
+    :param classes: List of class names
+    :type classes: [str]
+    """
+    draw_detections(img, detections, classes).save(_output_image_path(image_path, output_path))
+
+def _draw_and_save_output_image(img, image_path, detections, output_path, classes):
+    """Draws detections in a matplotlib figure of the output image and stores this.
+    Uses a standalone figure instead of pyplot, so it can run outside of the main thread.
+
+    :param img: Input image
+    :type img: nd.array
+    :param image_path: Path to input image
+    :type image_path: str
+    :param detections: Detections on image, rescaled to the input image
+    :type detections: nd.array
     :param output_path: Path of output directory
     :type output_path: str
     :param classes: List of class names
     :type classes: [str]
     """
     # Create plot
-    img = np.array(Image.open(image_path))
-    plt.figure()
-    fig, ax = plt.subplots(1)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots(1)
     ax.imshow(img)
-    # Rescale boxes to original image
-    detections = rescale_boxes(detections, img_size, img.shape[:2])
-    unique_labels = detections[:, -1].cpu().unique()
+    unique_labels = np.unique(detections[:, -1])
     n_cls_preds = len(unique_labels)
     # Bounding-box colors
     cmap = plt.get_cmap("tab20b")
     colors = [cmap(i) for i in np.linspace(0, 1, n_cls_preds)]
     bbox_colors = random.sample(colors, n_cls_preds)
 
-    preds = []
-    cnt = 0
     for x1, y1, x2, y2, conf, cls_pred in detections:
-        print(f"\t+ Label: {classes[int(cls_pred)]} | Confidence: {conf.item():0.4f}")
-
         box_w = x2 - x1
         box_h = y2 - y1
-        preds.append([x1, y1, box_w, box_h, cls_pred])
-        cnt += 1
 
-        color = bbox_colors[int(np.where(unique_labels == int(cls_pred))[0])]
+        color = bbox_colors[int(np.where(unique_labels == int(cls_pred))[0][0])]
         # Create a Rectangle patch
         bbox = patches.Rectangle((x1, y1), box_w, box_h, linewidth=2, edgecolor=color, facecolor="none")
         # Add the bbox to the plot
         ax.add_patch(bbox)
         # Add label
-        plt.text(
+        ax.text(
             x1,
             y1,
             s=classes[int(cls_pred)],
@@ -251,15 +731,46 @@ def _draw_and_save_output_image(image_path, detections, img_size, output_path, c
             verticalalignment="top",
             bbox={"color": color, "pad": 0})
 
-    save_label_predictions(image_path, preds, output_path, cnt)
     # Save generated image with detections
-    plt.axis("off")
-    plt.gca().xaxis.set_major_locator(NullLocator())
-    plt.gca().yaxis.set_major_locator(NullLocator())
-    filename = os.path.basename(image_path).split(".")[0]
-    output_path = output_path + f"/images/{filename}.png"
-    plt.savefig(output_path, bbox_inches="tight", pad_inches=0.0)
-    plt.close()
+    ax.axis("off")
+    ax.xaxis.set_major_locator(NullLocator())
+    ax.yaxis.set_major_locator(NullLocator())
+    fig.savefig(_output_image_path(image_path, output_path), bbox_inches="tight", pad_inches=0.0)
+
+
+def benchmark_renderers(image_path, classes, output_path="output", n_boxes=300, repeats=3):
+    """Measures the time to render and store a crowded tile with the matplotlib and the PIL renderer.
+
+    :param image_path: Path to the tile to draw on
+    :type image_path: str
+    :param classes: List of class names
+    :type classes: [str]
+    :param output_path: Path of output directory, defaults to "output"
+    :type output_path: str, optional
+    :param n_boxes: Number of random detections drawn on the tile, defaults to 300
+    :type n_boxes: int, optional
+    :param repeats: Number of timed renderings per renderer, defaults to 3
+    :type repeats: int, optional
+    :return: Returns the mean seconds per image of each renderer
+    :rtype: dict
+    """
+    os.makedirs(output_path+'/images/', exist_ok=True)
+    img = Image.open(image_path)
+
+    # Random crater sized boxes all over the tile
+    xy = torch.rand(n_boxes, 2) * torch.tensor([img.width, img.height])
+    wh = 5 + torch.rand(n_boxes, 1) * min(img.size) / 8
+    detections = torch.cat((
+        xy, xy + wh, torch.rand(n_boxes, 1), torch.randint(len(classes), (n_boxes, 1)).float()), 1).numpy()
+
+    results = {}
+    for renderer, draw in [("matplotlib", _draw_and_save_output_image), ("pil", _render_and_save_output_image)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            draw(np.array(img) if renderer == "matplotlib" else img, image_path, detections, output_path, classes)
+        results[renderer] = (time.perf_counter() - start) / repeats
+        print(f"{renderer}: {results[renderer] * 1000:.1f} ms per image with {n_boxes} detections")
+    return results
 
 
 def _create_data_loader(img_path, batch_size, img_size, n_cpu):
@@ -301,6 +812,15 @@ def run():
     parser.add_argument("--n_cpu", type=int, default=8, help="Number of cpu threads to use during batch generation")
     parser.add_argument("--conf_thres", type=float, default=0.5, help="Object confidence threshold")
     parser.add_argument("--nms_thres", type=float, default=0.4, help="IOU threshold for non-maximum suppression")
+    parser.add_argument("--backend", type=str, default="pytorch", choices=["pytorch", "onnxruntime"], help="Inference backend")
+    parser.add_argument("--no_render", action="store_true", help="Only write the label files, no images with drawn detections")
+    parser.add_argument("--renderer", type=str, default="pil", choices=["pil", "matplotlib"], help="Renderer of the output images")
+    parser.add_argument("--columnar", type=str, default=None, choices=["npz", "parquet"], help="Also write all detections to one columnar file")
+    parser.add_argument("--tta", action="store_true", help="Fuse the detections on all flips and transposes of each image")
+    parser.add_argument("--nms", type=str, default="greedy", choices=["greedy", "cluster", "matrix"], help="Non-maximum suppression method")
+    parser.add_argument("--geometry", type=str, default="box", choices=["box", "circle"], help="Overlap of the non-maximum suppression, boxes or the circles inscribed in them")
+    parser.add_argument("--store", type=str, default=None, help="Directory to store the raw model outputs in for offline re-scoring")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"], help="Run the model in float32 or under bfloat16 autocast")
     args = parser.parse_args()
     print(f"Command line arguments: {args}")
 
@@ -317,7 +837,16 @@ def run():
         img_size=args.img_size,
         n_cpu=args.n_cpu,
         conf_thres=args.conf_thres,
-        nms_thres=args.nms_thres)
+        nms_thres=args.nms_thres,
+        backend=args.backend,
+        render=not args.no_render,
+        renderer=args.renderer,
+        columnar=args.columnar,
+        tta=args.tta,
+        nms_method=args.nms,
+        geometry=args.geometry,
+        store_path=args.store,
+        precision=args.precision)
 
 
 if __name__ == '__main__':
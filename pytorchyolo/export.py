@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+from __future__ import division
+
+import io
+import inspect
+import argparse
+import numpy as np
+
+import torch
+
+from pytorchyolo.models import load_model
+from pytorchyolo.utils.utils import images_per_second, print_environment_info
+
+
+class OnnxRuntimeModel:
+    """Runs an exported Darknet model on the onnxruntime CPU execution provider.
+    It can be used in place of a Darknet model for inference, e.g. in `detect` and `detect_image`."""
+
+    def __init__(self, onnx_model, n_threads=None):
+        """
+        :param onnx_model: Path to an .onnx file or the serialized model as bytes
+        :type onnx_model: str or bytes
+        :param n_threads: Number of threads used by onnxruntime, defaults to onnxruntime's choice
+        :type n_threads: int, optional
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnxruntime backend requires the 'onnxruntime' package (pip install onnxruntime).")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(onnx_model, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.training = False
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(outputs)
+
+
+def _export(model, f, img_size, opset_version):
+    """Traces the model with a dummy batch and writes the ONNX graph to 'f' (path or file-like)."""
+    kwargs = {}
+    # Newer torch versions default to the dynamo exporter, the traced graph is all we need here
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        model,
+        torch.zeros(1, 3, img_size, img_size),
+        f,
+        input_names=["images"],
+        output_names=["detections"],
+        dynamic_axes={"images": {0: "batch"}, "detections": {0: "batch"}},
+        opset_version=opset_version,
+        **kwargs)
+
+
+def export_onnx(model_path, weights_path, output_path=None, img_size=416, opset_version=13, check=True):
+    """Exports a model including the YOLO layer decoding to ONNX.
+    The batch dimension is dynamic, the image size is fixed at export time.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param output_path: Path of the .onnx file, if None the serialized model is only returned, defaults to None
+    :type output_path: str, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param opset_version: ONNX opset to export with, defaults to 13
+    :type opset_version: int, optional
+    :param check: If True, compares the onnxruntime outputs with PyTorch on a random batch, defaults to True
+    :type check: bool, optional
+    :return: Returns the serialized ONNX model
+    :rtype: bytes
+    """
+    model = load_model(model_path, weights_path, fuse=True).to("cpu")
+    model.eval()
+
+    f = io.BytesIO()
+    _export(model, f, img_size, opset_version)
+    onnx_model = f.getvalue()
+
+    if check:
+        x = torch.rand(2, 3, img_size, img_size)
+        with torch.no_grad():
+            expected = model(x).numpy()
+        actual = OnnxRuntimeModel(onnx_model)(x).numpy()
+        # Boxes are in pixels, confidences in [0, 1]
+        max_diff = np.abs(expected - actual).max()
+        if not np.allclose(expected, actual, rtol=1e-3, atol=1e-3):
+            raise ValueError(f"ONNX export does not match the PyTorch model (max abs difference {max_diff:.6f})")
+        print(f"ONNX export matches the PyTorch model (max abs difference {max_diff:.6f})")
+
+    if output_path is not None:
+        with open(output_path, "wb") as fp:
+            fp.write(onnx_model)
+        print(f"ONNX model saved to: {output_path}")
+    return onnx_model
+
+
+def load_onnx_model(model_path, weights_path, img_size=416, n_threads=None):
+    """Creates an onnxruntime model. Weights that are not already exported are exported in memory.
+
+    :param model_path: Path to model definition file (.cfg), unused for .onnx weights
+    :type model_path: str
+    :param weights_path: Path to weights, checkpoint or exported model file (.weights, .pth or .onnx)
+    :type weights_path: str
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_threads: Number of threads used by onnxruntime, defaults to onnxruntime's choice
+    :type n_threads: int, optional
+    :return: Returns model
+    :rtype: OnnxRuntimeModel
+    """
+    if weights_path.endswith(".onnx"):
+        return OnnxRuntimeModel(weights_path, n_threads)
+    return OnnxRuntimeModel(export_onnx(model_path, weights_path, img_size=img_size), n_threads)
+
+
+def benchmark(model_path, weights_path, img_size=416, batch_size=8, n_batches=10):
+    """Measures the CPU inference throughput of the PyTorch and the onnxruntime backend.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param n_batches: Number of timed batches per backend, defaults to 10
+    :type n_batches: int, optional
+    :return: Returns images/sec per backend
+    :rtype: dict
+    """
+    imgs = torch.rand(batch_size, 3, img_size, img_size)
+
+    model = load_model(model_path, weights_path).to("cpu").eval()
+    results = {"pytorch": images_per_second(model, imgs, n_batches)}
+    results["onnxruntime"] = images_per_second(
+        OnnxRuntimeModel(export_onnx(model_path, weights_path, img_size=img_size)), imgs, n_batches)
+
+    for backend, ips in results.items():
+        print(f"{backend}: {ips:.2f} images/sec")
+    return results
+
+
+def run():
+    print_environment_info()
+    parser = argparse.ArgumentParser(description="Export a model to ONNX.")
+    parser.add_argument("-m", "--model", type=str, default="models/CDA.cfg", help="Path to model definition file (.cfg)")
+    parser.add_argument("-w", "--weights", type=str, required=True, help="Path to weights or checkpoint file (.weights or .pth)")
+    parser.add_argument("-o", "--output", type=str, default="model.onnx", help="Path to output .onnx file")
+    parser.add_argument("--img_size", type=int, default=416, help="Size of each image dimension for yolo")
+    parser.add_argument("--opset", type=int, default=13, help="ONNX opset version")
+    parser.add_argument("--benchmark", action="store_true", help="Compare PyTorch and onnxruntime throughput")
+    args = parser.parse_args()
+    print(f"Command line arguments: {args}")
+
+    export_onnx(args.model, args.weights, args.output, img_size=args.img_size, opset_version=args.opset)
+    if args.benchmark:
+        benchmark(args.model, args.weights, img_size=args.img_size)
+
+
+if __name__ == '__main__':
+    run()
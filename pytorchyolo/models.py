@@ -1,5 +1,10 @@
 from __future__ import division
-from itertools import chain
+from itertools import chain, islice
+from collections import OrderedDict
+import os
+import copy
+import contextlib
+import warnings
 
 import torch
 import torch.nn as nn
@@ -10,6 +15,13 @@ from pytorchyolo.utils.parse_config import parse_model_config
 from pytorchyolo.utils.utils import weights_init_normal
 
 
+# Operation codes of the compiled execution plan
+OP_SEQUENTIAL, OP_ROUTE, OP_SHORTCUT, OP_YOLO = range(4)
+
+# Autocast dtypes of the precisions Darknet runs in, None runs without autocast
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16}
+
+
 def create_modules(module_defs):
     """
     Constructs module list of layer blocks from module configuration in module_defs
@@ -31,8 +43,6 @@ def create_modules(module_defs):
         'lr_steps': list(zip(map(int,   hyperparams["steps"].split(",")),
                              map(float, hyperparams["scales"].split(","))))
     })
-    assert hyperparams["height"] == hyperparams["width"], \
-        "Height and width should be equal! Non square images are padded with zeros."
     output_filters = [hyperparams["channels"]]
     module_list = nn.ModuleList()
     for module_i, module_def in enumerate(module_defs):
@@ -101,6 +111,83 @@ def create_modules(module_defs):
     return hyperparams, module_list
 
 
+def compile_plan(module_defs):
+    """
+    Compiles the module definitions into an integer indexed execution plan.
+    Every step is a tuple (op, refs, groups, group_id, store, free) where 'refs' are the absolute
+    indices of the layer outputs read by a route or shortcut, 'store' tells if the output of the step
+    is read again later and 'free' lists the stored outputs whose last reader is this step.
+    """
+    refs_per_layer = []
+    for layer_i, module_def in enumerate(module_defs):
+        if module_def["type"] == "route":
+            refs = [int(x) for x in module_def["layers"].split(",")]
+        elif module_def["type"] == "shortcut":
+            refs = [int(module_def["from"])]
+        else:
+            refs = []
+        # Negative references are relative to the current layer
+        refs_per_layer.append([ref if ref >= 0 else layer_i + ref for ref in refs])
+
+    # Index of the last layer that reads each stored output
+    last_use = {}
+    for layer_i, refs in enumerate(refs_per_layer):
+        for ref in refs:
+            last_use[ref] = layer_i
+
+    plan = []
+    for layer_i, (module_def, refs) in enumerate(zip(module_defs, refs_per_layer)):
+        op = {"route": OP_ROUTE, "shortcut": OP_SHORTCUT, "yolo": OP_YOLO}.get(module_def["type"], OP_SEQUENTIAL)
+        free = tuple(sorted(ref for ref in set(refs) if last_use[ref] == layer_i))
+        plan.append((
+            op,
+            tuple(refs),
+            int(module_def.get("groups", 1)),
+            int(module_def.get("group_id", 0)),
+            layer_i in last_use,
+            free))
+    return plan
+
+
+def fuse_conv_and_bn(conv, bn):
+    """Folds the batch normalization layer 'bn' into the weights and bias of 'conv' in place"""
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = bn.bias - bn.running_mean * scale
+        if conv.bias is not None:
+            bias += conv.bias * scale
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        conv.bias = nn.Parameter(bias)
+    return conv
+
+
+def _darknet_weights_cutoff(weights_path):
+    """Returns the number of layers stored in a darknet weights file, None if it covers the whole model"""
+    if "darknet53.conv.74" in weights_path:
+        return 75
+    return None
+
+
+def _fill_from_buffer(tensor, buffer, ptr):
+    """
+    Fills 'tensor' with the values of the flat array 'buffer' starting at 'ptr' and returns the new pointer.
+    The values are copied, so the tensor does not keep the memory-mapped weights file open.
+    """
+    num = tensor.numel()
+    tensor.data.copy_(torch.from_numpy(buffer[ptr: ptr + num]).view_as(tensor))
+    return ptr + num
+
+
+def _load_checkpoint(weights_path):
+    """Loads a checkpoint to the CPU, memory-mapped if the torch version and file format support it.
+    The tensors read from the file, they must be copied before the file may be overwritten."""
+    try:
+        return torch.load(weights_path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or legacy (non zip) checkpoint
+        return torch.load(weights_path, map_location="cpu")
+
+
 class Upsample(nn.Module):
     """ nn.Upsample is deprecated """
 
@@ -132,7 +219,7 @@ class YOLOLayer(nn.Module):
         self.mse_loss = nn.MSELoss()
         self.bce_loss = nn.BCELoss()
         self.no = num_classes + 5  # number of outputs per anchor
-        self.grid = torch.zeros(1)  # TODO
+        self.grids = {}  # Grid cells per (ny, nx, device) of the inferenced shapes
 
         anchors = torch.tensor(list(chain(*anchors))).float().view(-1, 2)
         self.register_buffer('anchors', anchors)
@@ -140,20 +227,29 @@ class YOLOLayer(nn.Module):
             'anchor_grid', anchors.clone().view(1, -1, 1, 1, 2))
         self.stride = None
 
-    def forward(self, x, img_size):
-        stride = img_size // x.size(2)
-        self.stride = stride
+    def forward(self, x, img_size, raw=False):
         bs, _, ny, nx = x.shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
-        x = x.view(bs, self.num_anchors, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
+        # img_size is a single size for square inputs or (height, width) for rectangular ones
+        height, width = (img_size, img_size) if isinstance(img_size, int) else img_size
+        stride_y, stride_x = height // ny, width // nx
+        # The loss scales the anchors by a single stride, which every input that is a multiple of 32 has
+        self.stride = stride_x if stride_x == stride_y else torch.tensor([stride_x, stride_y], device=x.device)
+        # Under autocast the convolutions output bfloat16, the decoding and the loss take float32
+        x = x.view(bs, self.num_anchors, self.no, ny, nx).permute(0, 1, 3, 4, 2).float().contiguous()
 
         if not self.training:  # inference
-            if self.grid.shape[2:4] != x.shape[2:4]:
-                self.grid = self._make_grid(nx, ny).to(x.device)
+            # With 'raw', the undecoded outputs are returned as well, as in training mode
+            head, x = (x, x.clone()) if raw else (None, x)
+            key = (ny, nx, x.device)
+            if key not in self.grids:
+                self.grids[key] = self._make_grid(nx, ny).to(x.device)
 
-            x[..., 0:2] = (x[..., 0:2].sigmoid() + self.grid) * stride  # xy
+            x[..., 0:2] = (x[..., 0:2].sigmoid() + self.grids[key]) * self.stride  # xy
             x[..., 2:4] = torch.exp(x[..., 2:4]) * self.anchor_grid # wh
             x[..., 4:] = x[..., 4:].sigmoid()
             x = x.view(bs, -1, self.no)
+            if raw:
+                return x, head
 
         return x
 
@@ -174,26 +270,89 @@ class Darknet(nn.Module):
                             for layer in self.module_list if isinstance(layer[0], YOLOLayer)]
         self.seen = 0
         self.header_info = np.array([0, 0, 0, self.seen, 0], dtype=np.int32)
-
-    def forward(self, x):
-        img_size = x.size(2)
-        layer_outputs, yolo_outputs = [], []
-        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
-            if module_def["type"] in ["convolutional", "upsample", "maxpool"]:
+        self.fused = False
+        self.precision = "fp32"
+        self.plan = compile_plan(self.module_defs)
+
+    def forward(self, x, raw=False):
+        """In evaluation mode, 'raw' also returns the undecoded outputs of the YOLO layers, which the loss takes,
+        so that one forward pass gives both the detections and the validation loss.
+        With a "bf16" `precision`, the layers run under autocast and the YOLO layers output float32."""
+        with self._autocast(x.device.type):
+            return self._forward(x, raw)
+
+    def backbone_cutoff(self):
+        """Returns the number of layers of the backbone, up to the last shortcut layer before the first YOLO layer.
+        For YOLOv3 these are the 75 layers of Darknet-53."""
+        first_yolo = next(layer_i for layer_i, step in enumerate(self.plan) if step[0] == OP_YOLO)
+        shortcuts = [layer_i for layer_i, step in enumerate(self.plan[:first_yolo]) if step[0] == OP_SHORTCUT]
+        if not shortcuts:
+            raise ValueError("The model has no residual backbone to cut off.")
+        return shortcuts[-1] + 1
+
+    def backbone_features(self, x, cutoff):
+        """Runs the first 'cutoff' layers and returns the outputs that the later layers read, by layer index.
+        The output of the last backbone layer is always one of them, `forward_features` continues from them."""
+        with self._autocast(x.device.type):
+            return self._forward(x, False, stop=cutoff)
+
+    def forward_features(self, features, img_size):
+        """Runs the layers after the backbone on its `backbone_features`, e.g. read from a `FeatureCache`.
+        The outputs equal those of `forward` on the images of size 'img_size' (height, width)."""
+        start = max(features) + 1
+        with self._autocast(features[start - 1].device.type):
+            return self._forward(features[start - 1], False, img_size, start, dict(features))
+
+    def _autocast(self, device_type):
+        dtype = PRECISIONS[self.precision]
+        return contextlib.nullcontext() if dtype is None else torch.autocast(device_type, dtype=dtype)
+
+    def _forward(self, x, raw, img_size=None, start=0, layer_outputs=None, stop=None):
+        # Inputs may be rectangular, each side a multiple of 32
+        img_size = img_size or tuple(x.shape[2:4])
+        # Only outputs read by later route or shortcut layers are kept, until their last reader has run
+        layer_outputs, yolo_outputs, raw_outputs = layer_outputs or {}, [], []
+        for layer_i, ((op, refs, groups, group_id, store, free), module) in enumerate(
+                islice(zip(self.plan, self.module_list), start, stop), start):
+            if op == OP_SEQUENTIAL:
                 x = module(x)
-            elif module_def["type"] == "route":
-                combined_outputs = torch.cat([layer_outputs[int(layer_i)] for layer_i in module_def["layers"].split(",")], 1)
-                group_size = combined_outputs.shape[1] // int(module_def.get("groups", 1))
-                group_id = int(module_def.get("group_id", 0))
-                x = combined_outputs[:, group_size * group_id : group_size * (group_id + 1)] # Slice groupings used by yolo v4
-            elif module_def["type"] == "shortcut":
-                layer_i = int(module_def["from"])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
-            elif module_def["type"] == "yolo":
-                x = module[0](x, img_size)
+            elif op == OP_ROUTE:
+                if len(refs) == 1:
+                    x = layer_outputs[refs[0]]
+                else:
+                    x = torch.cat([layer_outputs[ref] for ref in refs], 1)
+                if groups > 1:
+                    group_size = x.shape[1] // groups
+                    x = x[:, group_size * group_id : group_size * (group_id + 1)]  # Slice groupings used by yolo v4
+            elif op == OP_SHORTCUT:
+                x = x + layer_outputs[refs[0]]
+            elif op == OP_YOLO:
+                if raw and not self.training:
+                    x, head = module[0](x, img_size, raw=True)
+                    raw_outputs.append(head)
+                else:
+                    x = module[0](x, img_size)
                 yolo_outputs.append(x)
-            layer_outputs.append(x)
-        return yolo_outputs if self.training else torch.cat(yolo_outputs, 1)
+            if store:
+                layer_outputs[layer_i] = x
+            for ref in free:
+                del layer_outputs[ref]
+        if stop is not None:
+            return {**layer_outputs, stop - 1: x}
+        if self.training:
+            return yolo_outputs
+        return (torch.cat(yolo_outputs, 1), raw_outputs) if raw else torch.cat(yolo_outputs, 1)
+
+    def fuse(self):
+        """Folds every batch normalization layer into its preceding convolution for faster inference.
+        The batch norm layers are replaced by identities, so the model should not be trained afterwards."""
+        for module_def, module in zip(self.module_defs, self.module_list):
+            if module_def["type"] == "convolutional" and int(module_def["batch_normalize"]) \
+                    and isinstance(module[1], nn.BatchNorm2d):
+                fuse_conv_and_bn(module[0], module[1])
+                module[1] = nn.Identity()
+        self.fused = True
+        return self
 
     def load_darknet_weights(self, weights_path):
         """Parses and loads the weights stored in 'weights_path'"""
@@ -204,12 +363,11 @@ class Darknet(nn.Module):
             header = np.fromfile(f, dtype=np.int32, count=5)
             self.header_info = header  # Needed to write header when saving weights
             self.seen = header[3]  # number of images seen during training
-            weights = np.fromfile(f, dtype=np.float32)  # The rest are weights
+        # The rest are weights, mapped so that each layer copies its values straight from the file pages
+        weights = np.memmap(weights_path, dtype=np.float32, mode="c", offset=header.nbytes)
 
         # Establish cutoff for loading backbone weights
-        cutoff = None
-        if "darknet53.conv.74" in weights_path:
-            cutoff = 75
+        cutoff = _darknet_weights_cutoff(weights_path)
 
         ptr = 0
         for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
@@ -217,43 +375,22 @@ class Darknet(nn.Module):
                 break
             if module_def["type"] == "convolutional":
                 conv_layer = module[0]
-                if module_def["batch_normalize"]:
+                if int(module_def["batch_normalize"]):
                     # Load BN bias, weights, running mean and running variance
-                    bn_layer = module[1]
-                    num_b = bn_layer.bias.numel()  # Number of biases
-                    # Bias
-                    bn_b = torch.from_numpy(
-                        weights[ptr: ptr + num_b]).view_as(bn_layer.bias)
-                    bn_layer.bias.data.copy_(bn_b)
-                    ptr += num_b
-                    # Weight
-                    bn_w = torch.from_numpy(
-                        weights[ptr: ptr + num_b]).view_as(bn_layer.weight)
-                    bn_layer.weight.data.copy_(bn_w)
-                    ptr += num_b
-                    # Running Mean
-                    bn_rm = torch.from_numpy(
-                        weights[ptr: ptr + num_b]).view_as(bn_layer.running_mean)
-                    bn_layer.running_mean.data.copy_(bn_rm)
-                    ptr += num_b
-                    # Running Var
-                    bn_rv = torch.from_numpy(
-                        weights[ptr: ptr + num_b]).view_as(bn_layer.running_var)
-                    bn_layer.running_var.data.copy_(bn_rv)
-                    ptr += num_b
+                    # Fused models read them into a temporary layer and fold it afterwards
+                    bn_layer = module[1] if isinstance(module[1], nn.BatchNorm2d) \
+                        else nn.BatchNorm2d(conv_layer.out_channels, eps=1e-5)
+                    for bn_tensor in [bn_layer.bias, bn_layer.weight, bn_layer.running_mean, bn_layer.running_var]:
+                        ptr = _fill_from_buffer(bn_tensor, weights, ptr)
                 else:
                     # Load conv. bias
-                    num_b = conv_layer.bias.numel()
-                    conv_b = torch.from_numpy(
-                        weights[ptr: ptr + num_b]).view_as(conv_layer.bias)
-                    conv_layer.bias.data.copy_(conv_b)
-                    ptr += num_b
+                    ptr = _fill_from_buffer(conv_layer.bias, weights, ptr)
                 # Load conv. weights
-                num_w = conv_layer.weight.numel()
-                conv_w = torch.from_numpy(
-                    weights[ptr: ptr + num_w]).view_as(conv_layer.weight)
-                conv_layer.weight.data.copy_(conv_w)
-                ptr += num_w
+                ptr = _fill_from_buffer(conv_layer.weight, weights, ptr)
+                if int(module_def["batch_normalize"]) and not isinstance(module[1], nn.BatchNorm2d):
+                    # Discard the previously fused bias and fold the freshly loaded batch norm
+                    conv_layer.bias = None
+                    fuse_conv_and_bn(conv_layer, bn_layer.to(conv_layer.weight.device))
 
     def save_darknet_weights(self, path, cutoff=-1):
         """
@@ -269,12 +406,19 @@ class Darknet(nn.Module):
             if module_def["type"] == "convolutional":
                 conv_layer = module[0]
                 # If batch norm, load bn first
-                if module_def["batch_normalize"]:
+                if int(module_def["batch_normalize"]) and isinstance(module[1], nn.BatchNorm2d):
                     bn_layer = module[1]
                     bn_layer.bias.data.cpu().numpy().tofile(fp)
                     bn_layer.weight.data.cpu().numpy().tofile(fp)
                     bn_layer.running_mean.data.cpu().numpy().tofile(fp)
                     bn_layer.running_var.data.cpu().numpy().tofile(fp)
+                elif int(module_def["batch_normalize"]):
+                    # Fused layer: store the folded bias as an identity batch norm
+                    bias = conv_layer.bias.data.cpu().numpy()
+                    bias.tofile(fp)
+                    np.ones_like(bias).tofile(fp)
+                    np.zeros_like(bias).tofile(fp)
+                    np.full_like(bias, 1.0 - 1e-5).tofile(fp)
                 # Load conv bias
                 else:
                     conv_layer.bias.data.cpu().numpy().tofile(fp)
@@ -284,28 +428,209 @@ class Darknet(nn.Module):
         fp.close()
 
 
-def load_model(model_path, weights_path=None):
+class QuantizedDarknet(Darknet):
+    """YOLOv3 object detection model for post-training static INT8 quantization on CPU"""
+
+    def __init__(self, config_path):
+        super(QuantizedDarknet, self).__init__(config_path)
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+        # Concatenations and additions need their own observers to be quantized
+        self.functionals = nn.ModuleDict({
+            str(layer_i): torch.nn.quantized.FloatFunctional()
+            for layer_i, (op, refs, *_) in enumerate(self.plan)
+            if op == OP_SHORTCUT or (op == OP_ROUTE and len(refs) > 1)})
+        self.quantized = False
+
+    def prepare(self, backend=None):
+        """Fuses the batch norm layers and inserts the observers.
+        Run inference on calibration images afterwards, then call `convert`.
+
+        :param backend: Quantized engine, defaults to x86 or fbgemm
+        :type backend: str, optional
+        """
+        if backend is None:
+            backend = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+        torch.backends.quantized.engine = backend
+        self.fuse()
+        self.eval()
+        self.qconfig = torch.quantization.get_default_qconfig(backend)
+        # The box decoding stays in float
+        for yolo_layer in self.yolo_layers:
+            yolo_layer.qconfig = None
+        torch.quantization.prepare(self, inplace=True)
+        return self
+
+    def convert(self):
+        """Replaces the observed float modules by their INT8 counterparts"""
+        torch.quantization.convert(self, inplace=True)
+        self.quantized = True
+        return self
+
+    def forward(self, x):
+        # Mirrors Darknet.forward with quantization stubs and observed route and shortcut operations
+        img_size = tuple(x.shape[2:4])
+        x = self.quant(x)
+        layer_outputs, yolo_outputs = {}, []
+        for layer_i, ((op, refs, groups, group_id, store, free), module) in enumerate(zip(self.plan, self.module_list)):
+            if op == OP_SEQUENTIAL:
+                x = module(x)
+            elif op == OP_ROUTE:
+                if len(refs) == 1:
+                    x = layer_outputs[refs[0]]
+                else:
+                    x = self.functionals[str(layer_i)].cat([layer_outputs[ref] for ref in refs], 1)
+                if groups > 1:
+                    group_size = x.shape[1] // groups
+                    x = x[:, group_size * group_id : group_size * (group_id + 1)]
+            elif op == OP_SHORTCUT:
+                x = self.functionals[str(layer_i)].add(x, layer_outputs[refs[0]])
+            elif op == OP_YOLO:
+                x = module[0](self.dequant(x), img_size)
+                yolo_outputs.append(x)
+            if store:
+                layer_outputs[layer_i] = x
+            for ref in free:
+                del layer_outputs[ref]
+        return yolo_outputs if self.training else torch.cat(yolo_outputs, 1)
+
+
+class ModelCache(object):
+    """
+    Least recently used cache of loaded models, keyed by the model and weights paths, their modification
+    times, the device, the fusion flag and the precision. Changed files on disk therefore never hit a stale entry.
+    The cached models hold copies of the weights, so the files may be overwritten while they are cached.
+    """
+
+    def __init__(self, max_size=2):
+        self.max_size = max_size
+        self.models = OrderedDict()
+
+    @staticmethod
+    def key(model_path, weights_path, fuse, precision="fp32", strict=True):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        paths = [os.path.abspath(path) if path else None for path in (model_path, weights_path)]
+        mtimes = [os.path.getmtime(path) if path else None for path in paths]
+        return (*paths, *mtimes, device, fuse, precision, strict)
+
+    def get(self, key):
+        """Returns the cached model for 'key' and marks it as most recently used, None if not cached"""
+        if key not in self.models:
+            return None
+        self.models.move_to_end(key)
+        return self.models[key]
+
+    def put(self, key, model):
+        """Caches 'model' and evicts stale versions of it and the least recently used models beyond 'max_size'"""
+        for stale_key in [k for k in self.models if k[:2] == key[:2] and k[4:] == key[4:]]:
+            del self.models[stale_key]
+        self.models[key] = model
+        self.models.move_to_end(key)
+        while len(self.models) > self.max_size:
+            self.models.popitem(last=False)
+
+    def evict(self, model_path=None, weights_path=None):
+        """Removes all models loaded from 'model_path' and/or 'weights_path', all models if both are None"""
+        model_path = os.path.abspath(model_path) if model_path else None
+        weights_path = os.path.abspath(weights_path) if weights_path else None
+        for key in list(self.models):
+            if (model_path is None or key[0] == model_path) and (weights_path is None or key[1] == weights_path):
+                del self.models[key]
+
+    def clear(self):
+        self.models.clear()
+
+    def __len__(self):
+        return len(self.models)
+
+
+# Process wide cache used by load_model
+model_cache = ModelCache()
+
+
+def load_model(model_path, weights_path=None, fuse=False, cache=False, shared=False, precision="fp32", strict=True):
     """Loads the yolo model from file.
 
     :param model_path: Path to model definition file (.cfg)
     :type model_path: str
-    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth), INT8 checkpoints are detected
     :type weights_path: str
+    :param fuse: If True, folds the batch norm layers into the convolutions for inference, defaults to False
+    :type fuse: bool, optional
+    :param cache: If True, the model is built and loaded only once and kept in `model_cache`, defaults to False
+    :type cache: bool, optional
+    :param shared: If True, returns the cached instance itself in evaluation mode instead of a copy.
+        It must not be trained or modified, defaults to False
+    :type shared: bool, optional
+    :param precision: "fp32" or "bf16" to run the layers under autocast in bfloat16, for training and inference on
+        CPUs with bfloat16 instructions. The weights stay float32, defaults to "fp32"
+    :type precision: str, optional
+    :param strict: If False, the weights of a checkpoint whose shapes differ from the model stay randomly
+        initialized, e.g. the YOLO head convolutions when fine-tuning for another number of classes, defaults to True
+    :type strict: bool, optional
     :return: Returns model
     :rtype: Darknet
     """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}'. Please choose between ({', '.join(PRECISIONS)}).")
+    if not cache:
+        return _load_model(model_path, weights_path, fuse, precision, strict)
+
+    key = model_cache.key(model_path, weights_path, fuse, precision, strict)
+    model = model_cache.get(key)
+    if model is None:
+        model = _load_model(model_path, weights_path, fuse, precision, strict)
+        model_cache.put(key, model)
+    return model.eval() if shared else copy.deepcopy(model)
+
+
+def _load_model(model_path, weights_path, fuse, precision="fp32", strict=True):
+    """Builds the model and loads its weights, see `load_model`"""
+    if weights_path and weights_path.endswith(".pth"):
+        state_dict = _load_checkpoint(weights_path)
+        # Training checkpoints hold the weights next to the optimizer and random number generator states
+        state_dict = state_dict.get("model", state_dict)
+        if "quant.scale" in state_dict:
+            if precision != "fp32":
+                raise ValueError("INT8 checkpoints cannot run in another precision.")
+            # INT8 checkpoints saved by pytorchyolo.quantize only run on the CPU
+            with warnings.catch_warnings():
+                # The observers are empty, their parameters are overwritten by the checkpoint
+                warnings.simplefilter("ignore")
+                model = QuantizedDarknet(model_path).prepare().convert()
+            model.load_state_dict(state_dict)
+            return model
+
     device = torch.device("cuda" if torch.cuda.is_available()
                           else "cpu")  # Select device for inference
     model = Darknet(model_path).to(device)
+    model.precision = precision
 
-    model.apply(weights_init_normal)
+    # Layers that are loaded below do not need a random initialization
+    if not weights_path or not strict or \
+            (not weights_path.endswith(".pth") and _darknet_weights_cutoff(weights_path) is not None):
+        model.apply(weights_init_normal)
 
     # If pretrained weights are specified, start from checkpoint or weight file
     if weights_path:
         if weights_path.endswith(".pth"):
-            # Load checkpoint weights
-            model.load_state_dict(torch.load(weights_path, map_location=device))
+            skipped = []
+            if not strict:
+                shapes = {name: value.shape for name, value in model.state_dict().items()}
+                skipped = [name for name, value in state_dict.items() if shapes.get(name, value.shape) != value.shape]
+                if skipped:
+                    print(f"Weights of another shape are not loaded: {', '.join(skipped)}")
+                state_dict = {name: value for name, value in state_dict.items() if name not in skipped}
+            # Load checkpoint weights, copied from the memory-mapped tensors so that the file may be overwritten
+            keys = model.load_state_dict(state_dict, strict=strict)
+            missing = [name for name in keys.missing_keys if name not in skipped]
+            if missing or keys.unexpected_keys:
+                print(f"Weights missing from the checkpoint: {', '.join(missing) or 'none'}, "
+                      f"weights not in the model: {', '.join(keys.unexpected_keys) or 'none'}")
         else:
             # Load darknet weights
             model.load_darknet_weights(weights_path)
+
+    if fuse:
+        model.fuse()
     return model
@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+from __future__ import division
+
+import argparse
+import random
+import tqdm
+
+from terminaltables import AsciiTable
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from pytorchyolo.models import QuantizedDarknet, load_model
+from pytorchyolo.utils.utils import load_classes, images_per_second, print_environment_info
+from pytorchyolo.utils.datasets import ListDataset
+from pytorchyolo.utils.transforms import DEFAULT_TRANSFORMS
+from pytorchyolo.utils.parse_config import parse_data_config
+from pytorchyolo.test import _evaluate, _create_validation_data_loader
+
+
+def _create_calibration_data_loader(img_path, n_images, batch_size, img_size, n_cpu, seed):
+    """Creates a DataLoader over a random sample of the images listed in 'img_path'.
+
+    :param img_path: Path to file containing all paths to calibration images
+    :type img_path: str
+    :param n_images: Number of images to sample
+    :type n_images: int
+    :param batch_size: Size of each image batch
+    :type batch_size: int
+    :param img_size: Size of each image dimension for yolo
+    :type img_size: int
+    :param n_cpu: Number of cpu threads to use during batch generation
+    :type n_cpu: int
+    :param seed: Seed of the image sample
+    :type seed: int
+    :return: Returns DataLoader
+    :rtype: DataLoader
+    """
+    dataset = ListDataset(img_path, img_size=img_size, multiscale=False, transform=DEFAULT_TRANSFORMS)
+    indices = random.Random(seed).sample(range(len(dataset)), min(n_images, len(dataset)))
+    dataloader = DataLoader(
+        Subset(dataset, indices),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=n_cpu,
+        collate_fn=dataset.collate_fn)
+    return dataloader
+
+
+def quantize_model(model_path, weights_path, calibration_path, output_path=None, n_images=200,
+                   batch_size=8, img_size=416, n_cpu=2, seed=42, backend=None):
+    """Creates an INT8 model by post-training static quantization of the convolution, batch norm and leaky ReLU layers.
+    The activation ranges are calibrated on a random sample of the calibration images.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to float weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param calibration_path: Path to file containing all paths to calibration images, e.g. data/combined_valid.txt
+    :type calibration_path: str
+    :param output_path: Path of the INT8 checkpoint (.pth) that `load_model` can load, defaults to None
+    :type output_path: str, optional
+    :param n_images: Number of calibration images, defaults to 200
+    :type n_images: int, optional
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_cpu: Number of cpu threads to use during batch generation, defaults to 2
+    :type n_cpu: int, optional
+    :param seed: Seed of the calibration sample, defaults to 42
+    :type seed: int, optional
+    :param backend: Quantized engine, defaults to x86 or fbgemm
+    :type backend: str, optional
+    :return: Returns the quantized model
+    :rtype: models.QuantizedDarknet
+    """
+    float_model = load_model(model_path, weights_path).to("cpu")
+    model = QuantizedDarknet(model_path)
+    model.load_state_dict(float_model.state_dict())
+    model.seen, model.header_info = float_model.seen, float_model.header_info
+    model.prepare(backend)
+
+    dataloader = _create_calibration_data_loader(calibration_path, n_images, batch_size, img_size, n_cpu, seed)
+    with torch.no_grad():
+        for _, imgs, _ in tqdm.tqdm(dataloader, desc="Calibrating"):
+            model(imgs)
+
+    model.convert()
+
+    if output_path is not None:
+        torch.save(model.state_dict(), output_path)
+        print(f"INT8 model saved to: {output_path}")
+    return model
+
+
+def compare(model_path, weights_path, int8_weights_path, valid_path, class_names, batch_size=8, img_size=416,
+            n_cpu=2, iou_thres=0.5, conf_thres=0.1, nms_thres=0.5):
+    """Evaluates the FP32 and the INT8 model and prints their mAP next to their CPU throughput.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to float weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param int8_weights_path: Path to INT8 checkpoint file created by `quantize_model`
+    :type int8_weights_path: str
+    :param valid_path: Path to file containing all paths to validation images
+    :type valid_path: str
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_cpu: Number of cpu threads to use during batch generation, defaults to 2
+    :type n_cpu: int, optional
+    :param iou_thres: IOU threshold required to qualify as detected, defaults to 0.5
+    :type iou_thres: float, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.1
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :return: Returns (mAP, images/sec) per precision
+    :rtype: dict
+    """
+    dataloader = _create_validation_data_loader(valid_path, batch_size, img_size, n_cpu)
+    imgs = torch.rand(batch_size, 3, img_size, img_size)
+
+    results = {}
+    for precision, weights in [("FP32", weights_path), ("INT8", int8_weights_path)]:
+        model = load_model(model_path, weights).to("cpu").eval()
+        metrics_output = _evaluate(model, dataloader, class_names, img_size, iou_thres, conf_thres, nms_thres, verbose=False)
+        mAP = metrics_output[2].mean() if metrics_output is not None else 0.0
+        results[precision] = (mAP, images_per_second(model, imgs))
+
+    table = [["Precision", "mAP", "Images/sec"]]
+    for precision, (mAP, ips) in results.items():
+        table += [[precision, "%.5f" % mAP, "%.2f" % ips]]
+    print('\n' + AsciiTable(table).table)
+    return results
+
+
+def run():
+    print_environment_info()
+    parser = argparse.ArgumentParser(description="Quantize a model to INT8 for CPU inference.")
+    parser.add_argument("-m", "--model", type=str, default="models/CDA.cfg", help="Path to model definition file (.cfg)")
+    parser.add_argument("-w", "--weights", type=str, required=True, help="Path to weights or checkpoint file (.weights or .pth)")
+    parser.add_argument("-d", "--data", type=str, default="config/CDA.data", help="Path to data config file (.data)")
+    parser.add_argument("-o", "--output", type=str, default="checkpoints/yolov3_int8.pth", help="Path to INT8 checkpoint file")
+    parser.add_argument("--n_images", type=int, default=200, help="Number of calibration images")
+    parser.add_argument("-b", "--batch_size", type=int, default=8, help="Size of each image batch")
+    parser.add_argument("--img_size", type=int, default=416, help="Size of each image dimension for yolo")
+    parser.add_argument("--n_cpu", type=int, default=2, help="Number of cpu threads to use during batch generation")
+    parser.add_argument("--compare", action="store_true", help="Compare mAP and throughput of the FP32 and INT8 model")
+    args = parser.parse_args()
+    print(f"Command line arguments: {args}")
+
+    # Calibrate on the validation list of the data config
+    data_config = parse_data_config(args.data)
+    valid_path = data_config["valid"]
+
+    quantize_model(
+        args.model,
+        args.weights,
+        valid_path,
+        args.output,
+        n_images=args.n_images,
+        batch_size=args.batch_size,
+        img_size=args.img_size,
+        n_cpu=args.n_cpu)
+
+    if args.compare:
+        compare(
+            args.model,
+            args.weights,
+            args.output,
+            valid_path,
+            load_classes(data_config["names"]),
+            batch_size=args.batch_size,
+            img_size=args.img_size,
+            n_cpu=args.n_cpu)
+
+
+if __name__ == '__main__':
+    run()
@@ -2,6 +2,7 @@
 
 from __future__ import division
 
+import time
 import argparse
 import tqdm
 import numpy as np
@@ -9,15 +10,18 @@ import numpy as np
 from terminaltables import AsciiTable
 
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Subset
 from torch.autograd import Variable
 
 from pytorchyolo.models import load_model
-from pytorchyolo.utils.utils import load_classes, ap_per_class, get_batch_statistics, non_max_suppression, to_cpu, xywh2xyxy, print_environment_info
+from pytorchyolo.utils.utils import load_classes, images_per_second, ap_per_class, coco_metrics, precision_recall_sweep, get_batch_statistics, non_max_suppression, to_cpu, xywh2xyxy, print_environment_info, COCO_IOU_THRESHOLDS, DIAMETER_BUCKETS
 from pytorchyolo.utils.datasets import ListDataset
 from pytorchyolo.utils.transforms import DEFAULT_TRANSFORMS
 from pytorchyolo.utils.parse_config import parse_data_config
 from pytorchyolo.utils.loss import compute_loss
+from pytorchyolo.utils.tta import dihedral_tta
+from pytorchyolo.utils.prediction_store import PredictionStore, PredictionStoreWriter
 
 class Args:
     def __init__(self, model, weights, config, img_size, batch_size):
@@ -33,7 +37,9 @@ class Args:
         self.nms_thres = 0.5
 
 def evaluate_model_file(model_path, weights_path, img_path, class_names, batch_size=8, img_size=416,
-                        n_cpu=8, iou_thres=0.5, conf_thres=0.5, nms_thres=0.5, verbose=True):
+                        n_cpu=8, iou_thres=0.5, conf_thres=0.5, nms_thres=0.5, verbose=True, tta=False,
+                        nms_method="greedy", geometry="box", store_path=None, precision="fp32",
+                        cache=False):
     """Evaluate model on validation dataset.
 
     :param model_path: Path to model definition file (.cfg)
@@ -58,11 +64,25 @@ def evaluate_model_file(model_path, weights_path, img_path, class_names, batch_s
     :type nms_thres: float, optional
     :param verbose: If True, prints stats of model, defaults to True
     :type verbose: bool, optional
+    :param tta: If True, evaluates the fused detections on all flips and transposes of each image, defaults to False
+    :type tta: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression and of the matching to targets, "box" or "circle" for the IoU of
+        the circles inscribed in the boxes, defaults to "box"
+    :type geometry: str, optional
+    :param store_path: Directory to store the raw model outputs and targets in for `evaluate_store`, defaults to None
+    :type store_path: str, optional
+    :param precision: "fp32" or "bf16" to inference under bfloat16 autocast, defaults to "fp32"
+    :type precision: str, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, e.g. in threshold sweeps,
+        see `models.load_model`, defaults to False
+    :type cache: bool, optional
     :return: Returns precision, recall, AP, f1, ap_class
     """
     dataloader = _create_validation_data_loader(
         img_path, batch_size, img_size, n_cpu)
-    model = load_model(model_path, weights_path)
+    model = load_model(model_path, weights_path, cache=cache, shared=cache, precision=precision)
     metrics_output = _evaluate(
         model,
         dataloader,
@@ -71,10 +91,108 @@ def evaluate_model_file(model_path, weights_path, img_path, class_names, batch_s
         iou_thres,
         conf_thres,
         nms_thres,
-        verbose)
+        verbose,
+        tta,
+        nms_method,
+        geometry,
+        store_path)
     return metrics_output
 
 
+def coco_evaluate_model_file(model_path, weights_path, img_path, class_names, batch_size=8, img_size=416, n_cpu=8,
+                             conf_thres=0.1, nms_thres=0.5, interpolation="101", buckets=DIAMETER_BUCKETS,
+                             verbose=True, tta=False, nms_method="greedy", geometry="box", cache=False):
+    """Evaluate the COCO style mAP@[.5:.95] of a model on a validation dataset, see `evaluate_coco`.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param img_path: Path to file containing all paths to validation images.
+    :type img_path: str
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_cpu: Number of cpu threads to use during batch generation, defaults to 8
+    :type n_cpu: int, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.1
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param interpolation: "101" point or "continuous" interpolation of the AP, defaults to "101"
+    :type interpolation: str, optional
+    :param buckets: Crater diameter buckets as (min, max) pairs in pixels, defaults to one bucket per octave
+    :type buckets: ((float, float)), optional
+    :param verbose: If True, prints the AP of each class, defaults to True
+    :type verbose: bool, optional
+    :param tta: If True, evaluates the fused detections on all flips and transposes of each image, defaults to False
+    :type tta: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression and of the matching to targets, "box" or "circle", defaults to "box"
+    :type geometry: str, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, see `models.load_model`,
+        defaults to False
+    :type cache: bool, optional
+    :return: Returns the metrics of `utils.coco_metrics`
+    :rtype: dict
+    """
+    dataloader = _create_validation_data_loader(img_path, batch_size, img_size, n_cpu)
+    model = load_model(model_path, weights_path, cache=cache, shared=cache)
+    return evaluate_coco(model, dataloader, class_names, img_size, conf_thres, nms_thres, interpolation=interpolation,
+                         buckets=buckets, verbose=verbose, tta=tta, nms_method=nms_method, geometry=geometry)
+
+
+def precision_recall_model_file(model_path, weights_path, img_path, class_names, confs, batch_size=8, img_size=416,
+                                n_cpu=8, iou_thres=0.5, nms_thres=0.5, cache=False):
+    """Computes precision and recall at all confidence thresholds from a single validation pass at the lowest one,
+    see `utils.precision_recall_sweep`.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param img_path: Path to file containing all paths to validation images.
+    :type img_path: str
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param confs: Object confidence thresholds
+    :type confs: [float]
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_cpu: Number of cpu threads to use during batch generation, defaults to 8
+    :type n_cpu: int, optional
+    :param iou_thres: IOU threshold required to qualify as detected, defaults to 0.5
+    :type iou_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, see `models.load_model`,
+        defaults to False
+    :type cache: bool, optional
+    :return: Returns precision and recall per class and threshold and the best F1 threshold per class
+    :rtype: dict
+    """
+    dataloader = _create_validation_data_loader(img_path, batch_size, img_size, n_cpu)
+    model = load_model(model_path, weights_path, cache=cache, shared=cache)
+    labels, sample_metrics, _ = _collect_statistics(model, dataloader, img_size, iou_thres, min(confs), nms_thres)
+
+    if len(sample_metrics):
+        true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
+    else:
+        true_positives, pred_scores, pred_labels = np.zeros(0), np.zeros(0), np.zeros(0)
+    sweep = precision_recall_sweep(true_positives, pred_scores, pred_labels, labels, confs)
+
+    for c, (f1, conf, precision, recall) in sweep["best_f1"].items():
+        print(f"{class_names[c]}: best F1 {f1:.3f} at confidence threshold {conf:.3f} "
+              f"(precision {precision:.3f}, recall {recall:.3f})")
+    return sweep
+
+
 def print_eval_stats(metrics_output, class_names, verbose):
     if metrics_output is not None:
         precision, recall, AP, f1, ap_class = metrics_output
@@ -89,7 +207,8 @@ def print_eval_stats(metrics_output, class_names, verbose):
         print("---- mAP not measured (no detections found by model) ----")
 
 
-def _evaluate(model, dataloader, class_names, img_size, iou_thres, conf_thres, nms_thres, verbose):
+def _evaluate(model, dataloader, class_names, img_size, iou_thres, conf_thres, nms_thres, verbose, tta=False,
+              nms_method="greedy", geometry="box", store_path=None):
     """Evaluate model on validation dataset.
 
     :param model: Model to evaluate
@@ -108,47 +227,367 @@ def _evaluate(model, dataloader, class_names, img_size, iou_thres, conf_thres, n
     :type nms_thres: float
     :param verbose: If True, prints stats of model
     :type verbose: bool
+    :param tta: If True, evaluates the fused detections on all flips and transposes of each image, defaults to False
+    :type tta: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression and of the matching to targets, "box" or "circle" for the IoU of
+        the circles inscribed in the boxes, defaults to "box"
+    :type geometry: str, optional
+    :param store_path: Directory to store the raw model outputs and targets in for `evaluate_store`, defaults to None
+    :type store_path: str, optional
     :return: Returns precision, recall, AP, f1, ap_class
     """
+    if store_path is None:
+        labels, sample_metrics, _ = _collect_statistics(
+            model, dataloader, img_size, iou_thres, conf_thres, nms_thres, tta, nms_method, geometry)
+    else:
+        with PredictionStoreWriter(store_path, model, img_size, min_obj=min(conf_thres, 0.001)) as store:
+            labels, sample_metrics, _ = _collect_statistics(
+                model, dataloader, img_size, iou_thres, conf_thres, nms_thres, tta, nms_method, geometry, store=store)
+
+    return _metrics_from_statistics(labels, sample_metrics, class_names, verbose)
+
+
+def _evaluate_with_loss(model, dataloader, class_names, img_size, iou_thres, conf_thres, nms_thres, verbose):
+    """Evaluates the metrics of `_evaluate` and the loss of the model on the validation dataset with one forward
+    pass per batch in evaluation mode.
+
+    :param model: Model to evaluate
+    :type model: models.Darknet
+    :param dataloader: Dataloader provides the batches of images with targets
+    :type dataloader: DataLoader
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param img_size: Size of each image dimension for yolo
+    :type img_size: int
+    :param iou_thres: IOU threshold required to qualify as detected
+    :type iou_thres: float
+    :param conf_thres: Object confidence threshold
+    :type conf_thres: float
+    :param nms_thres: IOU threshold for non-maximum suppression
+    :type nms_thres: float
+    :param verbose: If True, prints stats of model
+    :type verbose: bool
+    :return: Returns (precision, recall, AP, f1, ap_class) and the loss components (box, object, class, total)
+        averaged over all images. In distributed training, every process validates its shard of the images and
+        only rank 0 returns the results of all of them, the other ranks return None
+    :rtype: tuple, torch.Tensor
+    """
+    losses = []
+    labels, sample_metrics, _ = _collect_statistics(
+        model, dataloader, img_size, iou_thres, conf_thres, nms_thres, losses=losses)
+    if dist.is_available() and dist.is_initialized():
+        shards = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+        dist.gather_object((labels, sample_metrics, losses), shards, dst=0)
+        if dist.get_rank() != 0:
+            return None, None
+        labels, sample_metrics, losses = [sum(parts, []) for parts in zip(*shards)]
+    # Every image has statistics, the loss components of each batch are weighted by its size
+    loss_components = torch.stack(losses).sum(0) / max(len(sample_metrics), 1)
+    return _metrics_from_statistics(labels, sample_metrics, class_names, verbose), loss_components
+
+
+def _metrics_from_statistics(labels, sample_metrics, class_names, verbose):
+    """Computes and prints precision, recall, AP, f1 and ap_class from the statistics of all samples."""
+    if len(sample_metrics) == 0:  # No detections over whole validation set.
+        print("---- No detections over whole validation set ----")
+        return None
+
+    # Concatenate sample statistics
+    true_positives, pred_scores, pred_labels = [
+        np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
+    metrics_output = ap_per_class(
+        true_positives, pred_scores, pred_labels, labels)
+
+    print_eval_stats(metrics_output, class_names, verbose)
+
+    return metrics_output
+
+
+def _collect_statistics(model, dataloader, img_size, iou_thres, conf_thres, nms_thres, tta=False,
+                        nms_method="greedy", geometry="box", diameters=False, store=None, losses=None):
+    """Detects objects on the validation batches and matches them to the targets in one pass.
+    Returns the target labels, the statistics of `utils.get_batch_statistics` per sample and, with 'diameters',
+    the target diameters (else None). The raw outputs and the targets are also written to 'store', if given.
+    If 'losses' is a list, the loss components of each batch, times its size, are appended to it, computed from
+    the same forward pass."""
+    if tta and (store is not None or losses is not None):
+        raise ValueError("The raw outputs of test-time augmentation can not be stored or used for the loss.")
     model.eval()  # Set model to evaluation mode
 
     Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
 
     labels = []
+    target_diameters = []
     sample_metrics = []  # List of tuples (TP, confs, pred)
-    for _, imgs, targets in tqdm.tqdm(dataloader, desc="Validating"):
+    for img_paths, imgs, targets in tqdm.tqdm(dataloader, desc="Validating"):
+        # The loss takes the normalized targets
+        loss_targets = targets.clone() if losses is not None else None
         # Extract labels
         labels += targets[:, 1].tolist()
         # Rescale target
         targets[:, 2:] = xywh2xyxy(targets[:, 2:])
         targets[:, 2:] *= img_size
+        # Mean of width and height, like the predicted diameters
+        target_diameters += ((targets[:, 4] - targets[:, 2] + targets[:, 5] - targets[:, 3]) / 2).tolist()
 
         imgs = Variable(imgs.type(Tensor), requires_grad=False)
 
         with torch.no_grad():
-            outputs = to_cpu(model(imgs))
-            outputs = non_max_suppression(outputs, conf_thres=conf_thres, iou_thres=nms_thres)
+            if tta:
+                outputs = [to_cpu(output) for output in dihedral_tta(model, imgs, conf_thres, nms_thres)]
+            elif losses is not None:
+                outputs, head_outputs = model(imgs, raw=True)
+                _, loss_components = compute_loss(head_outputs, loss_targets.to(imgs.device), model)
+                losses.append(loss_components * len(imgs))
+                outputs = to_cpu(outputs)
+            else:
+                outputs = to_cpu(model(imgs))
+            if not tta:
+                if store is not None:
+                    store.append(img_paths, outputs, targets)
+                outputs = non_max_suppression(outputs, conf_thres=conf_thres, iou_thres=nms_thres, method=nms_method,
+                                              geometry=geometry)
+
+        sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres, geometry=geometry,
+                                               diameters=diameters)
+    return labels, sample_metrics, np.array(target_diameters) if diameters else None
+
+
+def evaluate_store(store_path, class_names, iou_thres=0.5, conf_thres=0.5, nms_thres=0.5, verbose=True,
+                   nms_method="greedy", geometry="box"):
+    """Evaluates the raw outputs stored by `_evaluate` again with other suppression and matching settings,
+    without inferencing the images.
+
+    :param store_path: Directory of the prediction store
+    :type store_path: str
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param iou_thres: IOU threshold required to qualify as detected, defaults to 0.5
+    :type iou_thres: float, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.5
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param verbose: If True, prints stats of model, defaults to True
+    :type verbose: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression and of the matching to targets, "box" or "circle", defaults to "box"
+    :type geometry: str, optional
+    :return: Returns precision, recall, AP, f1, ap_class
+    """
+    store = PredictionStore(store_path)
+    targets = store.targets()
+    if targets is None:
+        raise ValueError(f"The prediction store '{store_path}' holds no targets to evaluate against.")
+    outputs = store.detections(conf_thres, nms_thres, method=nms_method, geometry=geometry)
+    sample_metrics = get_batch_statistics(outputs, targets, iou_threshold=iou_thres, geometry=geometry)
+    return _metrics_from_statistics(targets[:, 1].tolist(), sample_metrics, class_names, verbose)
 
-        sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres)
+
+def evaluate_coco(model, dataloader, class_names, img_size, conf_thres, nms_thres,
+                  iou_thresholds=COCO_IOU_THRESHOLDS, interpolation="101", buckets=DIAMETER_BUCKETS, verbose=True,
+                  tta=False, nms_method="greedy", geometry="box"):
+    """Evaluates the COCO style mAP at all IoU thresholds and per crater diameter bucket in one validation pass.
+
+    :param model: Model to evaluate
+    :type model: models.Darknet
+    :param dataloader: Dataloader provides the batches of images with targets
+    :type dataloader: DataLoader
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param img_size: Size of each image dimension for yolo
+    :type img_size: int
+    :param conf_thres: Object confidence threshold
+    :type conf_thres: float
+    :param nms_thres: IOU threshold for non-maximum suppression
+    :type nms_thres: float
+    :param iou_thresholds: IOU thresholds required to qualify as detected, defaults to 0.5:0.95
+    :type iou_thresholds: np.ndarray, optional
+    :param interpolation: "101" point or "continuous" interpolation of the AP, defaults to "101"
+    :type interpolation: str, optional
+    :param buckets: Crater diameter buckets as (min, max) pairs in pixels, defaults to one bucket per octave
+    :type buckets: ((float, float)), optional
+    :param verbose: If True, prints the AP of each class, defaults to True
+    :type verbose: bool, optional
+    :param tta: If True, evaluates the fused detections on all flips and transposes of each image, defaults to False
+    :type tta: bool, optional
+    :param nms_method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+    :type nms_method: str, optional
+    :param geometry: Overlap of the suppression and of the matching to targets, "box" or "circle", defaults to "box"
+    :type geometry: str, optional
+    :return: Returns the metrics of `utils.coco_metrics`
+    :rtype: dict
+    """
+    labels, sample_metrics, target_diameters = _collect_statistics(
+        model, dataloader, img_size, iou_thresholds, conf_thres, nms_thres, tta, nms_method, geometry, diameters=True)
 
     if len(sample_metrics) == 0:  # No detections over whole validation set.
         print("---- No detections over whole validation set ----")
         return None
 
-    # Concatenate sample statistics
-    true_positives, pred_scores, pred_labels = [
+    true_positives, pred_scores, pred_labels, pred_diameters, match_diameters = [
         np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
-    metrics_output = ap_per_class(
-        true_positives, pred_scores, pred_labels, labels)
+    metrics = coco_metrics(
+        true_positives, pred_scores, pred_labels, np.array(labels), iou_thresholds, pred_diameters, match_diameters,
+        target_diameters, buckets, interpolation)
 
-    print_eval_stats(metrics_output, class_names, verbose)
+    print_coco_stats(metrics, class_names, verbose)
+    return metrics
 
-    return metrics_output
+
+def print_coco_stats(metrics, class_names, verbose):
+    if verbose:
+        # Prints class AP over all thresholds
+        ap_table = [["Index", "Class", "AP@[.5:.95]"]]
+        for i, c in enumerate(metrics["ap_class"]):
+            ap_table += [[c, class_names[c], "%.5f" % metrics["AP"][i].mean()]]
+        print('\n' + AsciiTable(ap_table).table)
+
+    table = [["Metric", "mAP"], ["mAP@[.5:.95]", "%.5f" % metrics["mAP"]]]
+    for name, label in (("mAP50", "mAP@.5"), ("mAP75", "mAP@.75")):
+        if name in metrics:
+            table += [[label, "%.5f" % metrics[name]]]
+    for (low, high), mAP in metrics.get("buckets", {}).items():
+        table += [[f"mAP@[.5:.95], {low:g} <= d < {high:g} px", "-" if np.isnan(mAP) else "%.5f" % mAP]]
+    print('\n' + AsciiTable(table).table)
+
+
+def compare_nms(model_path, weights_path, img_path, class_names, methods=("greedy", "cluster", "matrix"),
+                batch_size=8, img_size=416, n_cpu=8, iou_thres=0.5, conf_thres=0.1, nms_thres=0.5, geometry="box",
+                cache=False):
+    """Evaluates the suppression methods of `utils.non_max_suppression` on the same model outputs and prints
+    their mAP next to their NMS time, e.g. on data/robbins_test.txt.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param img_path: Path to file containing all paths to validation images.
+    :type img_path: str
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param methods: Suppression methods to compare, defaults to ("greedy", "cluster", "matrix")
+    :type methods: (str), optional
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_cpu: Number of cpu threads to use during batch generation, defaults to 8
+    :type n_cpu: int, optional
+    :param iou_thres: IOU threshold required to qualify as detected, defaults to 0.5
+    :type iou_thres: float, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.1
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param geometry: Overlap of the suppression and of the matching to targets, "box" or "circle", defaults to "box"
+    :type geometry: str, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, see `models.load_model`,
+        defaults to False
+    :type cache: bool, optional
+    :return: Returns (mAP, NMS ms per image) per method
+    :rtype: dict
+    """
+    dataloader = _create_validation_data_loader(img_path, batch_size, img_size, n_cpu)
+    model = load_model(model_path, weights_path, cache=cache, shared=cache)
+    model.eval()
+
+    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+
+    labels = []
+    sample_metrics = {method: [] for method in methods}
+    nms_time = {method: 0.0 for method in methods}
+    for _, imgs, targets in tqdm.tqdm(dataloader, desc="Validating"):
+        labels += targets[:, 1].tolist()
+        targets[:, 2:] = xywh2xyxy(targets[:, 2:])
+        targets[:, 2:] *= img_size
+
+        with torch.no_grad():
+            outputs = to_cpu(model(imgs.type(Tensor)))
+
+        # Every method suppresses the same outputs
+        for method in methods:
+            start = time.perf_counter()
+            detections = non_max_suppression(outputs, conf_thres=conf_thres, iou_thres=nms_thres, method=method,
+                                             geometry=geometry)
+            nms_time[method] += time.perf_counter() - start
+            sample_metrics[method] += get_batch_statistics(detections, targets, iou_threshold=iou_thres,
+                                                           geometry=geometry)
+
+    results = {}
+    for method in methods:
+        mAP = 0.0
+        if len(sample_metrics[method]):
+            true_positives, pred_scores, pred_labels = [
+                np.concatenate(x, 0) for x in list(zip(*sample_metrics[method]))]
+            mAP = ap_per_class(true_positives, pred_scores, pred_labels, labels)[2].mean()
+        results[method] = (mAP, nms_time[method] * 1000 / len(dataloader.dataset))
+
+    table = [["NMS", "mAP", "NMS ms/image"]]
+    for method, (mAP, ms) in results.items():
+        table += [[method, "%.5f" % mAP, "%.2f" % ms]]
+    print('\n' + AsciiTable(table).table)
+    return results
+
+
+def compare_precision(model_path, weights_path, img_path, class_names, precisions=("fp32", "bf16"), batch_size=8,
+                      img_size=416, n_cpu=8, iou_thres=0.5, conf_thres=0.1, nms_thres=0.5, cache=False):
+    """Evaluates the model in each precision of `models.load_model` and prints their mAP next to their throughput,
+    e.g. on data/combined_valid.txt.
+
+    :param model_path: Path to model definition file (.cfg)
+    :type model_path: str
+    :param weights_path: Path to weights or checkpoint file (.weights or .pth)
+    :type weights_path: str
+    :param img_path: Path to file containing all paths to validation images.
+    :type img_path: str
+    :param class_names: List of class names
+    :type class_names: [str]
+    :param precisions: Precisions to compare, defaults to ("fp32", "bf16")
+    :type precisions: (str), optional
+    :param batch_size: Size of each image batch, defaults to 8
+    :type batch_size: int, optional
+    :param img_size: Size of each image dimension for yolo, defaults to 416
+    :type img_size: int, optional
+    :param n_cpu: Number of cpu threads to use during batch generation, defaults to 8
+    :type n_cpu: int, optional
+    :param iou_thres: IOU threshold required to qualify as detected, defaults to 0.5
+    :type iou_thres: float, optional
+    :param conf_thres: Object confidence threshold, defaults to 0.1
+    :type conf_thres: float, optional
+    :param nms_thres: IOU threshold for non-maximum suppression, defaults to 0.5
+    :type nms_thres: float, optional
+    :param cache: If True, reuses the model loaded by an earlier call with the same files, see `models.load_model`,
+        defaults to False
+    :type cache: bool, optional
+    :return: Returns (mAP, images/sec) per precision
+    :rtype: dict
+    """
+    dataloader = _create_validation_data_loader(img_path, batch_size, img_size, n_cpu)
+    # The throughput is measured on the first validation batch
+    imgs = next(iter(dataloader))[1]
+
+    results = {}
+    for precision in precisions:
+        model = load_model(model_path, weights_path, cache=cache, shared=cache, precision=precision).eval()
+        metrics_output = _evaluate(model, dataloader, class_names, img_size, iou_thres, conf_thres, nms_thres,
+                                   verbose=False)
+        mAP = metrics_output[2].mean() if metrics_output is not None else 0.0
+        results[precision] = (mAP, images_per_second(model, imgs.to(next(model.parameters()).device)))
+
+    table = [["Precision", "mAP", "Images/sec"]]
+    for precision, (mAP, ips) in results.items():
+        table += [[precision, "%.5f" % mAP, "%.2f" % ips]]
+    print('\n' + AsciiTable(table).table)
+    return results
 
 
-def _create_validation_data_loader(img_path, batch_size, img_size, n_cpu):
+def _create_validation_data_loader(img_path, batch_size, img_size, n_cpu, rank=0, world_size=1):
     """
-    Creates a DataLoader for validation.
+    Creates a DataLoader for validation, over every 'world_size'-th image starting at 'rank' in distributed training.
 
     :param img_path: Path to file containing all paths to validation images.
     :type img_path: str
@@ -158,12 +597,16 @@ def _create_validation_data_loader(img_path, batch_size, img_size, n_cpu):
     :type img_size: int
     :param n_cpu: Number of cpu threads to use during batch generation
     :type n_cpu: int
+    :param rank: Rank of the process in distributed training, defaults to 0
+    :type rank: int, optional
+    :param world_size: Number of processes in distributed training, defaults to 1
+    :type world_size: int, optional
     :return: Returns DataLoader
     :rtype: DataLoader
     """
     dataset = ListDataset(img_path, img_size=img_size, multiscale=False, transform=DEFAULT_TRANSFORMS)
     dataloader = DataLoader(
-        dataset,
+        Subset(dataset, range(rank, len(dataset), world_size)) if world_size > 1 else dataset,
         batch_size=batch_size,
         shuffle=False,
         num_workers=n_cpu,
@@ -172,7 +615,7 @@ def _create_validation_data_loader(img_path, batch_size, img_size, n_cpu):
     return dataloader
 
 
-def test(model, weights, config, test_paths, img_size=416, batch_size=8):
+def test(model, weights, config, test_paths, img_size=416, batch_size=8, tta=False):
     # print_environment_info()
     # parser = argparse.ArgumentParser(description="Evaluate validation data.")
     # parser.add_argument("-m", "--model", type=str, default="config/yolov3.cfg", help="Path to model definition file (.cfg)")
@@ -207,4 +650,5 @@ def test(model, weights, config, test_paths, img_size=416, batch_size=8):
         iou_thres=args.iou_thres,
         conf_thres=args.conf_thres,
         nms_thres=args.nms_thres,
-        verbose=True)
+        verbose=True,
+        tta=tta)
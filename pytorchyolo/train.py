@@ -3,23 +3,32 @@
 from __future__ import division
 
 import os
+import argparse
+import contextlib
+from datetime import timedelta
 import tqdm
 import numpy as np
 import pandas as pd
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import torch.optim as optim
 
 from pytorchyolo.models import load_model
-from pytorchyolo.utils.logger import Logger
+from pytorchyolo.utils.logger import Logger, Telemetry
 from pytorchyolo.utils.utils import to_cpu, load_classes, print_environment_info, provide_determinism, worker_seed_set
 from pytorchyolo.utils.datasets import ListDataset
 from pytorchyolo.utils.augmentations import AUGMENTATION_TRANSFORMS
 # from pytorchyolo.utils.transforms import DEFAULT_TRANSFORMS
 from pytorchyolo.utils.parse_config import parse_data_config
 from pytorchyolo.utils.loss import compute_loss
-from pytorchyolo.test import _evaluate, _create_validation_data_loader
+from pytorchyolo.utils.checkpoints import CheckpointSaver, load_checkpoint, latest_checkpoint, rng_state, set_rng_state
+from pytorchyolo.utils.feature_cache import FeatureCache, write_feature_cache
+from pytorchyolo.test import _evaluate_with_loss, _create_validation_data_loader
 
 from terminaltables import AsciiTable
 
@@ -27,7 +36,7 @@ from torchsummary import summary
 
 
 class Args:
-    def __init__(self, model, epochs, seed, pretrained_weights, config):
+    def __init__(self, model, epochs, seed, pretrained_weights, config, precision="fp32", distributed=False):
         self.model = model
         self.data = config
         self.epochs = epochs
@@ -42,9 +51,11 @@ class Args:
         self.nms_thres = 0.5
         self.logdir = 'logs'
         self.seed = seed
+        self.precision = precision
+        self.distributed = distributed
 
 def _create_data_loader(img_path, batch_size, img_size, n_cpu, 
-                        multiscale_training=False, shuffle_order=True):
+                        multiscale_training=False, shuffle_order=True, distributed=False, seed=42):
     """Creates a DataLoader for training.
 
     :param img_path: Path to file containing all paths to training images.
@@ -57,6 +68,11 @@ def _create_data_loader(img_path, batch_size, img_size, n_cpu,
     :type n_cpu: int
     :param multiscale_training: Scale images to different sizes randomly
     :type multiscale_training: bool
+    :param distributed: If True, each process of the process group loads its own shard of the images.
+        Call `set_epoch` of the sampler before every epoch, defaults to False
+    :type distributed: bool, optional
+    :param seed: Seed of the shuffled order of the shards, the same in all processes, defaults to 42
+    :type seed: int, optional
     :return: Returns DataLoader
     :rtype: DataLoader
     """
@@ -66,16 +82,61 @@ def _create_data_loader(img_path, batch_size, img_size, n_cpu,
         img_size=img_size,
         multiscale=multiscale_training,
         transform=AUGMENTATION_TRANSFORMS)
+    sampler = DistributedSampler(dataset, shuffle=shuffle_order, seed=seed) if distributed else None
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=shuffle_order,
+        shuffle=shuffle_order and sampler is None,
+        sampler=sampler,
         num_workers=n_cpu,
         pin_memory=True,
         collate_fn=dataset.collate_fn,
         worker_init_fn=worker_seed_set)
     return dataloader
 
+def _create_feature_data_loader(cache_path, model, img_path, batch_size, n_cpu, cutoff, n_variants=2):
+    """Creates a DataLoader for training on the features of the frozen backbone of 'model', which are cached in
+    'cache_path'. The cache is written first, unless it holds the features of the same backbone, images and labels.
+
+    :param cache_path: Directory of the `FeatureCache`
+    :type cache_path: str
+    :param model: Model whose backbone computes the features
+    :type model: models.Darknet
+    :param img_path: Path to file containing all paths to training images.
+    :type img_path: str
+    :param batch_size: Size of each batch
+    :type batch_size: int
+    :param n_cpu: Number of cpu threads to use during batch generation
+    :type n_cpu: int
+    :param cutoff: Number of layers of the backbone
+    :type cutoff: int
+    :param n_variants: Number of flipped variants of each image, defaults to 2
+    :type n_variants: int, optional
+    :return: Returns DataLoader
+    :rtype: DataLoader
+    """
+    img_size = model.hyperparams['height']
+    with open(img_path, "r") as file:
+        image_paths = [path.rstrip() for path in file.readlines()]
+    cache = FeatureCache(cache_path) if os.path.exists(os.path.join(cache_path, "meta.json")) else None
+    if cache is not None and cache.is_current(model, image_paths, img_size, n_variants):
+        print(f"Reusing the backbone features cached in: {cache_path}")
+    else:
+        # The images are loaded in order and without augmentations, the random states are left as they were
+        with torch.random.fork_rng():
+            cache = write_feature_cache(cache_path, model, _create_validation_data_loader(
+                img_path, batch_size, img_size, n_cpu), cutoff, n_variants)
+
+    dataloader = DataLoader(
+        cache,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=n_cpu,
+        pin_memory=True,
+        collate_fn=cache.collate_fn,
+        worker_init_fn=worker_seed_set)
+    return dataloader
+
 def save_losses(model_path, weights, paths):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -106,13 +167,62 @@ def save_losses(model_path, weights, paths):
     loss_df.to_csv('loss_table.csv')
     print('Loss table saved to loss_table.csv')
 
-def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=None, show_loss=False):
-    print("Training\n")
-    args = Args(model, epochs, seed, pretrained_weights, config)
-    print(f"Parameters: \nEpochs: {args.epochs}, Seed: {args.seed}")
+def _init_distributed():
+    """Joins the gloo process group of a torchrun style launch, configured by the RANK, WORLD_SIZE, MASTER_ADDR and
+    MASTER_PORT environment variables. Returns the rank of the process and the number of processes."""
+    if not dist.is_initialized():
+        # Rank 0 validates its shard while the others may wait in the gather, allow for slow CPU epochs
+        dist.init_process_group("gloo", timeout=timedelta(hours=6))
+    return dist.get_rank(), dist.get_world_size()
+
+def launch(n_procs, model, epochs, config, master_port=29500, **kwargs):
+    """Trains with `run` in 'n_procs' processes on this machine, which share its CPU cores.
+    To train on several nodes, start `run(..., distributed=True)` with torchrun on every node instead, e.g.
+    torchrun --nnodes 2 --nproc_per_node 4 --rdzv_endpoint host:29500 -m pytorchyolo.train -m models/CDA.cfg
+
+    :param n_procs: Number of processes
+    :type n_procs: int
+    :param master_port: Free port of the process group on this machine, defaults to 29500
+    :type master_port: int, optional
+    """
+    mp.spawn(_launched_run, args=(n_procs, master_port, (model, epochs, config), kwargs), nprocs=n_procs)
+
+def _launched_run(rank, n_procs, master_port, args, kwargs):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(master_port), RANK=str(rank),
+                      LOCAL_RANK=str(rank), WORLD_SIZE=str(n_procs))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_procs))
+    run(*args, distributed=True, **kwargs)
+
+def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=None, show_loss=False, precision="fp32",
+        distributed=False, resume=None, keep_last=None, keep_best=0, telemetry=True, cached_backbone=None,
+        cache_variants=2, partial_weights=False):
+    """Trains the model for 'epochs' epochs. Every checkpoint holds the full training state and is written in the
+    background. With 'resume', a run continues from such a checkpoint as if it had not been interrupted.
+    'resume' is the path of a checkpoint or True for the latest one in checkpoints/. 'keep_last' limits the
+    checkpoints kept to the latest ones, all if None, plus the 'keep_best' ones with the highest mAP.
+    With 'telemetry', the time spent waiting for data, in the forward pass, the loss, the backward pass and the
+    optimizer step of every iteration is logged to TensorBoard in logs/ and to telemetry.jsonl next to it.
+    With 'cached_backbone', the backbone is frozen and runs only once over the training images, in 'cache_variants'
+    flips. Its features are cached in the directory 'cached_backbone', or feature_cache/ if True, and the epochs
+    train the layers after it on them. With 'partial_weights', pretrained weights of another shape than the model,
+    e.g. the YOLO heads of the CDA weights in the classifier, are skipped instead of raising an error. This is
+    only allowed with 'cached_backbone', where they belong to the trained layers."""
+    args = Args(model, epochs, seed, pretrained_weights, config, precision, distributed)
+    if cached_backbone and distributed:
+        raise ValueError("Training on a cached backbone is not supported in distributed training.")
+    if partial_weights and not cached_backbone:
+        raise ValueError("Partial pretrained weights are only supported when training on a cached backbone.")
+    # In distributed training, every process trains on a shard of each epoch and only rank 0 reports and saves
+    rank, world_size = _init_distributed() if args.distributed else (0, 1)
+    is_main = rank == 0
+    if is_main:
+        print("Training\n")
+        print(f"Parameters: \nEpochs: {args.epochs}, Seed: {args.seed}, Precision: {args.precision}, "
+              f"Processes: {world_size}")
 
     if args.seed != -1:
-        provide_determinism(args.seed)
+        # Each rank draws its own deterministic augmentations, rank 0 initializes the model that DDP broadcasts
+        provide_determinism(args.seed + rank)
 
     # Create output directories if missing
     os.makedirs("output", exist_ok=True)
@@ -129,32 +239,71 @@ def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=Non
     # Create model
     # ############
 
-    model = load_model(args.model, args.pretrained_weights)
+    checkpoint = None
+    if resume:
+        resume = latest_checkpoint() if resume is True else resume
+        if resume is None:
+            raise ValueError("No checkpoint to resume from in checkpoints/.")
+        checkpoint = load_checkpoint(resume)
+        if "optimizer" not in checkpoint:
+            raise ValueError(f"'{resume}' only holds model weights, pass it as the pretrained weights instead.")
+
+    # With "bf16", the forward passes of training and validation run under CPU autocast, the loss in float32
+    model = load_model(args.model, None if resume else args.pretrained_weights, precision=args.precision,
+                       strict=not partial_weights)
+    if checkpoint is not None:
+        # The checkpoint read above also holds the weights
+        model.load_state_dict(checkpoint["model"])
+    # The loss reads the YOLO layers of 'model', the training forward passes go through 'train_model'
+    train_model = DistributedDataParallel(model) if args.distributed else model
 
     # Print model
-    if args.verbose:
+    if args.verbose and is_main:
         summary(model, input_size=(3, model.hyperparams['height'], model.hyperparams['height']))
 
     mini_batch_size = model.hyperparams['batch'] // model.hyperparams['subdivisions']
+    # The subdivisions of a batch are split over the processes, which accumulate their share before each step
+    accumulations = max(1, model.hyperparams['subdivisions'] // world_size)
+    if is_main and accumulations * world_size != model.hyperparams['subdivisions']:
+        print(f"Effective batch size: {mini_batch_size * accumulations * world_size}")
+
+    cutoff = model.backbone_cutoff() if cached_backbone else 0
+    # The frozen backbone is left out of the optimizer, its batch norm statistics stay those of the cached features
+    for module in model.module_list[:cutoff]:
+        module.requires_grad_(False)
 
     # #################
     # Create Dataloader
     # #################
 
     # Load training dataloader
-    dataloader = _create_data_loader(
-        train_path,
-        mini_batch_size,
-        model.hyperparams['height'],
-        args.n_cpu,
-        args.multiscale_training)
+    if cached_backbone:
+        dataloader = _create_feature_data_loader(
+            "feature_cache" if cached_backbone is True else cached_backbone,
+            model,
+            train_path,
+            mini_batch_size,
+            args.n_cpu,
+            cutoff,
+            cache_variants)
+    else:
+        dataloader = _create_data_loader(
+            train_path,
+            mini_batch_size,
+            model.hyperparams['height'],
+            args.n_cpu,
+            args.multiscale_training,
+            distributed=args.distributed,
+            seed=args.seed)
 
     # Load validation dataloader
     validation_dataloader = _create_validation_data_loader(
         valid_path,
         mini_batch_size,
         model.hyperparams['height'],
-        args.n_cpu)
+        args.n_cpu,
+        rank=rank,
+        world_size=world_size)
 
     # ################
     # Create optimizer
@@ -183,40 +332,94 @@ def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=Non
     recallVals = []
     mAPs = []
 
-    for epoch in range(args.epochs):
-
-        print("\n## Epoch {} of {} ##\n".format(epoch+1, args.epochs))
+    if append_file is not None:
+        stats_file = append_file
+    else:
+        stats_file = 'stats.txt'
 
-        for threshold, value in model.hyperparams['lr_steps']:
-            if epoch == threshold:
-                print(f'New learning rate: {model.hyperparams["learning_rate"] * value}\n')
+    start_epoch = 0
+    if checkpoint is not None:
+        # The learning rate follows from the epoch, the random number generators continue in every process
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        for p, grad in zip(params, checkpoint["gradients"]):
+            p.grad = None if grad is None else grad.to(p.device)
+        model.seen = checkpoint["seen"]
+        start_epoch = checkpoint["epoch"] + 1
+        trainingLosses, validationLosses, precisionVals, recallVals, mAPs = map(list, checkpoint["stats"])
+        if len(checkpoint["rng"]) == world_size:
+            set_rng_state(checkpoint["rng"][rank])
+        elif is_main:
+            print(f"The checkpoint was saved by {len(checkpoint['rng'])} processes, the random states are not resumed.")
+        if is_main:
+            print(f"Resuming from '{resume}' after epoch {start_epoch}")
+
+    # Every process times its iterations, rank 0 writes the timings
+    logger = Logger(args.logdir) if telemetry and is_main else None
+    timer = Telemetry(logger, os.path.join(logger.log_dir, "telemetry.jsonl") if logger else None,
+                      synchronize=device.type == "cuda")
+
+    # Rank 0 writes the checkpoints and, after each of them, the stats of its epochs in the background
+    saver = CheckpointSaver(keep_last, keep_best, checkpoint["checkpoints"] if checkpoint else ()) if is_main else None
+    stats_written = start_epoch
+    checkpoint = None
+
+    for epoch in range(start_epoch, args.epochs):
+
+        if is_main:
+            print("\n## Epoch {} of {} ##\n".format(epoch+1, args.epochs))
+
+            for threshold, value in model.hyperparams['lr_steps']:
+                if epoch == threshold:
+                    print(f'New learning rate: {model.hyperparams["learning_rate"] * value}\n')
+
+        if args.distributed:
+            dataloader.sampler.set_epoch(epoch)  # Reshuffles the shards
         
         model.train()  # Set model to training mode
 
-        for batch_i, (_, imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc=f"Training")):
+        timer.start()
+        for batch_i, (_, imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc=f"Training", disable=not is_main)):
+            timer.mark("data")
 
             batches_done = len(dataloader) * epoch + batch_i
-
-            imgs = imgs.to(device, non_blocking=True)
+            # Gradients are only synchronized on the batches the optimizer steps on
+            step = batches_done % accumulations == 0
+
+            if cached_backbone:
+                # The batches of a cached backbone hold its features instead of the images
+                imgs = {layer_i: features.to(device, non_blocking=True) for layer_i, features in imgs.items()}
+                n_images, img_size = len(imgs[cutoff - 1]), dataloader.dataset.img_size
+            else:
+                imgs = imgs.to(device, non_blocking=True)
+                n_images, img_size = imgs.shape[0], imgs.shape[-1]
             targets = targets.to(device)
             
-            outputs = model(imgs)
+            with contextlib.nullcontext() if step or not args.distributed else train_model.no_sync():
+                if cached_backbone:
+                    outputs = model.forward_features(imgs, (img_size, img_size))
+                else:
+                    outputs = train_model(imgs)
+                timer.mark("forward")
 
-            loss, loss_components = compute_loss(outputs, targets, model)
+                loss, loss_components = compute_loss(outputs, targets, model)
+                timer.mark("loss")
 
-            loss.backward()
+                # DDP averages the gradients of the processes, a single process sums those of the subdivisions
+                (loss * world_size).backward()
+                timer.mark("backward")
 
             ###############
             # Run optimizer
             ###############
 
-            if batches_done % model.hyperparams['subdivisions'] == 0:
+            if step:
                 # Adapt learning rate
                 # Get learning rate defined in cfg
                 lr = model.hyperparams['learning_rate']
-                if batches_done < model.hyperparams['burn_in']:
+                # The burn in counts the batches of all processes
+                if batches_done * world_size < model.hyperparams['burn_in']:
                     # Burn in
-                    lr *= (batches_done / model.hyperparams['burn_in'])
+                    lr *= (batches_done * world_size / model.hyperparams['burn_in'])
                 else:
                     # Set and parse the learning rate to the steps defined in the cfg
                     for threshold, value in model.hyperparams['lr_steps']:
@@ -231,11 +434,16 @@ def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=Non
                 optimizer.step()
                 # Reset gradients
                 optimizer.zero_grad()
+                timer.mark("optimizer")
+
+            # Multiscale training changes the input size every tenth batch
+            timer.log(batches_done, n_images, img_size, loss=float(loss_components[3]),
+                      lr=optimizer.param_groups[0]['lr'])
 
             # ############
             # Log progress
             # ############
-            if show_loss and batch_i % (len(dataloader)//4) == 0 and batch_i > 1:
+            if show_loss and is_main and batch_i % (len(dataloader)//4) == 0 and batch_i > 1:
                 print('\n'+AsciiTable(
                     [
                         ["Type", "Value"],
@@ -246,24 +454,19 @@ def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=Non
                         ["Batch loss", to_cpu(loss).item()],
                     ]).table)
 
-                model.seen += imgs.size(0)
+                model.seen += n_images
 
         # #############
         # Validation
         # #############
 
-        with torch.no_grad():
-            for batch_i, (_, imgs, targets) in enumerate(validation_dataloader):
-                batches_done = len(validation_dataloader) * epoch + batch_i
-
-                imgs = imgs.to(device, non_blocking=True)
-                targets = targets.to(device)
-
-                outputs = model(imgs)
+        if args.distributed:
+            # The batch norm statistics of rank 0 are validated on every shard and saved
+            for buffer in model.buffers():
+                dist.broadcast(buffer, 0)
 
-                val_loss, val_loss_components = compute_loss(outputs, targets, model)
-
-        metrics_output = _evaluate(
+        # One pass in evaluation mode gives the detections for the metrics and the loss over all images
+        metrics_output, val_loss_components = _evaluate_with_loss(
             model,
             validation_dataloader,
             class_names,
@@ -273,6 +476,16 @@ def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=Non
             nms_thres=args.nms_thres,
             verbose=args.verbose)
 
+        # The random states of all processes are saved, each of them continues its own sequence on resume
+        save = epoch % args.checkpoint_interval == 0 or epoch == args.epochs - 1
+        rng_states = [rng_state()]
+        if save and args.distributed:
+            rng_states = [None] * world_size if is_main else None
+            dist.gather_object(rng_state(), rng_states, dst=0)
+
+        if not is_main:
+            continue
+
         precision, recall, AP, f1, ap_class = metrics_output
         precisionVals.append(precision.mean())
         recallVals.append(recall.mean())
@@ -284,23 +497,62 @@ def run(model, epochs, config, seed=42, pretrained_weights=None, append_file=Non
         print("Validation loss:", float(val_loss_components[3]))
         validationLosses.append(float(val_loss_components[3]))
 
+        if logger is not None:
+            logger.list_of_scalars_summary([
+                ("validation/precision", precision.mean()),
+                ("validation/recall", recall.mean()),
+                ("validation/mAP", AP.mean()),
+                ("validation/loss", float(val_loss_components[3]))], epoch)
+
         # Save model to checkpoint file
-        if epoch % args.checkpoint_interval == 0:
+        if save:
             checkpoint_path = f"checkpoints/yolov3_ckpt_{epoch+1}.pth"
             print(f"\n---- Saving checkpoint to: '{checkpoint_path}' ----")
-            torch.save(model.state_dict(), checkpoint_path)
+            saver.save(checkpoint_path, {
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "gradients": [p.grad for p in params],  # Subdivisions accumulated over the end of the epoch
+                "seen": model.seen,
+                "epoch": epoch,
+                "rng": rng_states,
+                "stats": [[float(value) for value in values]
+                          for values in (trainingLosses, validationLosses, precisionVals, recallVals, mAPs)],
+            }, score=float(mAPs[-1]))
+
+            # The stats are written once the checkpoint holding them is, a resumed run never writes them twice
+            for i in range(stats_written, len(mAPs)):
+                saver.submit(_append_stats, stats_file, trainingLosses[i], validationLosses[i], precisionVals[i],
+                             recallVals[i], mAPs[i])
+            stats_written = len(mAPs)
+
+    if args.distributed:
+        dist.destroy_process_group()
+    if not is_main:
+        return
+
+    saver.close()
+    timer.close()
+    print("\nTraining finished. Statisics are saved in:", stats_file)
 
-    if append_file is not None:
-        stats_file = append_file
-    else:
-        stats_file = 'stats.txt'
-        
+def _append_stats(stats_file, *values):
     with open(stats_file, "a") as stats:
-        for i in range(epochs):
-            stats.write("{} {} {} {} {}\n".format(trainingLosses[i],
-                                               validationLosses[i],
-                                               precisionVals[i],
-                                               recallVals[i],
-                                               mAPs[i]))
-
-    print("\nTraining finished. Statisics are saved in:", stats_file)
+        stats.write("{} {} {} {} {}\n".format(*values))
+
+
+if __name__ == '__main__':
+    # Command line entry point for torchrun, e.g. torchrun --nproc_per_node 4 -m pytorchyolo.train
+    parser = argparse.ArgumentParser(description="Trains a model, in parallel processes when started with torchrun.")
+    parser.add_argument("-m", "--model", type=str, default="models/CDA.cfg", help="Path to model definition file (.cfg)")
+    parser.add_argument("-d", "--data", type=str, default="config/CDA.data", help="Path to data config file (.data)")
+    parser.add_argument("-e", "--epochs", type=int, default=50, help="Number of epochs")
+    parser.add_argument("-w", "--pretrained_weights", type=str, default=None, help="Path to weights or checkpoint file (.weights or .pth)")
+    parser.add_argument("--seed", type=int, default=42, help="Seed, -1 for no determinism")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"], help="Run the model in float32 or under bfloat16 autocast")
+    parser.add_argument("--cached_backbone", type=str, nargs="?", const=True, default=None, help="Freeze the backbone and train on its features, cached in the given directory or feature_cache/")
+    parser.add_argument("--cache_variants", type=int, default=2, help="Number of flipped variants of each image in the feature cache")
+    parser.add_argument("--partial_weights", action="store_true", help="Skip pretrained weights of another shape, with --cached_backbone")
+    cli_args = parser.parse_args()
+    run(cli_args.model, cli_args.epochs, cli_args.data, seed=cli_args.seed, pretrained_weights=cli_args.pretrained_weights,
+        precision=cli_args.precision, distributed=int(os.environ.get("WORLD_SIZE", 1)) > 1,
+        cached_backbone=cli_args.cached_backbone, cache_variants=cli_args.cache_variants,
+        partial_weights=cli_args.partial_weights)
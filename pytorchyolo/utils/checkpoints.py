@@ -0,0 +1,140 @@
+import os
+import re
+import glob
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import imgaug.random
+import numpy as np
+import torch
+
+
+def rng_state():
+    """Returns the states of the python, numpy, imgaug and torch random number generators.
+    The numpy arrays are stored as tensors, so that checkpoints load with torch.load(weights_only=True)."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "python": random.getstate(),
+        "numpy": (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        "imgaug": _map_arrays(imgaug.random.get_global_rng().state,
+                              lambda array: torch.from_numpy(array.view(np.int64))),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    """Restores the random number generators from a state of `rng_state`"""
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    if "imgaug" in state:  # Checkpoints saved before the imgaug state was stored
+        imgaug.random.get_global_rng().state = _map_arrays(state["imgaug"],
+                                                           lambda tensor: tensor.numpy().view(np.uint64))
+    torch.set_rng_state(state["torch"].clone())
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.clone() for s in state["cuda"]])
+
+
+def _map_arrays(state, fn):
+    """Applies 'fn' to the uint64 arrays or int64 tensors of a nested bit generator state of numpy"""
+    if isinstance(state, dict):
+        return {key: _map_arrays(value, fn) for key, value in state.items()}
+    if isinstance(state, np.ndarray) or torch.is_tensor(state):
+        return fn(state)
+    return state
+
+
+def load_checkpoint(path):
+    """Loads a checkpoint written by `CheckpointSaver` to the CPU"""
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def latest_checkpoint(directory="checkpoints"):
+    """Returns the path of the checkpoint of the latest epoch in 'directory', None if there is none"""
+    paths = glob.glob(os.path.join(directory, "yolov3_ckpt_*.pth"))
+    epochs = [int(re.search(r"yolov3_ckpt_(\d+)\.pth$", path).group(1)) for path in paths]
+    return paths[int(np.argmax(epochs))] if paths else None
+
+
+def _cpu_copy(obj):
+    """Copies the tensors in nested dicts, lists and tuples to the CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _cpu_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(value) for value in obj)
+    return obj
+
+
+class CheckpointSaver(object):
+    """
+    Writes training checkpoints in a background thread while the training continues.
+    The state is copied to the CPU first, so the training may update the model and optimizer right away.
+    Files are written under a temporary name and renamed, an interrupted save never leaves a truncated checkpoint.
+    Of the saved checkpoints, the 'keep_last' latest ones and the 'keep_best' ones with the highest score are kept.
+    """
+
+    def __init__(self, keep_last=None, keep_best=0, saved=()):
+        """
+        :param keep_last: Number of latest checkpoints to keep, all if None, defaults to None
+        :type keep_last: int, optional
+        :param keep_best: Number of checkpoints with the highest score to keep in addition, defaults to 0
+        :type keep_best: int, optional
+        :param saved: (path, score) of the checkpoints saved before, e.g. by the run that is resumed, defaults to ()
+        :type saved: [(str, float)], optional
+        """
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.saved = [tuple(checkpoint) for checkpoint in saved]
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def save(self, path, state, score=None):
+        """
+        Saves 'state' to 'path' in the background. Waits for the previous checkpoint first, so that at most one
+        copy of the state is held in memory. The saved checkpoints are stored under "checkpoints" for resuming.
+
+        :param path: Path of the checkpoint file
+        :type path: str
+        :param state: Nested dicts, lists and tuples of tensors and python values
+        :type state: dict
+        :param score: Score of the checkpoint for the 'keep_best' retention, higher is better, defaults to None
+        :type score: float, optional
+        """
+        self.wait()
+        state = dict(state, checkpoints=self.saved + [(path, score)])
+        self.submit(self._write, path, _cpu_copy(state), score)
+
+    def submit(self, fn, *args):
+        """Runs 'fn' in the background thread once the checkpoints saved before are written"""
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def wait(self):
+        """Blocks until all saves are done and raises their errors"""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(self, path, state, score):
+        temporary_path = path + ".tmp"
+        torch.save(state, temporary_path)
+        os.replace(temporary_path, path)
+        self.saved = [checkpoint for checkpoint in self.saved if checkpoint[0] != path] + [(path, score)]
+        self._remove_old()
+
+    def _remove_old(self):
+        if self.keep_last is None:
+            return
+        keep = {path for path, _ in self.saved[-self.keep_last:]} if self.keep_last > 0 else set()
+        scored = [checkpoint for checkpoint in self.saved if checkpoint[1] is not None]
+        keep |= {path for path, _ in sorted(scored, key=lambda checkpoint: -checkpoint[1])[:self.keep_best]}
+        for path, _ in self.saved:
+            if path not in keep and os.path.exists(path):
+                os.remove(path)
+        self.saved = [checkpoint for checkpoint in self.saved if checkpoint[0] in keep]
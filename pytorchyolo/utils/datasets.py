@@ -30,6 +30,16 @@ def resize(image, size):
     return image
 
 
+def label_path(image_path):
+    """Returns the path of the label file of an image, the same name in the 'labels' folder next to 'images'"""
+    image_dir = os.path.dirname(image_path)
+    label_dir = "labels".join(image_dir.rsplit("images", 1))
+    assert label_dir != image_dir, \
+        f"Image path must contain a folder named 'images'! \n'{image_dir}'"
+    label_file = os.path.join(label_dir, os.path.basename(image_path))
+    return os.path.splitext(label_file)[0] + '.txt'
+
+
 class ImageFolder(Dataset):
     def __init__(self, folder_path, transform=None):
         self.files = sorted(glob.glob("%s/*.*" % folder_path))
@@ -60,15 +70,7 @@ class ListDataset(Dataset):
         with open(list_path, "r") as file:
             self.img_files = file.readlines()
 
-        self.label_files = []
-        for path in self.img_files:
-            image_dir = os.path.dirname(path)
-            label_dir = "labels".join(image_dir.rsplit("images", 1))
-            assert label_dir != image_dir, \
-                f"Image path must contain a folder named 'images'! \n'{image_dir}'"
-            label_file = os.path.join(label_dir, os.path.basename(path))
-            label_file = os.path.splitext(label_file)[0] + '.txt'
-            self.label_files.append(label_file)
+        self.label_files = [label_path(path.rstrip()) for path in self.img_files]
 
         self.img_size = img_size
         self.max_objects = 100
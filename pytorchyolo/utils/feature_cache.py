@@ -0,0 +1,230 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+import tqdm
+from torch.utils.data import Dataset
+
+from pytorchyolo.utils.prediction_store import model_fingerprint, dataset_fingerprint
+from pytorchyolo.utils.tta import dihedral_transforms
+from pytorchyolo.utils.datasets import label_path
+
+CACHE_VERSION = 1
+
+
+def transform_images(imgs, transform):
+    """Applies a (flip_x, flip_y, transpose) transform of `tta.dihedral_transforms` to images (B, C, H, W)"""
+    flip_x, flip_y, transpose = transform
+    imgs = imgs.transpose(2, 3) if transpose else imgs
+    dims = [dim for dim, flip in ((3, flip_x), (2, flip_y)) if flip]
+    return imgs.flip(dims) if dims else imgs
+
+
+def transform_targets(targets, transform):
+    """Applies the transform of `transform_images` to targets (sample, class, x, y, w, h) relative to the image size"""
+    flip_x, flip_y, transpose = transform
+    targets = targets[:, [0, 1, 3, 2, 5, 4]] if transpose else targets.clone()
+    if flip_x:
+        targets[:, 2] = 1 - targets[:, 2]
+    if flip_y:
+        targets[:, 3] = 1 - targets[:, 3]
+    return targets
+
+
+def labels_fingerprint(image_paths):
+    """Returns a hash of the paths, sizes and modification times of the label files of the images, in order.
+    Missing label files are hashed as such, so adding one changes the hash as well."""
+    digest = hashlib.sha1()
+    for path in image_paths:
+        path = os.path.abspath(label_path(path))
+        stat = os.stat(path) if os.path.exists(path) else None
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode() if stat else f"{path}:missing\n".encode())
+    return digest.hexdigest()
+
+
+class FeatureCacheWriter:
+    """Writes the backbone features of a model, as returned by `models.Darknet.backbone_features`, to a
+    `FeatureCache` directory. The features are stored in float16, one file per layer."""
+
+    def __init__(self, path, model, cutoff, img_size, transforms):
+        """
+        :param path: Directory of the cache, created if missing
+        :type path: str
+        :param model: Model whose backbone computes the features, only used for its fingerprint
+        :type model: models.Darknet
+        :param cutoff: Number of layers of the backbone
+        :type cutoff: int
+        :param img_size: Size of each image dimension the backbone runs on
+        :type img_size: int
+        :param transforms: The (flip_x, flip_y, transpose) transforms of the variants of each image
+        :type transforms: [(bool, bool, bool)]
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {
+            "version": CACHE_VERSION,
+            "img_size": img_size,
+            "cutoff": cutoff,
+            "transforms": [list(transform) for transform in transforms],
+            "model_fingerprint": model_fingerprint(model, cutoff),
+        }
+        self.files, self.shapes = {}, {}
+        self.image_paths, self.variants, self.targets = [], [], []
+
+    def append(self, image_paths, variant, features, targets):
+        """
+        Stores the features of one batch of images in one variant.
+
+        :param image_paths: Paths of the images of the batch
+        :type image_paths: [str]
+        :param variant: Index of the transform of the batch
+        :type variant: int
+        :param features: Backbone features (B, C, H, W) by layer index
+        :type features: {int: torch.Tensor}
+        :param targets: Transformed targets of the batch as rows of (sample, class, x, y, w, h)
+        :type targets: torch.Tensor
+        """
+        for layer_i, value in features.items():
+            if layer_i not in self.files:
+                self.files[layer_i] = open(os.path.join(self.path, f"layer_{layer_i}.bin"), "wb")
+                self.shapes[layer_i] = list(value.shape[1:])
+            self.files[layer_i].write(value.detach().cpu().to(torch.float16).numpy().tobytes())
+
+        targets = targets.detach().cpu().float().clone()
+        targets[:, 0] += len(self.image_paths)  # Index of the sample in the cache
+        self.targets.append(targets.numpy())
+        self.image_paths += list(image_paths)
+        self.variants += [variant] * len(image_paths)
+
+    def close(self):
+        """Finishes the cache, the metadata is written last."""
+        for file in self.files.values():
+            file.close()
+        targets = np.concatenate(self.targets, 0) if self.targets else np.zeros((0, 6), dtype=np.float32)
+        np.save(os.path.join(self.path, "targets.npy"), targets)
+        unique_paths = list(dict.fromkeys(self.image_paths))
+        self.meta.update({
+            "layers": {str(layer_i): shape for layer_i, shape in self.shapes.items()},
+            "image_paths": self.image_paths,
+            "variants": self.variants,
+            "dataset_fingerprint": dataset_fingerprint(unique_paths),
+            "labels_fingerprint": labels_fingerprint(unique_paths),
+        })
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        print(f"Cached the backbone features of {len(unique_paths)} images in {len(self.meta['transforms'])} "
+              f"variants in: {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FeatureCache(Dataset):
+    """Dataset of the backbone features and targets stored by `FeatureCacheWriter`, one sample per image variant.
+    The features are memory-mapped, so a training epoch reads them from disk instead of holding them in memory."""
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the cache
+        :type path: str
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != CACHE_VERSION:
+            raise ValueError(f"Feature cache version {self.meta['version']} is not supported.")
+        self.path = path
+        self.img_size = self.meta["img_size"]
+        self.cutoff = self.meta["cutoff"]
+        self.layers = {int(layer_i): tuple(shape) for layer_i, shape in self.meta["layers"].items()}
+        targets = np.load(os.path.join(path, "targets.npy"))
+        self._targets = torch.from_numpy(targets[np.argsort(targets[:, 0], kind="stable")])
+        # Rows of the targets of each sample
+        self._target_index = np.searchsorted(targets[:, 0], np.arange(len(self) + 1)) if len(targets) else \
+            np.zeros(len(self) + 1, dtype=np.int64)
+        self._features = None
+
+    def __len__(self):
+        return len(self.meta["image_paths"])
+
+    def __getstate__(self):
+        # Data loader workers map the files again instead of receiving copies of them
+        return dict(self.__dict__, _features=None)
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = {
+                layer_i: np.memmap(os.path.join(self.path, f"layer_{layer_i}.bin"), dtype=np.float16, mode="r",
+                                   shape=(len(self),) + shape)
+                for layer_i, shape in self.layers.items()}
+        return self._features
+
+    def is_current(self, model=None, image_paths=None, img_size=None, n_variants=None):
+        """Returns False if the backbone of 'model', the images, their labels, their size or the variants differ
+        from the ones the cache was written for."""
+        if model is not None and model_fingerprint(model, self.cutoff) != self.meta["model_fingerprint"]:
+            return False
+        if image_paths is not None and dataset_fingerprint(image_paths) != self.meta["dataset_fingerprint"]:
+            return False
+        # Caches written before the labels were fingerprinted have none and are rewritten
+        if image_paths is not None and labels_fingerprint(image_paths) != self.meta.get("labels_fingerprint"):
+            return False
+        if img_size is not None and img_size != self.img_size:
+            return False
+        if n_variants is not None and n_variants != len(self.meta["transforms"]):
+            return False
+        return True
+
+    def __getitem__(self, index):
+        features = {layer_i: torch.from_numpy(np.array(values[index])).float()
+                    for layer_i, values in self.features.items()}
+        start, end = self._target_index[index:index + 2]
+        return index, features, self._targets[start:end].clone()
+
+    def collate_fn(self, batch):
+        indices, features, targets = list(zip(*batch))
+        features = {layer_i: torch.stack([sample[layer_i] for sample in features]) for layer_i in self.layers}
+        # Add sample index to targets
+        for i, boxes in enumerate(targets):
+            boxes[:, 0] = i
+        return indices, features, torch.cat(targets, 0)
+
+
+def write_feature_cache(path, model, dataloader, cutoff, n_variants=2):
+    """
+    Runs the backbone of 'model' once over every image of 'dataloader' in 'n_variants' flips and stores the
+    features that the layers after it read. The variants are the first ones of `tta.dihedral_transforms`: the
+    image, its horizontal flip, its vertical flip, both flips and, on square images, the transposes of these.
+
+    :param path: Directory of the cache
+    :type path: str
+    :param model: Model whose backbone computes the features
+    :type model: models.Darknet
+    :param dataloader: Loader of the images and targets in a fixed size, without random augmentations
+    :type dataloader: DataLoader
+    :param cutoff: Number of layers of the backbone, see `models.Darknet.backbone_cutoff`
+    :type cutoff: int
+    :param n_variants: Number of flipped variants of each image, defaults to 2
+    :type n_variants: int, optional
+    :return: Returns the cache
+    :rtype: FeatureCache
+    """
+    img_size = dataloader.dataset.img_size
+    transforms = dihedral_transforms(img_size, img_size)
+    if not 1 <= n_variants <= len(transforms):
+        raise ValueError(f"The number of variants must be between 1 and {len(transforms)}.")
+    transforms = transforms[:n_variants]
+    device = next(model.parameters()).device
+    model.eval()
+    with FeatureCacheWriter(path, model, cutoff, img_size, transforms) as writer, torch.no_grad():
+        for image_paths, imgs, targets in tqdm.tqdm(dataloader, desc="Caching backbone features"):
+            imgs = imgs.to(device)
+            for variant, transform in enumerate(transforms):
+                features = model.backbone_features(transform_images(imgs, transform), cutoff)
+                writer.append(image_paths, variant, features, transform_targets(targets, transform))
+    return FeatureCache(path)
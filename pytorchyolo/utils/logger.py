@@ -1,7 +1,16 @@
 import os
+import sys
+import json
+import time
 import datetime
+import torch
 from torch.utils.tensorboard import SummaryWriter
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 
 class Logger(object):
     def __init__(self, log_dir, log_hist=True):
@@ -11,6 +20,7 @@ class Logger(object):
             log_dir = os.path.join(
                 log_dir,
                 datetime.datetime.now().strftime("%Y_%m_%d__%H_%M_%S"))
+        self.log_dir = log_dir
         self.writer = SummaryWriter(log_dir)
         print("Logger init Done")
 
@@ -22,3 +32,73 @@ class Logger(object):
         """Log scalar variables."""
         for tag, value in tag_value_pairs:
             self.writer.add_scalar(tag, value, step)
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB, None where the resource module is missing"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class Telemetry(object):
+    """
+    Times the phases of every training iteration and writes them, with the throughput, the peak memory and the input
+    size, to a `Logger` under "telemetry/" and as one JSON object per line to 'jsonl_path'.
+    `mark` ends a phase, the time since the previous mark is the data loading wait of the iteration.
+    """
+
+    def __init__(self, logger=None, jsonl_path=None, synchronize=False):
+        """
+        :param logger: Logger of the scalars, defaults to None
+        :type logger: Logger, optional
+        :param jsonl_path: Path of the JSON lines file, defaults to None
+        :type jsonl_path: str, optional
+        :param synchronize: If True, waits for the CUDA kernels at every mark, so that the phases time them,
+            defaults to False
+        :type synchronize: bool, optional
+        """
+        self.logger = logger
+        self.file = open(jsonl_path, "a", buffering=1) if jsonl_path else None  # Line buffered, for tail -f
+        self.synchronize = synchronize
+        self.start()
+
+    def start(self):
+        """Restarts the timing, e.g. before the first batch of an epoch"""
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        """Adds the time since the previous mark to 'phase'"""
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def log(self, step, n_images, img_size, **values):
+        """Writes the phases since the last call, the timing restarts afterwards so writing is not counted"""
+        total = sum(self.times.values())
+        record = {
+            "step": step,
+            **{f"{phase}_s": seconds for phase, seconds in self.times.items()},
+            "images_per_s": n_images / total if total > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "img_size": img_size,
+            **values,
+        }
+        if self.logger is not None:
+            self.logger.list_of_scalars_summary(
+                [(f"telemetry/{key}", value) for key, value in record.items() if key != "step" and value is not None],
+                step)
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+        self.start()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.logger is not None:
+            self.logger.writer.flush()
@@ -3,13 +3,14 @@ import math
 import torch
 import torch.nn as nn
 
-from .utils import to_cpu
+from .utils import to_cpu, _circle_intersection
 
 # This new loss function is based on https://github.com/ultralytics/yolov3/blob/master/utils/loss.py
 
 
-def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False, eps=1e-9):
+def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False, Circle=False, eps=1e-9):
     # Returns the IoU of box1 to box2. box1 is 4, box2 is nx4
+    # With Circle, the IoU of the circles inscribed in the boxes (diameter is the mean side), for round objects
     box2 = box2.T
 
     # Get the coordinates of bounding boxes
@@ -22,6 +23,23 @@ def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False, eps=
         b2_x1, b2_x2 = box2[0] - box2[2] / 2, box2[0] + box2[2] / 2
         b2_y1, b2_y2 = box2[1] - box2[3] / 2, box2[1] + box2[3] / 2
 
+    if Circle:
+        r1 = (b1_x2 - b1_x1 + b1_y2 - b1_y1) / 4
+        r2 = (b2_x2 - b2_x1 + b2_y2 - b2_y1) / 4
+        rho2 = ((b2_x1 + b2_x2 - b1_x1 - b1_x2) ** 2 +
+                (b2_y1 + b2_y2 - b1_y1 - b1_y2) ** 2) / 4  # center distance squared
+        inter = _circle_intersection(r1, r2, torch.sqrt(rho2 + eps))
+        union = math.pi * (r1 ** 2 + r2 ** 2) - inter + eps
+        iou = inter / union
+        if GIoU or DIoU or CIoU:
+            # smallest enclosing circle diameter
+            c = torch.max(torch.sqrt(rho2 + eps) + r1 + r2, 2 * torch.max(r1, r2))
+            if CIoU or DIoU:  # circles have no aspect ratio, CIoU is DIoU
+                return iou - rho2 / (c ** 2 + eps)
+            c_area = math.pi * c ** 2 / 4 + eps  # enclosing circle area
+            return iou - (c_area - union) / c_area  # GIoU
+        return iou
+
     # Intersection area
     inter = (torch.min(b1_x2, b2_x2) - torch.max(b1_x1, b2_x1)).clamp(0) * \
             (torch.min(b1_y2, b2_y2) - torch.max(b1_y1, b2_y1)).clamp(0)
@@ -134,6 +152,12 @@ class QFocalLoss(nn.Module):
 
 
 def compute_loss(predictions, targets, model):  # predictions, targets, model
+    # The box regression, the exponentials and the BCE sums stay in float32 when the model runs in bfloat16
+    with torch.autocast(targets.device.type, enabled=False):
+        return _compute_loss([p.float() for p in predictions], targets.float(), model)
+
+
+def _compute_loss(predictions, targets, model):
     device = targets.device
     lcls, lbox, lobj = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
     tcls, tbox, indices, anchors = build_targets(predictions, targets, model)  # targets
@@ -232,7 +256,7 @@ def build_targets(p, targets, model):
         # Append
         a = t[:, 6].long()  # anchor indices
         # image, anchor, grid indices
-        indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))
+        indices.append((b, a, gj.clamp_(0, gain[3].long() - 1), gi.clamp_(0, gain[2].long() - 1)))
         tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
         anch.append(anchors[a])  # anchors
         tcls.append(c)  # class
@@ -0,0 +1,238 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+
+from pytorchyolo.utils.utils import non_max_suppression
+
+STORE_VERSION = 1
+
+
+def model_fingerprint(model, cutoff=None):
+    """
+    Returns a hash of the architecture and the weights of 'model', None for models without a state dict like
+    the onnxruntime backend. With a 'cutoff', only the first 'cutoff' layers of a Darknet model are hashed.
+    """
+    if not hasattr(model, "state_dict"):
+        return None
+    module_defs = getattr(model, "module_defs", None)
+    digest = hashlib.sha1(repr(module_defs if cutoff is None else module_defs[:cutoff]).encode())
+    # Float32 models keep the fingerprints of stores written before models had a precision
+    if getattr(model, "precision", "fp32") != "fp32":
+        digest.update(model.precision.encode())
+    for name, value in model.state_dict().items():
+        if cutoff is not None and (not name.startswith("module_list.") or int(name.split(".")[1]) >= cutoff):
+            continue
+        digest.update(name.encode())
+        if torch.is_tensor(value):
+            value = value.detach().cpu()
+            value = value.int_repr() if value.is_quantized else value
+            digest.update(value.contiguous().numpy().tobytes())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+def dataset_fingerprint(image_paths):
+    """Returns a hash of the paths, sizes and modification times of the images, in order."""
+    digest = hashlib.sha1()
+    for path in image_paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class PredictionStoreWriter:
+    """Writes the raw outputs of a model, before non-maximum suppression, to a `PredictionStore` directory.
+    Rows with an objectness of at most 'min_obj' are dropped, the store answers queries at higher thresholds."""
+
+    def __init__(self, path, model, img_size, min_obj=0.001):
+        """
+        :param path: Directory of the store, created if missing
+        :type path: str
+        :param model: Model whose outputs are stored, only used for its fingerprint
+        :type model: models.Darknet
+        :param img_size: Size of each image dimension the model inferences
+        :type img_size: int
+        :param min_obj: Objectness threshold of the stored rows, defaults to 0.001
+        :type min_obj: float, optional
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {
+            "version": STORE_VERSION,
+            "img_size": img_size,
+            "min_obj": min_obj,
+            "model_fingerprint": model_fingerprint(model),
+        }
+        self.image_paths, self.counts, self.targets = [], [], []
+        self.columns = None
+        self.file = open(os.path.join(path, "predictions.bin"), "wb")
+
+    def append(self, image_paths, outputs, targets=None):
+        """
+        Stores the outputs of one batch.
+
+        :param image_paths: Paths of the images of the batch
+        :type image_paths: [str]
+        :param outputs: Model outputs (B, A, 5 + classes) in pixels of the network input
+        :type outputs: torch.Tensor
+        :param targets: Targets of the batch as rows of (sample, class, x1, y1, x2, y2) in pixels, defaults to None
+        :type targets: torch.Tensor, optional
+        """
+        outputs = outputs.detach().cpu().float()
+        self.columns = outputs.shape[2]
+        keep = outputs[..., 4] > self.meta["min_obj"]
+        self.file.write(outputs[keep].numpy().tobytes())
+        self.counts += keep.sum(1).tolist()
+
+        if targets is not None:
+            targets = targets.detach().cpu().float().clone()
+            targets[:, 0] += len(self.image_paths)  # Index of the image in the store
+            self.targets.append(targets.numpy())
+        self.image_paths += list(image_paths)
+
+    def close(self):
+        """Finishes the store, the index and the metadata are written last."""
+        self.file.close()
+        counts = np.array(self.counts, dtype=np.int64)
+        np.save(os.path.join(self.path, "index.npy"), np.stack((np.cumsum(counts) - counts, counts), 1))
+        if self.targets:
+            np.save(os.path.join(self.path, "targets.npy"), np.concatenate(self.targets, 0))
+        self.meta.update({
+            "columns": self.columns,
+            "rows": int(counts.sum()),
+            "image_paths": self.image_paths,
+            "dataset_fingerprint": dataset_fingerprint(self.image_paths),
+        })
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        print(f"Stored {counts.sum()} predictions of {len(counts)} images in: {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PredictionStore:
+    """Read-only view of the raw model outputs stored by `PredictionStoreWriter`.
+    The rows are memory-mapped, so queries only read the images they touch. Non-maximum suppression and matching
+    can be re-run on them with other settings without inferencing the images again."""
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the store
+        :type path: str
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError(f"Prediction store version {self.meta['version']} is not supported.")
+        self.path = path
+        self.image_paths = self.meta["image_paths"]
+        self.img_size = self.meta["img_size"]
+        self.min_obj = self.meta["min_obj"]
+        self.index = np.load(os.path.join(path, "index.npy"))
+        shape = (self.meta["rows"], self.meta["columns"] or 0)
+        self.rows = np.memmap(os.path.join(path, "predictions.bin"), dtype=np.float32, mode="r", shape=shape) \
+            if shape[0] else np.zeros(shape, dtype=np.float32)
+        targets_path = os.path.join(path, "targets.npy")
+        self._targets = torch.from_numpy(np.load(targets_path)) if os.path.exists(targets_path) else None
+        self._path_index = {image_path: i for i, image_path in enumerate(self.image_paths)}
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def is_current(self, model=None, image_paths=None):
+        """Returns False if 'model' or the images differ from the ones the store was written for."""
+        if model is not None and model_fingerprint(model) != self.meta["model_fingerprint"]:
+            return False
+        if image_paths is not None and dataset_fingerprint(image_paths) != self.meta["dataset_fingerprint"]:
+            return False
+        return True
+
+    def _image_indices(self, images):
+        if images is None:
+            return np.arange(len(self))
+        images = [images] if isinstance(images, (int, str)) else images
+        return np.array([self._path_index[image] if isinstance(image, str) else image for image in images],
+                        dtype=np.int64)
+
+    def predictions(self, image):
+        """Returns the stored rows (x, y, w, h, obj, class confidences...) of one image by index or path."""
+        start, count = self.index[self._image_indices(image)[0]]
+        return torch.from_numpy(np.array(self.rows[start:start + count]))
+
+    def query(self, images=None, conf_thres=None, region=None):
+        """
+        Returns the stored rows of the given images above an objectness threshold whose box centre lies in a region.
+
+        :param images: Image indices or paths, defaults to all images
+        :type images: [int or str], optional
+        :param conf_thres: Objectness threshold, not below the one the store was written with, defaults to None
+        :type conf_thres: float, optional
+        :param region: Region (x1, y1, x2, y2) in pixels of the network input, defaults to None
+        :type region: (float, float, float, float), optional
+        :return: Returns the image index of each row and the rows (x, y, w, h, obj, class confidences...)
+        :rtype: torch.Tensor, torch.Tensor
+        """
+        if conf_thres is not None and conf_thres < self.min_obj:
+            raise ValueError(f"The store only holds predictions with an objectness above {self.min_obj}.")
+        image_indices = self._image_indices(images)
+        image_i = torch.from_numpy(np.repeat(image_indices, self.index[image_indices, 1]))
+        rows = torch.from_numpy(np.concatenate(
+            [self.rows[start:start + count] for start, count in self.index[image_indices]] or
+            [np.zeros((0, self.rows.shape[1]), dtype=np.float32)], 0))
+
+        keep = torch.ones(len(rows), dtype=torch.bool)
+        if conf_thres is not None:
+            keep &= rows[:, 4] > conf_thres
+        if region is not None:
+            x1, y1, x2, y2 = region
+            keep &= (rows[:, 0] >= x1) & (rows[:, 0] < x2) & (rows[:, 1] >= y1) & (rows[:, 1] < y2)
+        return image_i[keep], rows[keep]
+
+    def targets(self, images=None):
+        """Returns the stored targets as rows of (image, class, x1, y1, x2, y2), None if none were stored."""
+        if self._targets is None or images is None:
+            return self._targets
+        image_indices = torch.from_numpy(self._image_indices(images))
+        return self._targets[torch.isin(self._targets[:, 0].long(), image_indices)]
+
+    def detections(self, conf_thres, nms_thres, method="greedy", geometry="box", images=None, batch_size=64):
+        """
+        Runs `utils.non_max_suppression` on the stored rows, the result equals the one on the model outputs.
+
+        :param conf_thres: Object confidence threshold
+        :type conf_thres: float
+        :param nms_thres: IOU threshold for non-maximum suppression
+        :type nms_thres: float
+        :param method: Suppression method of `utils.non_max_suppression`, defaults to "greedy"
+        :type method: str, optional
+        :param geometry: Overlap of the suppression, "box" or "circle", defaults to "box"
+        :type geometry: str, optional
+        :param images: Image indices or paths, defaults to all images
+        :type images: [int or str], optional
+        :param batch_size: Number of images suppressed at once, defaults to 64
+        :type batch_size: int, optional
+        :return: Detections of each image with shape nx6 (x1, y1, x2, y2, conf, cls)
+        :rtype: [torch.Tensor]
+        """
+        if conf_thres < self.min_obj:
+            raise ValueError(f"The store only holds predictions with an objectness above {self.min_obj}.")
+        image_indices = self._image_indices(images)
+        detections = []
+        for batch_start in range(0, len(image_indices), batch_size):
+            batch = image_indices[batch_start:batch_start + batch_size]
+            _, rows = self.query(batch)
+            # Pad the images to the same number of rows, zero objectness rows are never candidates
+            counts = torch.from_numpy(self.index[batch, 1])
+            position = torch.arange(len(rows)) - (torch.cumsum(counts, 0) - counts).repeat_interleave(counts)
+            prediction = torch.zeros((len(batch), int(counts.max()) if len(batch) else 0, rows.shape[1]))
+            prediction[torch.arange(len(batch)).repeat_interleave(counts), position] = rows
+            detections += non_max_suppression(prediction, conf_thres, nms_thres, method=method, geometry=geometry)
+        return detections
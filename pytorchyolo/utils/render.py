@@ -0,0 +1,31 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Colors of matplotlib's tab20b colormap, ordered so that neighbouring classes get different hues
+BOX_COLORS = [
+    (57, 59, 121), (99, 121, 57), (140, 109, 49), (132, 60, 57), (123, 65, 115),
+    (82, 84, 163), (140, 162, 82), (189, 158, 57), (173, 73, 74), (165, 81, 148),
+    (107, 110, 207), (181, 207, 107), (231, 186, 82), (214, 97, 107), (206, 109, 189),
+    (156, 158, 222), (206, 219, 156), (231, 203, 148), (231, 150, 156), (222, 158, 214),
+]
+
+
+def draw_detections(img, detections, classes, line_width=2):
+    """
+    Draws the boxes and class labels of 'detections' onto a copy of 'img' at its native resolution.
+    'detections' are given in image coordinates as rows of (x1, y1, x2, y2, conf, cls).
+    """
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    img = img.convert("RGB")
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default()
+
+    for x1, y1, x2, y2, _, cls_pred in np.asarray(detections).tolist():
+        color = BOX_COLORS[int(cls_pred) % len(BOX_COLORS)]
+        draw.rectangle([x1, y1, x2, y2], outline=color, width=line_width)
+        # Label on a filled background at the top left corner of the box
+        label = classes[int(cls_pred)]
+        draw.rectangle(draw.textbbox((x1, y1), label, font=font), fill=color)
+        draw.text((x1, y1), label, fill="white", font=font)
+    return img
@@ -0,0 +1,113 @@
+import torch
+import torchvision
+
+from pytorchyolo.utils.utils import non_max_suppression
+
+
+def dihedral_transforms(height, width):
+    """
+    Returns the dihedral transforms of an image as (flip_x, flip_y, transpose) tuples, the identity first.
+    The transposed variants need square images, rectangular ones only get the horizontal, vertical and both flips.
+    """
+    flips = [(False, False), (True, False), (False, True), (True, True)]
+    transposes = [False, True] if height == width else [False]
+    return [(flip_x, flip_y, transpose) for transpose in transposes for flip_x, flip_y in flips]
+
+
+def dihedral_batch(imgs):
+    """
+    Stacks all dihedral variants of a batch of images (B, C, H, W) into one batch for a single forward pass.
+    The variants are ordered transform by transform, image i of transform k is at index k * B + i.
+    """
+    transforms = dihedral_transforms(*imgs.shape[2:4])
+    variants = []
+    for flip_x, flip_y, transpose in transforms:
+        variant = imgs.transpose(2, 3) if transpose else imgs
+        dims = [dim for dim, flip in ((3, flip_x), (2, flip_y)) if flip]
+        variants.append(variant.flip(dims) if dims else variant)
+    return torch.cat(variants, 0), transforms
+
+
+def invert_dihedral(boxes, transforms, height, width):
+    """
+    Maps (x1, y1, x2, y2) boxes detected on dihedral variants back to the original image.
+    'transforms' holds the (flip_x, flip_y, transpose) transform of each box, as a (n, 3) bool tensor.
+    Transposes only occur on square images, so flips use the same width and height before and after them.
+    """
+    flip_x, flip_y, transpose = transforms.T
+    # Flipping an axis mirrors the coordinates and swaps the min and max corner
+    xs = torch.where(flip_x[:, None], width - boxes[:, [2, 0]], boxes[:, [0, 2]])
+    ys = torch.where(flip_y[:, None], height - boxes[:, [3, 1]], boxes[:, [1, 3]])
+    boxes = torch.stack((xs[:, 0], ys[:, 0], xs[:, 1], ys[:, 1]), 1)
+    return torch.where(transpose[:, None], boxes[:, [1, 0, 3, 2]], boxes)
+
+
+def weighted_box_fusion(detections, n_variants, iou_thres=0.5, max_det=300):
+    """
+    Fuses the detections of all variants of one image into one box per object (https://arxiv.org/abs/1910.13302).
+    The boxes kept by a non-maximum suppression are the cluster seeds, every other box joins the overlapping seed
+    of its class with the highest IoU. A fused box is the confidence weighted mean of its cluster and its
+    confidence the summed confidence over max(cluster size, n_variants), so boxes that only some variants detect
+    are down-weighted instead of suppressed.
+
+    :param detections: Detections of all variants with shape nx6 (x1, y1, x2, y2, conf, cls)
+    :type detections: torch.Tensor
+    :param n_variants: Number of variants the detections come from
+    :type n_variants: int
+    :param iou_thres: IOU threshold for boxes of the same cluster, defaults to 0.5
+    :type iou_thres: float, optional
+    :param max_det: Maximum number of fused detections, defaults to 300
+    :type max_det: int, optional
+    :return: Fused detections with shape nx6 (x1, y1, x2, y2, conf, cls)
+    :rtype: torch.Tensor
+    """
+    if not len(detections):
+        return detections
+    boxes, scores, labels = detections[:, :4], detections[:, 4], detections[:, 5]
+    seeds = torchvision.ops.batched_nms(boxes, scores, labels, iou_thres)
+
+    # Assign every box to the seed of its class it overlaps most, each suppressed box overlaps its suppressor
+    iou = torchvision.ops.box_iou(boxes, boxes[seeds])
+    iou[labels[:, None] != labels[seeds][None]] = -1
+    cluster = iou.argmax(1)
+
+    n_clusters = len(seeds)
+    weights = torch.zeros(n_clusters, device=detections.device).index_add_(0, cluster, scores)
+    counts = torch.zeros(n_clusters, device=detections.device).index_add_(0, cluster, torch.ones_like(scores))
+    fused_boxes = torch.zeros((n_clusters, 4), device=detections.device).index_add_(
+        0, cluster, boxes * scores[:, None]) / weights[:, None]
+    fused_scores = weights / counts.clamp(min=n_variants)
+
+    fused = torch.cat((fused_boxes, fused_scores[:, None], labels[seeds][:, None]), 1)
+    return fused[fused_scores.argsort(descending=True)[:max_det]]
+
+
+def dihedral_tta(model, imgs, conf_thres, nms_thres):
+    """
+    Inferences all dihedral variants of a batch in one forward pass and fuses the detections of each image.
+
+    :param model: Model for inference
+    :type model: models.Darknet or export.OnnxRuntimeModel
+    :param imgs: Batch of images (B, C, H, W)
+    :type imgs: torch.Tensor
+    :param conf_thres: Object confidence threshold of the detections on each variant
+    :type conf_thres: float
+    :param nms_thres: IOU threshold for the non-maximum suppression on each variant and the box fusion
+    :type nms_thres: float
+    :return: Detections of each image with shape nx6 (x1, y1, x2, y2, conf, cls), like `non_max_suppression`
+    :rtype: [torch.Tensor]
+    """
+    batch_size, height, width = imgs.shape[0], imgs.shape[2], imgs.shape[3]
+    variants, transforms = dihedral_batch(imgs)
+    detections = non_max_suppression(model(variants), conf_thres, nms_thres)
+
+    # Undo the transforms of all boxes at once, then fuse the variants of each image
+    counts = torch.tensor([len(d) for d in detections])
+    detections = torch.cat(detections, 0)
+    variant_i = torch.arange(len(counts)).repeat_interleave(counts).to(detections.device)
+    box_transforms = torch.tensor(transforms, device=detections.device)[variant_i // batch_size]
+    detections[:, :4] = invert_dihedral(detections[:, :4], box_transforms, height, width)
+
+    image_i = variant_i % batch_size
+    n_variants = len(variants) // batch_size
+    return [weighted_box_fusion(detections[image_i == i], n_variants, nms_thres) for i in range(batch_size)]
@@ -1,15 +1,16 @@
 from __future__ import division
 
 import os
+import math
 import time
 import platform
-import tqdm
 import torch
 import torch.nn as nn
 import torchvision
 import numpy as np
 import subprocess
 import random
+import imgaug.random
 
 
 def provide_determinism(seed=42):
@@ -17,6 +18,8 @@ def provide_determinism(seed=42):
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+    # The augmentations draw from the global random number generator of imgaug
+    imgaug.random.seed(seed)
 
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
@@ -36,11 +39,26 @@ def worker_seed_set(worker_id):
     worker_seed = torch.initial_seed() % 2**32
     random.seed(worker_seed)
 
+    # imgaug, otherwise every epoch forks the workers with the same state
+    imgaug.random.seed(worker_seed)
+
 
 def to_cpu(tensor):
     return tensor.detach().cpu()
 
 
+def images_per_second(model, imgs, n_batches=10):
+    """
+    Measures the inference throughput of 'model' on the batch 'imgs' after one warm up pass
+    """
+    with torch.no_grad():
+        model(imgs)
+        start = time.perf_counter()
+        for _ in range(n_batches):
+            model(imgs)
+    return n_batches * imgs.size(0) / (time.perf_counter() - start)
+
+
 def load_classes(path):
     """
     Loads class labels at 'path'
@@ -99,28 +117,38 @@ def xywh2xyxy_np(x):
     return y
 
 
-def ap_per_class(tp, conf, pred_cls, target_cls):
+# IoU thresholds 0.5:0.95 of the COCO mAP and crater diameter buckets in pixels of the network input, one per octave
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+DIAMETER_BUCKETS = ((0, 16), (16, 32), (32, 64), (64, np.inf))
+
+
+def ap_per_class(tp, conf, pred_cls, target_cls, interpolation="continuous", ignore=None):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
     # Arguments
-        tp:    True positives (list).
+        tp:    True positives (list), or an array with one column per IoU threshold.
         conf:  Objectness value from 0-1 (list).
         pred_cls: Predicted object classes (list).
         target_cls: True object classes (list).
+        interpolation: "continuous" or "101" point interpolation, see `compute_ap`.
+        ignore: Predictions left out of the curves, shaped like tp (optional).
     # Returns
-        The average precision as computed in py-faster-rcnn.
+        The average precision as computed in py-faster-rcnn, with one column per IoU threshold for 2d tp.
     """
+    tp, target_cls = np.asarray(tp, dtype=np.float64), np.asarray(target_cls)
+    columns = tp if tp.ndim == 2 else tp[:, None]
+    counted = np.ones_like(columns) if ignore is None else 1.0 - np.asarray(ignore).reshape(columns.shape)
 
     # Sort by objectness
     i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    columns, counted, conf, pred_cls = columns[i], counted[i], conf[i], pred_cls[i]
 
     # Find unique classes
     unique_classes = np.unique(target_cls)
 
     # Create Precision-Recall curve and compute AP for each class
     ap, p, r = [], [], []
-    for c in tqdm.tqdm(unique_classes, desc="Computing AP"):
+    for c in unique_classes:
         i = pred_cls == c
         n_gt = (target_cls == c).sum()  # Number of ground truth objects
         n_p = i.sum()  # Number of predicted objects
@@ -128,62 +156,198 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
         if n_p == 0 and n_gt == 0:
             continue
         elif n_p == 0 or n_gt == 0:
-            ap.append(0)
-            r.append(0)
-            p.append(0)
+            ap.append(np.zeros(columns.shape[1]))
+            r.append(np.zeros(columns.shape[1]))
+            p.append(np.zeros(columns.shape[1]))
         else:
             # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum()
-            tpc = (tp[i]).cumsum()
+            fpc = ((1 - columns[i]) * counted[i]).cumsum(0)
+            tpc = (columns[i] * counted[i]).cumsum(0)
 
             # Recall
             recall_curve = tpc / (n_gt + 1e-16)
             r.append(recall_curve[-1])
 
-            # Precision
-            precision_curve = tpc / (tpc + fpc)
+            # Precision, ignored predictions before the first counted one have none
+            precision_curve = tpc / np.maximum(tpc + fpc, 1e-16)
             p.append(precision_curve[-1])
 
             # AP from recall-precision curve
-            ap.append(compute_ap(recall_curve, precision_curve))
+            ap.append(compute_ap(recall_curve, precision_curve, interpolation))
 
     # Compute F1 score (harmonic mean of precision and recall)
-    p, r, ap = np.array(p), np.array(r), np.array(ap)
+    p, r, ap = [np.array(x).reshape(len(x), columns.shape[1]) for x in (p, r, ap)]
+    if tp.ndim == 1:
+        p, r, ap = p[:, 0], r[:, 0], ap[:, 0]
     f1 = 2 * p * r / (p + r + 1e-16)
 
     return p, r, ap, f1, unique_classes.astype("int32")
 
 
-def compute_ap(recall, precision):
+def precision_recall_sweep(tp, conf, pred_cls, target_cls, thresholds):
+    """
+    Computes precision and recall per class at any number of confidence thresholds from one set of matches.
+    The matches of a detection do not depend on the detections below it, so the detections above a threshold are
+    the same as those of a run at that threshold, as long as the matches were made at a lower one.
+    Also finds the confidence threshold of the best F1 score per class over all detections.
+
+    :param tp: True positives
+    :type tp: np.ndarray
+    :param conf: Confidence of each prediction
+    :type conf: np.ndarray
+    :param pred_cls: Class of each prediction
+    :type pred_cls: np.ndarray
+    :param target_cls: Class of each target
+    :type target_cls: np.ndarray
+    :param thresholds: Confidence thresholds, detections above a threshold are kept
+    :type thresholds: np.ndarray
+    :return: Returns precision and recall with shape (classes, thresholds), the classes, and per class the best
+        F1 score as (f1, confidence threshold, precision, recall)
+    :rtype: dict
+    """
+    tp, conf, pred_cls = np.asarray(tp, dtype=np.float64), np.asarray(conf), np.asarray(pred_cls)
+    target_cls, thresholds = np.asarray(target_cls), np.asarray(thresholds)
+    unique_classes = np.unique(target_cls)
+    precision = np.zeros((len(unique_classes), len(thresholds)))
+    recall = np.zeros((len(unique_classes), len(thresholds)))
+    best_f1 = {}
+
+    # Sort by confidence
+    i = np.argsort(-conf, kind="stable")
+    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    for ci, c in enumerate(unique_classes):
+        i = pred_cls == c
+        n_gt = (target_cls == c).sum()
+        tpc = np.concatenate(([0.0], tp[i].cumsum()))
+        # Number of detections above each threshold
+        n_p = np.searchsorted(-conf[i], -thresholds, side="left")
+        precision[ci] = tpc[n_p] / np.maximum(n_p, 1)
+        recall[ci] = tpc[n_p] / (n_gt + 1e-16)
+
+        if not i.any():
+            best_f1[int(c)] = (0.0, float(thresholds.min()) if len(thresholds) else 0.0, 0.0, 0.0)
+            continue
+        # The curve after each detection, a threshold between it and the next one keeps exactly these
+        p_curve = tpc[1:] / np.arange(1, i.sum() + 1)
+        r_curve = tpc[1:] / (n_gt + 1e-16)
+        f1_curve = 2 * p_curve * r_curve / (p_curve + r_curve + 1e-16)
+        # Ties in confidence can only be split at their last detection
+        last = np.append(conf[i][1:] != conf[i][:-1], True)
+        k = np.flatnonzero(last)[np.argmax(f1_curve[last])]
+        next_conf = conf[i][k + 1] if k + 1 < i.sum() else 0.0
+        best_f1[int(c)] = (float(f1_curve[k]), float((conf[i][k] + next_conf) / 2), float(p_curve[k]),
+                           float(r_curve[k]))
+
+    return {"precision": precision, "recall": recall, "classes": unique_classes.astype("int32"),
+            "best_f1": best_f1}
+
+
+def compute_ap(recall, precision, interpolation="continuous"):
     """ Compute the average precision, given the recall and precision curves.
     Code originally from https://github.com/rbgirshick/py-faster-rcnn.
+    "101" interpolation averages the precision envelope at the recalls 0, 0.01, ..., 1 like the COCO evaluation.
 
     # Arguments
-        recall:    The recall curve (list).
-        precision: The precision curve (list).
+        recall:    The recall curve (list), or an array with one curve per column.
+        precision: The precision curve (list), or an array with one curve per column.
+        interpolation: "continuous" or "101" point interpolation.
     # Returns
-        The average precision as computed in py-faster-rcnn.
+        The average precision as computed in py-faster-rcnn, one per column for 2d curves.
     """
-    # correct AP calculation
-    # first append sentinel values at the end
-    mrec = np.concatenate(([0.0], recall, [1.0]))
-    mpre = np.concatenate(([0.0], precision, [0.0]))
-
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
-
-    # to calculate area under PR curve, look for points
-    # where X axis (recall) changes value
-    i = np.where(mrec[1:] != mrec[:-1])[0]
-
-    # and sum (\Delta recall) * prec
-    ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
-    return ap
+    recall, precision = np.asarray(recall, dtype=np.float64), np.asarray(precision, dtype=np.float64)
+    curves = recall.ndim == 2
+    recall, precision = recall.reshape(len(recall), -1), precision.reshape(len(precision), -1)
+
+    if interpolation == "continuous":
+        # correct AP calculation
+        # first append sentinel values at the end
+        sentinel = np.ones((1, recall.shape[1]))
+        mrec = np.concatenate((0 * sentinel, recall, sentinel))
+        mpre = np.concatenate((0 * sentinel, precision, 0 * sentinel))
+
+        # compute the precision envelope, the running maximum from the end
+        mpre = np.maximum.accumulate(mpre[::-1], 0)[::-1]
+
+        # sum (\Delta recall) * prec, points where recall does not change add nothing
+        ap = np.sum((mrec[1:] - mrec[:-1]) * mpre[1:], 0)
+    elif interpolation == "101":
+        envelope = np.maximum.accumulate(precision[::-1], 0)[::-1]
+        points = np.linspace(0, 1, 101)
+        ap = np.empty(recall.shape[1])
+        for column in range(recall.shape[1]):
+            # Precision at the first point reaching each recall, none beyond the final recall
+            i = np.searchsorted(recall[:, column], points, side="left")
+            ap[column] = np.where(i < len(recall), envelope[np.minimum(i, len(recall) - 1), column], 0).mean()
+    else:
+        raise ValueError(f"Unknown AP interpolation '{interpolation}'")
+    return ap if curves else ap[0]
 
 
-def get_batch_statistics(outputs, targets, iou_threshold):
-    """ Compute true positives, predicted scores and predicted labels per sample """
+def coco_metrics(tp, conf, pred_cls, target_cls, iou_thresholds=COCO_IOU_THRESHOLDS, pred_diameters=None,
+                 match_diameters=None, target_diameters=None, buckets=DIAMETER_BUCKETS, interpolation="101"):
+    """
+    Computes COCO style AP at several IoU thresholds at once from the matches of `get_batch_statistics`.
+    With the diameters, the AP is also computed per crater diameter bucket [min, max), as the COCO area ranges:
+    only targets in the bucket count, and predictions are left out that match a target outside it or, when
+    unmatched, lie outside it themselves.
+
+    :param tp: True positives with one column per IoU threshold
+    :type tp: np.ndarray
+    :param conf: Confidence of each prediction
+    :type conf: np.ndarray
+    :param pred_cls: Class of each prediction
+    :type pred_cls: np.ndarray
+    :param target_cls: Class of each target
+    :type target_cls: np.ndarray
+    :param iou_thresholds: IoU threshold of each column of tp, defaults to 0.5:0.95
+    :type iou_thresholds: np.ndarray, optional
+    :param pred_diameters: Diameter of each prediction, defaults to None
+    :type pred_diameters: np.ndarray, optional
+    :param match_diameters: Diameter of the matched target per prediction and threshold, NaN if unmatched,
+        defaults to None
+    :type match_diameters: np.ndarray, optional
+    :param target_diameters: Diameter of each target, defaults to None
+    :type target_diameters: np.ndarray, optional
+    :param buckets: Diameter buckets as (min, max) pairs, defaults to one bucket per octave
+    :type buckets: ((float, float)), optional
+    :param interpolation: "101" point or "continuous" interpolation of the AP, defaults to "101"
+    :type interpolation: str, optional
+    :return: Returns the AP per class and threshold, the classes, mAP over all thresholds, mAP at 0.5 and 0.75
+        if evaluated, and mAP per diameter bucket (NaN without targets in the bucket)
+    :rtype: dict
+    """
+    iou_thresholds = np.asarray(iou_thresholds)
+    _, _, ap, _, ap_class = ap_per_class(tp, conf, pred_cls, target_cls, interpolation)
+    metrics = {"AP": ap, "ap_class": ap_class, "mAP": ap.mean() if ap.size else 0.0}
+    for name, threshold in (("mAP50", 0.5), ("mAP75", 0.75)):
+        column = np.isclose(iou_thresholds, threshold).nonzero()[0]
+        if len(column):
+            metrics[name] = ap[:, column[0]].mean() if ap.size else 0.0
+
+    if pred_diameters is not None:
+        metrics["buckets"] = {}
+        matched = ~np.isnan(match_diameters)
+        for low, high in buckets:
+            in_bucket = (target_diameters >= low) & (target_diameters < high)
+            if not in_bucket.any():
+                metrics["buckets"][(low, high)] = np.nan
+                continue
+            inside = np.where(matched, (match_diameters >= low) & (match_diameters < high),
+                              ((pred_diameters >= low) & (pred_diameters < high))[:, None])
+            bucket_ap = ap_per_class(tp, conf, pred_cls, target_cls[in_bucket], interpolation, ignore=~inside)[2]
+            metrics["buckets"][(low, high)] = bucket_ap.mean()
+    return metrics
+
+
+def get_batch_statistics(outputs, targets, iou_threshold, geometry="box", diameters=False):
+    """ Compute true positives, predicted scores and predicted labels per sample.
+    Predictions are matched to targets by the IoU of their boxes or, with geometry "circle", of their circles.
+    In order of confidence, a prediction is a true positive if its class is among the targets of its image and
+    the target it overlaps most is matched with at least 'iou_threshold' and not yet taken by another prediction.
+    For a sequence of thresholds, the true positives have one column per threshold.
+    With 'diameters', the predicted diameters and the diameters of the matched targets (NaN for false positives)
+    are added for `coco_metrics` """
+    thresholds = torch.tensor(np.atleast_1d(iou_threshold), dtype=torch.float32)
     batch_metrics = []
     for sample_i in range(len(outputs)):
 
@@ -195,29 +359,39 @@ def get_batch_statistics(outputs, targets, iou_threshold):
         pred_scores = output[:, 4]
         pred_labels = output[:, -1]
 
-        true_positives = np.zeros(pred_boxes.shape[0])
+        true_positives = torch.zeros((pred_boxes.shape[0], len(thresholds)), dtype=torch.bool)
+        match_diameters = torch.full(true_positives.shape, float("nan"))
 
         annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
-        if len(annotations):
-            detected_boxes = []
-            target_boxes = annotations[:, 1:]
-
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
-
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
-
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
-
-                iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
+        if len(annotations) and len(pred_boxes):
+            target_labels = annotations[:, 0].to(pred_labels.device)
+            target_boxes = annotations[:, 1:].to(pred_boxes.device)
+
+            if geometry == "circle":
+                iou = circle_iou(pred_boxes, target_boxes)
+            else:
+                iou = bbox_iou(pred_boxes[:, None], target_boxes[None])
+            iou, box_index = iou.max(1)
+            iou, box_index = iou.cpu(), box_index.cpu()
+
+            # Candidates per threshold, the first candidate of each target in confidence order is its match
+            candidate = (iou[:, None] >= thresholds) & \
+                (pred_labels[:, None] == target_labels).any(1).cpu()[:, None]
+            pred_i, threshold_i = candidate.nonzero(as_tuple=True)
+            n_preds = len(pred_boxes)
+            first = torch.full((len(annotations) * len(thresholds),), n_preds).scatter_reduce(
+                0, box_index[pred_i] * len(thresholds) + threshold_i, pred_i, "amin")
+            matched = (first < n_preds).nonzero(as_tuple=True)[0]
+            true_positives[first[matched], matched % len(thresholds)] = True
+            match_diameters[first[matched], matched % len(thresholds)] = \
+                _diameters(target_boxes).cpu()[matched // len(thresholds)]
+
+        true_positives = true_positives.numpy().astype(np.float64)
+        if np.ndim(iou_threshold) == 0:
+            true_positives, match_diameters = true_positives[:, 0], match_diameters[:, 0]
         batch_metrics.append([true_positives, pred_scores, pred_labels])
+        if diameters:
+            batch_metrics[-1] += [_diameters(pred_boxes).cpu().numpy(), match_diameters.numpy()]
     return batch_metrics
 
 
@@ -232,20 +406,20 @@ def bbox_wh_iou(wh1, wh2):
 
 def bbox_iou(box1, box2, x1y1x2y2=True):
     """
-    Returns the IoU of two bounding boxes
+    Returns the IoU of two bounding boxes, boxes of shape (n, 1, 4) and (1, m, 4) broadcast to an nxm matrix
     """
     if not x1y1x2y2:
         # Transform from center and width to exact coordinates
-        b1_x1, b1_x2 = box1[:, 0] - box1[:, 2] / 2, box1[:, 0] + box1[:, 2] / 2
-        b1_y1, b1_y2 = box1[:, 1] - box1[:, 3] / 2, box1[:, 1] + box1[:, 3] / 2
-        b2_x1, b2_x2 = box2[:, 0] - box2[:, 2] / 2, box2[:, 0] + box2[:, 2] / 2
-        b2_y1, b2_y2 = box2[:, 1] - box2[:, 3] / 2, box2[:, 1] + box2[:, 3] / 2
+        b1_x1, b1_x2 = box1[..., 0] - box1[..., 2] / 2, box1[..., 0] + box1[..., 2] / 2
+        b1_y1, b1_y2 = box1[..., 1] - box1[..., 3] / 2, box1[..., 1] + box1[..., 3] / 2
+        b2_x1, b2_x2 = box2[..., 0] - box2[..., 2] / 2, box2[..., 0] + box2[..., 2] / 2
+        b2_y1, b2_y2 = box2[..., 1] - box2[..., 3] / 2, box2[..., 1] + box2[..., 3] / 2
     else:
         # Get the coordinates of bounding boxes
         b1_x1, b1_y1, b1_x2, b1_y2 = \
-            box1[:, 0], box1[:, 1], box1[:, 2], box1[:, 3]
+            box1[..., 0], box1[..., 1], box1[..., 2], box1[..., 3]
         b2_x1, b2_y1, b2_x2, b2_y2 = \
-            box2[:, 0], box2[:, 1], box2[:, 2], box2[:, 3]
+            box2[..., 0], box2[..., 1], box2[..., 2], box2[..., 3]
 
     # get the corrdinates of the intersection rectangle
     inter_rect_x1 = torch.max(b1_x1, b2_x1)
@@ -292,75 +466,290 @@ def box_iou(box1, box2):
     return inter / (area1[:, None] + area2 - inter)
 
 
-def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None):
+def _diameters(boxes):
+    """Returns the diameters of the circles of (x1, y1, x2, y2) boxes, the mean of their width and height."""
+    return (boxes[..., 2] - boxes[..., 0] + boxes[..., 3] - boxes[..., 1]) / 2
+
+
+def _circles(boxes):
+    """Returns the centres (x, y) and radii of the circles of (x1, y1, x2, y2) boxes, the diameter is the mean side."""
+    return (boxes[..., 0] + boxes[..., 2]) / 2, (boxes[..., 1] + boxes[..., 3]) / 2, \
+        (boxes[..., 2] - boxes[..., 0] + boxes[..., 3] - boxes[..., 1]) / 4
+
+
+def _circle_intersection(r1, r2, d, eps=1e-7):
+    """
+    Returns the intersection area of circles with radii r1 and r2 whose centres are d apart, elementwise.
+    Partly overlapping circles intersect in a lens of two circular segments. The lens terms are clamped, so
+    disjoint and contained circles give finite values and gradients before they are replaced.
+    """
+    d_safe = d.clamp(min=eps)
+    cos1 = ((d ** 2 + r1 ** 2 - r2 ** 2) / (2 * d_safe * r1.clamp(min=eps))).clamp(-1 + eps, 1 - eps)
+    cos2 = ((d ** 2 + r2 ** 2 - r1 ** 2) / (2 * d_safe * r2.clamp(min=eps))).clamp(-1 + eps, 1 - eps)
+    kite = ((-d + r1 + r2) * (d + r1 - r2) * (d - r1 + r2) * (d + r1 + r2)).clamp(min=eps)
+    lens = r1 ** 2 * torch.acos(cos1) + r2 ** 2 * torch.acos(cos2) - 0.5 * torch.sqrt(kite)
+    contained = math.pi * torch.min(r1, r2) ** 2
+    return torch.where(d >= r1 + r2, torch.zeros_like(lens),
+                       torch.where(d <= (r1 - r2).abs(), contained, lens.clamp(min=0)))
+
+
+def circle_iou(box1, box2):
+    """
+    Return intersection-over-union of the circles inscribed in boxes, for round objects like craters.
+    Each circle has the centre of its box and the mean of its width and height as diameter.
+    Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
+    Arguments:
+        box1 (Tensor[N, 4])
+        box2 (Tensor[M, 4])
+    Returns:
+        iou (Tensor[N, M]): the NxM matrix containing the pairwise
+            IoU values for every element in boxes1 and boxes2
+    """
+    x1, y1, r1 = _circles(box1[:, None])
+    x2, y2, r2 = _circles(box2[None])
+    inter = _circle_intersection(r1, r2, torch.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2))
+    return inter / (math.pi * (r1 ** 2 + r2 ** 2) - inter)
+
+
+def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, method="greedy", sigma=None,
+                        geometry="box"):
     """Performs Non-Maximum Suppression (NMS) on inference results
+    The candidates of the whole batch are selected at once, only the suppression itself runs per image.
+    The suppression method is one of
+        "greedy": sequential suppression by torchvision.ops.nms()
+        "cluster": Cluster-NMS (https://arxiv.org/abs/2005.03572), the greedy result computed on the IoU matrix.
+            With 'sigma', overlaps decay the scores instead of removing boxes.
+        "matrix": Matrix NMS (https://arxiv.org/abs/2003.10152), every box is kept with its score decayed by
+            its overlaps, boxes below conf_thres afterwards are dropped. 'sigma' defaults to 0.5.
+    The decay of a box with IoU u to a higher scored box is exp(-u^2 / sigma).
+    The overlap 'geometry' is "box" or "circle", the IoU of the circles inscribed in the boxes (see `circle_iou`),
+    which separates nearly concentric craters better. Greedy suppression of circles runs as Cluster-NMS.
     Returns:
          detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
     """
 
+    batch_size = prediction.shape[0]
     nc = prediction.shape[2] - 5  # number of classes
 
     # Settings
     # (pixels) minimum and maximum box width and height
     max_wh = 4096
     max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 5.0  # seconds to quit after
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
     multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
 
-    t = time.time()
-    output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
-
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[x[..., 4] > conf_thres]  # confidence
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    # Confidence of the whole batch, image_i holds the image of each candidate
+    image_i, anchor_i = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    x = prediction[image_i, anchor_i]
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
+        image_i = image_i[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.float()), 1)[keep]
+        image_i = image_i[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, image_i = x[keep], image_i[keep]
+
+    # Check shape
+    if not x.shape[0]:  # no boxes
+        return [torch.zeros((0, 6), device=prediction.device)] * batch_size
+    if (torch.bincount(image_i, minlength=batch_size) > max_nms).any():  # excess boxes
+        # sort by confidence within each image
+        order = x[:, 4].argsort(descending=True, stable=True)
+        order = order[image_i[order].argsort(stable=True)]
+        counts = torch.bincount(image_i, minlength=batch_size)
+        rank = torch.arange(len(order), device=x.device) - (torch.cumsum(counts, 0) - counts)[image_i[order]]
+        keep = order[rank < max_nms]
+        x, image_i = x[keep], image_i[keep]
+
+    # Batched NMS
+    c = x[:, 5:6] * max_wh  # classes
+    # boxes (offset by class), scores. The candidates are ordered by image, torchvision.ops.nms() runs on each
+    # image's slice, as its cost grows with the square of the boxes in one call.
+    counts = torch.bincount(image_i, minlength=batch_size).tolist()
+    output = []
+    for x_i, boxes in zip(x.split(counts), (x[:, :4] + c).split(counts)):
+        if method == "greedy" and geometry == "box":
+            i = torchvision.ops.nms(boxes, x_i[:, 4], iou_thres)  # NMS
+        else:
+            i, scores = _parallel_nms(boxes, x_i[:, 4], iou_thres, conf_thres,
+                                      "cluster" if method == "greedy" else method, sigma, geometry)
+            x_i = x_i.clone()
+            x_i[:, 4] = scores
+        output.append(x_i[i[:max_det]])  # limit detections
+    return output
 
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
 
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
+def _overlapping_pairs(boxes, min_iou=0.0, chunk_size=1 << 22, geometry="box"):
+    """
+    Returns the pairs (i, j), i < j, of boxes with an IoU above 'min_iou' and their IoU.
+    Sorted by x1, a box can only overlap the boxes that start before it ends, less 'min_iou' of its width as the
+    IoU is at most the intersection over the width. The IoU is only computed for these candidates, at most
+    'chunk_size' pairs at a time.
+    Circles are swept by their bounding squares. Their lens is at most as wide as the squares' overlap and as high
+    as the diameter, so the IoU is at most the overlap over pi / 4 of the diameter.
+    """
+    n = len(boxes)
+    if geometry == "circle":
+        cx, cy, r = _circles(boxes)
+        boxes = torch.stack((cx - r, cy - r, cx + r, cy + r), 1)
+        width_fraction = math.pi / 4
+    elif geometry == "box":
+        width_fraction = 1.0
+    else:
+        raise ValueError(f"Unknown IoU geometry '{geometry}'")
+    x_order = boxes[:, 0].argsort()
+    x1, y1, x2, y2 = boxes[x_order].T.contiguous()
+    area = (x2 - x1) * (y2 - y1)
+    # Candidates of the k-th box in x order are the boxes k+1, ..., ends[k]-1
+    ends = torch.searchsorted(x1, x2 - min_iou * width_fraction * (1 - 1e-5) * (x2 - x1))  # Slack for rounding
+    counts = (ends - torch.arange(1, n + 1, device=boxes.device)).clamp(min=0)
+    cum_counts = torch.cumsum(counts, 0)
+    # The candidate at position p of all candidates is box p + 1 - offsets[k] for its box k
+    offsets = cum_counts - counts - torch.arange(n, device=boxes.device)
+
+    pairs_i, pairs_j, pairs_iou = [], [], []
+    start = 0
+    while start < n:
+        # Boxes start, ..., stop-1 have at most chunk_size candidates in total, but at least one box is taken
+        done = int(cum_counts[start - 1]) if start else 0
+        stop = max(int(torch.searchsorted(cum_counts, done + chunk_size, right=True)), start + 1)
+        k = torch.arange(start, stop, device=boxes.device).repeat_interleave(counts[start:stop])
+        m = torch.arange(done + 1, done + len(k) + 1, device=boxes.device) - offsets.index_select(0, k)
+
+        if geometry == "circle":
+            iou = _pair_circle_iou(x1, y1, x2, k, m)
+        else:
+            # Same operations as torchvision.ops.nms(), so the IoU values are identical. In x order, x1 of m is
+            # the larger.
+            w = (torch.min(x2.index_select(0, k), x2.index_select(0, m)) - x1.index_select(0, m)).clamp(min=0)
+            h = (torch.min(y2.index_select(0, k), y2.index_select(0, m)) -
+                 torch.max(y1.index_select(0, k), y1.index_select(0, m))).clamp(min=0)
+            inter = w * h
+            iou = inter / (area.index_select(0, k) + area.index_select(0, m) - inter)
+
+        overlapping = (iou > min_iou).nonzero(as_tuple=True)[0]
+        a, b = x_order[k[overlapping]], x_order[m[overlapping]]
+        pairs_i.append(torch.min(a, b))
+        pairs_j.append(torch.max(a, b))
+        pairs_iou.append(iou[overlapping])
+        start = stop
+    return torch.cat(pairs_i), torch.cat(pairs_j), torch.cat(pairs_iou)
+
+
+def _pair_circle_iou(x1, y1, x2, k, m):
+    """Returns the circle IoU of the bounding squares k and m, the lens area is only computed where they overlap."""
+    r = (x2 - x1) / 2
+    r_k, r_m = r.index_select(0, k), r.index_select(0, m)
+    d = torch.sqrt((x1.index_select(0, k) + r_k - x1.index_select(0, m) - r_m) ** 2 +
+                   (y1.index_select(0, k) + r_k - y1.index_select(0, m) - r_m) ** 2)
+    iou = torch.zeros_like(d)
+    hit = (d < r_k + r_m).nonzero(as_tuple=True)[0]
+    r_k, r_m = r_k[hit], r_m[hit]
+    inter = _circle_intersection(r_k, r_m, d[hit])
+    iou[hit] = inter / (math.pi * (r_k ** 2 + r_m ** 2) - inter)
+    return iou
 
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
 
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            # sort by confidence
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]
-
-        # Batched NMS
-        c = x[:, 5:6] * max_wh  # classes
-        # boxes (offset by class), scores
-        boxes, scores = x[:, :4] + c, x[:, 4]
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
+def _parallel_nms(boxes, scores, iou_thres, conf_thres, method, sigma, geometry="box"):
+    """
+    Suppresses boxes by Cluster-NMS or Matrix NMS with box or circle IoU, see `non_max_suppression`.
+    Returns the indices of the kept boxes sorted by their new scores and the new scores of all boxes.
+    """
+    if not len(boxes):  # Images without candidates
+        return torch.zeros(0, dtype=torch.long, device=boxes.device), scores
+    order = scores.argsort(descending=True, stable=True)
+    # Without decay, only overlaps above the threshold can suppress
+    i, j, iou = _overlapping_pairs(boxes[order], iou_thres if method == "cluster" and sigma is None else 0.0,
+                                   geometry=geometry)
+    n = len(boxes)
+
+    if method == "cluster":
+        # Boxes suppressed by no kept box are kept, which converges to the greedy result in at most n iterations
+        suppress_i, suppress_j = i[iou > iou_thres], j[iou > iou_thres]
+        keep = torch.ones(n, dtype=torch.bool, device=boxes.device)
+        for _ in range(n):
+            suppressors = torch.zeros(n, device=boxes.device).index_add_(0, suppress_j, keep[suppress_i].float())
+            new_keep = suppressors == 0
+            if torch.equal(new_keep, keep):
+                break
+            keep = new_keep
+        if sigma is None:
+            return order[keep], scores
+        # Score penalty by the overlapping kept boxes
+        decay = torch.ones(n, device=boxes.device).index_reduce_(
+            0, j, torch.exp(-(iou * keep[i]) ** 2 / sigma), "prod")
+    elif method == "matrix":
+        sigma = 0.5 if sigma is None else sigma
+        # The decay a box imposes is compensated by its own overlap with a higher scored box
+        compensate_iou = torch.zeros(n, device=boxes.device).scatter_reduce(0, j, iou, "amax")
+        decay = torch.ones(n, device=boxes.device).scatter_reduce(
+            0, j, torch.exp(-(iou ** 2 - compensate_iou[i] ** 2) / sigma), "amin")
+    else:
+        raise ValueError(f"Unknown NMS method '{method}'")
 
-        output[xi] = x[i]
+    new_scores = torch.empty_like(scores)
+    new_scores[order] = scores[order] * decay
+    kept = (new_scores > conf_thres).nonzero(as_tuple=True)[0]
+    return kept[new_scores[kept].argsort(descending=True, stable=True)], new_scores
 
-        if (time.time() - t) > time_limit:
-            print(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
 
-    return output
+def benchmark_nms(n_boxes=(1000, 5000, 30000), methods=("greedy", "cluster", "matrix"), img_size=416, repeats=3,
+                  geometry="box"):
+    """
+    Measures the NMS time of one image on synthetic crater fields, where many small craters lie on and
+    inside larger ones and each crater has several jittered candidate boxes.
+
+    :param n_boxes: Numbers of candidate boxes, defaults to (1000, 5000, 30000)
+    :type n_boxes: (int), optional
+    :param methods: Suppression methods of `non_max_suppression` to time, defaults to all
+    :type methods: (str), optional
+    :param img_size: Size of the image the craters lie on, defaults to 416
+    :type img_size: int, optional
+    :param repeats: Number of timed runs, the fastest is reported, defaults to 3
+    :type repeats: int, optional
+    :param geometry: Overlap geometry of `non_max_suppression`, "box" or "circle", defaults to "box"
+    :type geometry: str, optional
+    :return: Returns the time in ms and the number of detections per (method, n_boxes)
+    :rtype: dict
+    """
+    generator = torch.Generator().manual_seed(0)
+    results = {}
+    for n in n_boxes:
+        # Crater diameters are roughly power law distributed, each crater is hit by about ten candidates
+        n_craters = max(n // 10, 1)
+        diameters = (4 * torch.rand(n_craters, generator=generator) ** -0.7).clamp(max=img_size / 4)
+        centers = torch.rand(n_craters, 2, generator=generator) * img_size
+        crater_i = torch.randint(n_craters, (n,), generator=generator)
+        jitter = 1 + 0.1 * torch.randn(n, 3, generator=generator)
+        prediction = torch.cat((
+            centers[crater_i] + (jitter[:, :2] - 1) * diameters[crater_i, None],
+            (diameters[crater_i] * jitter[:, 2])[:, None].repeat(1, 2).abs(),
+            torch.rand(n, 1, generator=generator) * 0.9 + 0.1,
+            torch.ones(n, 1)), 1)[None]
+        for method in methods:
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                detections = non_max_suppression(prediction.clone(), 0.05, 0.5, method=method, geometry=geometry)
+                timings.append(time.perf_counter() - start)
+            results[(method, n)] = (min(timings) * 1000, len(detections[0]))
+            print(f"{method} NMS on {n} boxes: {min(timings) * 1000:.1f} ms, {len(detections[0])} detections")
+    return results
 
 
 def print_environment_info():
@@ -3,7 +3,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import random
 import numpy as np
-from pytorchyolo.test import evaluate_model_file
+from pytorchyolo.test import precision_recall_model_file
 from sklearn.metrics import auc
 from PIL import Image
 
@@ -106,15 +106,16 @@ def plot_stats(stats_file, save_path=None):
 class PRcurve:
     def __init__(self, model, weights_path, valid_file, start=0.05, stop=0.5, n=10):
         self.confs = np.linspace(start, stop, num=n)
-        self.precisions = []
-        self.recalls = []
+
+        # One validation pass at the lowest threshold gives the detections at every threshold
+        sweep = precision_recall_model_file(model, weights_path, valid_file, ['crater'], self.confs, batch_size=32, n_cpu=2)
+        self.precisions = sweep["precision"].mean(0).tolist()
+        self.recalls = sweep["recall"].mean(0).tolist()
+        # Best F1 per class as (f1, confidence threshold, precision, recall)
+        self.best_f1 = sweep["best_f1"]
 
         for i, conf in enumerate(self.confs):
-            print("\n%i/%i: Confidence Threshold = %.3f" % (i+1, n, conf))
-            metrics = evaluate_model_file(model, weights_path, valid_file, ['crater'], batch_size=32, n_cpu=2, conf_thres=conf, verbose=False)
-            self.precisions.append(float(np.mean(metrics[0])))
-            self.recalls.append(float(np.mean(metrics[1])))
-            print("Precision = %.3f, Recall = %.3f" % (np.mean(metrics[0]), np.mean(metrics[1])))
+            print("%i/%i: Confidence Threshold = %.3f, Precision = %.3f, Recall = %.3f" % (i+1, n, conf, self.precisions[i], self.recalls[i]))
 
         list_to_file([self.precisions, self.recalls], "PRstats.txt")
         self.auc_score = auc(self.recalls, self.precisions)
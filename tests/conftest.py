@@ -0,0 +1,46 @@
+import pytest
+
+NET = """[net]
+batch=4
+subdivisions=1
+width=416
+height=416
+channels=3
+momentum=0.9
+decay=0.0005
+learning_rate=0.001
+burn_in=1000
+max_batches=500200
+policy=steps
+steps=400000,450000
+scales=.1,.1
+"""
+
+
+def _conv(filters, size=3, stride=1, batch_normalize=1, activation="leaky"):
+    return (f"\n[convolutional]\nbatch_normalize={batch_normalize}\nfilters={filters}\nsize={size}\nstride={stride}\n"
+            f"pad=1\nactivation={activation}\n")
+
+
+def _yolo(mask, classes):
+    return (f"\n[yolo]\nmask={mask}\nanchors=10,13,16,30,33,23,30,61,62,45,59,119,116,90,156,198,373,326\n"
+            f"classes={classes}\nnum=9\njitter=.3\nignore_thresh=.7\ntruth_thresh=1\nrandom=1\n")
+
+
+def tiny_cfg(classes=1):
+    """A small YOLOv3 with a residual backbone of 9 layers, routes, an upsample and two YOLO layers"""
+    head = _conv(3 * (5 + classes), 1, batch_normalize=0, activation="linear")
+    return (NET + _conv(8) + _conv(16, stride=2) + _conv(16, stride=2) + _conv(32, stride=2) + _conv(32) +
+            "\n[shortcut]\nfrom=-2\nactivation=linear\n" + _conv(32, stride=2) + _conv(32, 1) +
+            "\n[shortcut]\nfrom=-2\nactivation=linear\n" + head + _yolo("6,7,8", classes) +
+            "\n[route]\nlayers=-3\n\n[upsample]\nstride=2\n\n[route]\nlayers=-1,5\n" + head + _yolo("3,4,5", classes))
+
+
+@pytest.fixture
+def model_cfg(tmp_path):
+    """Returns a function writing the config of `tiny_cfg` and returning its path"""
+    def write(classes=1):
+        path = tmp_path / f"tiny_{classes}.cfg"
+        path.write_text(tiny_cfg(classes))
+        return str(path)
+    return write
@@ -0,0 +1,42 @@
+import random
+
+import numpy as np
+import torch
+
+from pytorchyolo.utils.augmentations import AUGMENTATION_TRANSFORMS
+from pytorchyolo.utils.checkpoints import CheckpointSaver, load_checkpoint, rng_state, set_rng_state
+from pytorchyolo.utils.utils import provide_determinism
+
+
+def _draws():
+    """Draws from every random number generator of the training, including an augmentation with imgaug"""
+    img = np.random.RandomState(0).randint(0, 255, (64, 64, 3), dtype=np.uint8)
+    boxes = np.array([[0, 0.5, 0.5, 0.2, 0.2]])
+    augmented, targets = AUGMENTATION_TRANSFORMS((img, boxes))
+    return random.random(), np.random.rand(), torch.rand(1).item(), augmented, targets
+
+
+def _assert_equal(a, b):
+    assert a[:3] == b[:3]
+    assert torch.equal(a[3], b[3]) and torch.equal(a[4], b[4])
+
+
+def test_provide_determinism_seeds_augmentations():
+    provide_determinism(42)
+    a = _draws()
+    provide_determinism(42)
+    _assert_equal(a, _draws())
+
+
+def test_rng_state_round_trip(tmp_path):
+    provide_determinism(42)
+    _draws()
+    path = str(tmp_path / "ckpt.pth")
+    saver = CheckpointSaver()
+    saver.save(path, {"rng": [rng_state()]})
+    saver.close()
+    expected = _draws()
+
+    provide_determinism(0)
+    set_rng_state(load_checkpoint(path)["rng"][0])
+    _assert_equal(expected, _draws())
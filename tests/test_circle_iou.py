@@ -0,0 +1,39 @@
+import math
+
+import pytest
+import torch
+
+from pytorchyolo.utils.utils import circle_iou, non_max_suppression, _overlapping_pairs
+
+
+def _circle(x, y, r):
+    return torch.tensor([[x - r, y - r, x + r, y + r]], dtype=torch.float64)
+
+
+def _lens_iou(r, d):
+    """Analytic IoU of two circles of radius r whose centres are d apart"""
+    inter = 2 * r ** 2 * math.acos(d / (2 * r)) - d / 2 * math.sqrt(4 * r ** 2 - d ** 2)
+    return inter / (2 * math.pi * r ** 2 - inter)
+
+
+@pytest.mark.parametrize("box1, box2, expected", [
+    (_circle(50, 50, 10), _circle(50, 50, 20), 0.25),  # Concentric, area r^2 over (2r)^2
+    (_circle(50, 50, 10), _circle(50, 50, 10), 1.0),  # Identical
+    (_circle(20, 20, 10), _circle(80, 20, 10), 0.0),  # Disjoint
+    (_circle(20, 20, 10), _circle(40, 20, 10), 0.0),  # Tangent
+    (_circle(20, 20, 10), _circle(30, 20, 10), _lens_iou(10, 10)),  # Equal radii lens
+    (_circle(20, 20, 10), _circle(25, 32, 10), _lens_iou(10, 13)),
+])
+def test_circle_iou_analytic(box1, box2, expected):
+    assert circle_iou(box1, box2).item() == pytest.approx(expected, abs=1e-6)
+    # The sweep of the suppression computes the same IoU
+    _, _, iou = _overlapping_pairs(torch.cat((box1, box2)), geometry="circle")
+    assert (iou.item() if len(iou) else 0.0) == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize("iou_thres, kept", [(0.2, 1), (0.3, 2)])
+def test_concentric_suppression(iou_thres, kept):
+    # A crater of radius 10 inside one of radius 20, as (x, y, w, h, conf, class)
+    prediction = torch.tensor([[[50, 50, 40, 40, 0.9, 1], [50, 50, 20, 20, 0.8, 1]]])
+    output = non_max_suppression(prediction, 0.25, iou_thres, geometry="circle")
+    assert len(output[0]) == kept
@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from pytorchyolo.detect import ColumnarDetectionWriter, detect_directory, detect_scene, save_columnar_detections
+from pytorchyolo.models import model_cache
+
+
+def _detections(n, seed):
+    rows = np.random.RandomState(seed).rand(n, 6).astype(np.float32)
+    rows[:, 5] = np.arange(n) % 3
+    return rows
+
+
+def test_columnar_batches_equal_single_write(tmp_path):
+    image_paths = [f"img_{i}.png" for i in range(5)]
+    img_detections = [_detections(n, i) for i, n in enumerate([3, 0, 7, 1, 4])]
+    save_columnar_detections(str(tmp_path / "all.npz"), image_paths, img_detections)
+
+    writer = ColumnarDetectionWriter(str(tmp_path / "batches.npz"))
+    writer.append(image_paths[:2], img_detections[:2])
+    writer.append(image_paths[2:], img_detections[2:])
+    writer.close()
+
+    expected, actual = np.load(tmp_path / "all.npz"), np.load(tmp_path / "batches.npz")
+    assert sorted(expected.files) == sorted(actual.files)
+    for name in expected.files:
+        assert np.array_equal(expected[name], actual[name])
+    assert np.array_equal(actual["image_index"], np.repeat(np.arange(5), [3, 0, 7, 1, 4]))
+    assert np.array_equal(actual["confidence"], np.concatenate(img_detections)[:, 4])
+    assert not os.path.exists(tmp_path / "batches.npz.tmp")
+
+
+def test_columnar_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        ColumnarDetectionWriter(str(tmp_path / "detections.csv"))
+
+
+def test_detect_directory_columnar(model_cfg, tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    for i in range(5):
+        Image.fromarray(np.random.RandomState(i).randint(0, 255, (64, 96, 3), dtype=np.uint8)).save(images / f"{i}.png")
+    output = tmp_path / "output"
+    detect_directory(model_cfg(), None, str(images), ["crater"], str(output), batch_size=2, img_size=64, n_cpu=0,
+                     conf_thres=0.2, render=False, max_in_flight=1, columnar="npz")
+    # Models are only cached on request
+    assert len(model_cache) == 0
+
+    columns = np.load(output / "detections.npz")
+    assert [os.path.basename(path) for path in columns["image_path"]] == [f"{i}.png" for i in range(5)]
+    counts = np.bincount(columns["image_index"], minlength=5)
+    assert counts.sum() > 0
+    for i, count in enumerate(counts):
+        with open(output / "labels" / f"{i}.txt") as f:
+            assert len(f.readlines()) == count
+
+
+class _BoxFinder(torch.nn.Module):
+    """Detects the pixels of each of the given brightness values as one crater, like a perfect model"""
+
+    def __init__(self, values):
+        super().__init__()
+        self.values = values
+
+    def forward(self, imgs):
+        outputs = torch.zeros(len(imgs), len(self.values), 6)
+        for i, img in enumerate(imgs):
+            for j, value in enumerate(self.values):
+                ys, xs = torch.nonzero((img[0] * 255).round() == value, as_tuple=True)
+                if len(xs):
+                    x1, y1, x2, y2 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+                    outputs[i, j] = torch.tensor([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1, 0.9, 1.0])
+        return outputs
+
+
+def test_detect_scene_crater_on_seam():
+    # Tiles of 416 pixels with an overlap of 64 start at x = 0 and 352
+    scene = np.zeros((416, 768), dtype=np.uint8)
+    scene[100:300, 250:500] = 80  # Larger than the overlap, cut by both tiles
+    scene[20:60, 370:400] = 160  # Inside the overlap, whole in both tiles
+    scene[330:380, 320:400] = 240  # Whole in the first tile, cut by the second
+    detections = detect_scene(_BoxFinder((80, 160, 240)), scene, img_size=416, overlap=64, conf_thres=0.5)
+
+    boxes = sorted(detections[:, :4].tolist())
+    assert np.allclose(boxes, [[250, 100, 500, 300], [320, 330, 400, 380], [370, 20, 400, 60]])
+
+
+def test_detect_scene_crater_on_corner():
+    scene = np.zeros((768, 768), dtype=np.uint8)
+    scene[250:500, 260:480] = 80  # Cut into four parts by the seams of four tiles
+    detections = detect_scene(_BoxFinder((80,)), scene, img_size=416, overlap=64, conf_thres=0.5)
+    assert np.allclose(detections[:, :4], [[260, 250, 480, 500]])
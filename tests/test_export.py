@@ -0,0 +1,56 @@
+import os
+
+import pytest
+import torch
+
+from pytorchyolo.models import load_model
+from pytorchyolo.export import export_onnx, OnnxRuntimeModel
+
+CDA_CFG = os.path.join(os.path.dirname(__file__), "..", "models", "CDA.cfg")
+
+
+def _eager_forward(model, x):
+    """Runs the layers one by one from the module definitions, keeping every output, like the original forward"""
+    img_size = tuple(x.shape[2:4])
+    layer_outputs, yolo_outputs = [], []
+    for module_def, module in zip(model.module_defs, model.module_list):
+        if module_def["type"] in ["convolutional", "upsample", "maxpool"]:
+            x = module(x)
+        elif module_def["type"] == "route":
+            x = torch.cat([layer_outputs[int(layer_i)] for layer_i in module_def["layers"].split(",")], 1)
+            groups = int(module_def.get("groups", 1))
+            group_size = x.shape[1] // groups
+            group_id = int(module_def.get("group_id", 0))
+            x = x[:, group_size * group_id: group_size * (group_id + 1)]
+        elif module_def["type"] == "shortcut":
+            x = layer_outputs[-1] + layer_outputs[int(module_def["from"])]
+        elif module_def["type"] == "yolo":
+            x = module[0](x, img_size)
+            yolo_outputs.append(x)
+        layer_outputs.append(x)
+    return torch.cat(yolo_outputs, 1)
+
+
+@pytest.fixture(params=["tiny", "CDA"])
+def model(request, model_cfg):
+    return load_model(model_cfg() if request.param == "tiny" else CDA_CFG).eval()
+
+
+@pytest.mark.parametrize("shape", [(416, 416), (256, 416)])
+def test_compiled_plan_matches_eager_forward(model, shape):
+    x = torch.rand(2, 3, *shape, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        assert torch.equal(model(x), _eager_forward(model, x))
+
+
+def test_onnxruntime_matches_pytorch(model_cfg, tmp_path):
+    pytest.importorskip("onnxruntime")
+    path = model_cfg()
+    weights_path = str(tmp_path / "weights.pth")
+    torch.save(load_model(path).state_dict(), weights_path)
+    onnx_model = OnnxRuntimeModel(export_onnx(path, weights_path, img_size=416, check=False))
+
+    x = torch.rand(3, 3, 416, 416, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        expected = load_model(path, weights_path).eval()(x)
+    assert torch.allclose(onnx_model(x), expected, atol=1e-3, rtol=1e-3)
@@ -0,0 +1,40 @@
+import numpy as np
+from PIL import Image
+
+from pytorchyolo.models import load_model
+from pytorchyolo.train import _create_feature_data_loader
+from pytorchyolo.utils.feature_cache import FeatureCache
+
+
+def _dataset(tmp_path, n=2):
+    """Writes 'n' images with one label each and returns the path of their list file"""
+    (tmp_path / "images").mkdir()
+    (tmp_path / "labels").mkdir()
+    paths = []
+    for i in range(n):
+        path = tmp_path / "images" / f"{i}.png"
+        Image.fromarray(np.random.RandomState(i).randint(0, 255, (64, 64, 3), dtype=np.uint8)).save(path)
+        (tmp_path / "labels" / f"{i}.txt").write_text("0 0.5 0.5 0.2 0.2\n")
+        paths.append(str(path))
+    list_path = tmp_path / "train.txt"
+    list_path.write_text("\n".join(paths) + "\n")
+    return str(list_path)
+
+
+def test_edited_label_rewrites_cache(model_cfg, tmp_path):
+    list_path = _dataset(tmp_path)
+    with open(list_path) as f:
+        image_paths = f.read().split()
+    model = load_model(model_cfg())
+    cache_path = str(tmp_path / "cache")
+    cutoff = model.backbone_cutoff()
+
+    _create_feature_data_loader(cache_path, model, list_path, 2, 0, cutoff, n_variants=1)
+    assert len(FeatureCache(cache_path)._targets) == 2
+
+    # The images and the backbone are unchanged, only a label gains a crater
+    (tmp_path / "labels" / "1.txt").write_text("0 0.5 0.5 0.2 0.2\n0 0.25 0.25 0.1 0.1\n")
+    assert not FeatureCache(cache_path).is_current(model, image_paths, 416, 1)
+    cache = _create_feature_data_loader(cache_path, model, list_path, 2, 0, cutoff, n_variants=1).dataset
+    assert len(cache._targets) == 3
+    assert cache.is_current(model, image_paths, 416, 1)
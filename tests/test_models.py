@@ -0,0 +1,111 @@
+import os
+import sys
+import subprocess
+
+import pytest
+import torch
+
+from pytorchyolo.models import load_model
+
+CDA_CFG = os.path.join(os.path.dirname(__file__), "..", "models", "CDA.cfg")
+
+
+@pytest.fixture
+def detector_weights(model_cfg, tmp_path):
+    """Weights of a one class model, saved like the CDA weights"""
+    path = str(tmp_path / "detector.pth")
+    torch.save(load_model(model_cfg(1)).state_dict(), path)
+    return path
+
+
+def test_load_other_classes_is_strict(model_cfg, detector_weights):
+    with pytest.raises(RuntimeError):
+        load_model(model_cfg(4), detector_weights)
+
+
+def test_load_other_classes_partial(model_cfg, detector_weights):
+    model = load_model(model_cfg(4), detector_weights, strict=False)
+    weights = torch.load(detector_weights)
+    loaded = [name for name, value in model.state_dict().items() if torch.equal(value, weights[name])]
+    # Everything but the two YOLO head convolutions is loaded
+    assert len(loaded) == len(weights) - 4
+    assert all(name.startswith(("module_list.9.", "module_list.14.")) for name in set(weights) - set(loaded))
+
+
+def _randomize_batch_norms(model, seed=0):
+    """Gives the batch norm layers statistics and affine parameters far from the identity"""
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                n = module.num_features
+                module.weight.copy_(torch.rand(n, generator=generator) + 0.5)
+                module.bias.copy_(torch.randn(n, generator=generator) * 0.1)
+                module.running_mean.copy_(torch.randn(n, generator=generator) * 0.1)
+                module.running_var.copy_(torch.rand(n, generator=generator) + 0.5)
+    return model
+
+
+@pytest.fixture(params=["tiny", "CDA"])
+def weights(request, model_cfg, tmp_path):
+    """Config and .pth weights of a model with non-trivial batch norms"""
+    path = model_cfg() if request.param == "tiny" else CDA_CFG
+    weights_path = str(tmp_path / "weights.pth")
+    torch.save(_randomize_batch_norms(load_model(path)).state_dict(), weights_path)
+    return path, weights_path
+
+
+def _outputs(model, x):
+    with torch.no_grad():
+        return model.eval()(x)
+
+
+def test_fused_outputs_match(weights):
+    x = torch.rand(2, 3, 416, 416, generator=torch.Generator().manual_seed(0))
+    model = load_model(*weights)
+    fused = load_model(*weights, fuse=True)
+    assert fused.fused
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in fused.modules())
+    assert torch.allclose(_outputs(model, x), _outputs(fused, x), atol=1e-3, rtol=1e-3)
+
+
+@pytest.mark.parametrize("save_fused, load_fused", [(True, False), (False, True), (True, True)])
+def test_fused_darknet_weights_round_trip(model_cfg, tmp_path, save_fused, load_fused):
+    path = model_cfg()
+    model = _randomize_batch_norms(load_model(path))
+    expected = _outputs(model, torch.zeros(1, 3, 416, 416) + 0.5)
+    if save_fused:
+        model.fuse()
+    weights_path = str(tmp_path / "tiny.weights")
+    model.save_darknet_weights(weights_path)
+
+    loaded = load_model(path, weights_path, fuse=load_fused)
+    assert torch.allclose(expected, _outputs(loaded, torch.zeros(1, 3, 416, 416) + 0.5), atol=1e-3, rtol=1e-3)
+
+
+def _save_back(model_cfg, weights_path, save):
+    """Loads weights and saves them back to the same file in a subprocess, which dies on a bus error if the
+    parameters still map the file"""
+    script = (f"import torch\nfrom pytorchyolo.models import load_model\n"
+              f"model = load_model({model_cfg!r}, {weights_path!r})\n{save}\n"
+              f"reloaded = load_model({model_cfg!r}, {weights_path!r})\n"
+              f"assert all(torch.equal(a, b) for a, b in zip(model.state_dict().values(), "
+              f"reloaded.state_dict().values()))\n")
+    root = os.path.join(os.path.dirname(__file__), "..")
+    result = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=os.path.abspath(root)))
+    assert result.returncode == 0, result.stderr
+
+
+def test_save_back_to_loaded_pth(model_cfg, tmp_path):
+    path = model_cfg()
+    weights_path = str(tmp_path / "weights.pth")
+    torch.save(_randomize_batch_norms(load_model(path)).state_dict(), weights_path)
+    _save_back(path, weights_path, f"torch.save(model.state_dict(), {weights_path!r})")
+
+
+def test_save_back_to_loaded_darknet_weights(model_cfg, tmp_path):
+    path = model_cfg()
+    weights_path = str(tmp_path / "weights.weights")
+    _randomize_batch_norms(load_model(path)).save_darknet_weights(weights_path)
+    _save_back(path, weights_path, f"model.save_darknet_weights({weights_path!r})")
@@ -0,0 +1,89 @@
+import pytest
+import torch
+import torchvision
+
+from pytorchyolo.utils.utils import non_max_suppression
+
+
+def _prediction():
+    """Batch of an image with overlapping candidates and a blank image without any candidate above conf_thres"""
+    torch.manual_seed(0)
+    n = 50
+    xy = torch.rand(n, 2) * 100 + 50
+    wh = torch.rand(n, 2) * 20 + 20
+    conf = torch.rand(n, 1) * 0.7 + 0.3
+    image = torch.cat((xy, wh, conf, torch.ones(n, 1)), 1)
+    blank = torch.cat((xy, wh, torch.zeros(n, 1), torch.ones(n, 1)), 1)
+    return torch.stack((image, blank))
+
+
+@pytest.mark.parametrize("method", ["greedy", "cluster", "matrix"])
+@pytest.mark.parametrize("geometry", ["box", "circle"])
+def test_blank_image_in_batch(method, geometry):
+    output = non_max_suppression(_prediction(), 0.25, 0.5, method=method, geometry=geometry)
+    assert len(output) == 2
+    assert len(output[0]) > 0
+    assert output[1].shape == (0, 6)
+
+
+def test_cluster_equals_greedy():
+    greedy, _ = non_max_suppression(_prediction(), 0.25, 0.5)
+    cluster, _ = non_max_suppression(_prediction(), 0.25, 0.5, method="cluster")
+    assert torch.equal(greedy, cluster)
+
+
+def _random_batch(seed, batch_size=4, n=200, nc=3):
+    """Random candidates of several classes, with a different number above conf_thres in every image"""
+    generator = torch.Generator().manual_seed(seed)
+    xy = torch.rand(batch_size, n, 2, generator=generator) * 300
+    wh = torch.rand(batch_size, n, 2, generator=generator) * 60 + 10
+    obj = torch.rand(batch_size, n, 1, generator=generator) * torch.linspace(0.2, 1, batch_size)[:, None, None]
+    cls = torch.rand(batch_size, n, nc, generator=generator)
+    return torch.cat((xy, wh, obj, cls), 2)
+
+
+def _greedy_per_image(prediction, conf_thres, iou_thres):
+    """Reference of the greedy suppression, every image and class on its own with torchvision"""
+    output = []
+    for x in prediction:
+        x = x[x[:, 4] > conf_thres]
+        scores = x[:, 5:] * x[:, 4:5]
+        i, j = (scores > conf_thres).nonzero(as_tuple=True)
+        boxes = torch.cat((x[i, :2] - x[i, 2:4] / 2, x[i, :2] + x[i, 2:4] / 2), 1)
+        keep = torchvision.ops.batched_nms(boxes, scores[i, j], j, iou_thres)
+        output.append(torch.cat((boxes, scores[i, j, None], j[:, None].float()), 1)[keep[:300]])  # max_det
+    return output
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("method", ["greedy", "cluster"])
+def test_batched_equals_greedy_per_image(seed, method):
+    prediction = _random_batch(seed)
+    output = non_max_suppression(prediction.clone(), 0.1, 0.5, method=method)
+    for detections, expected in zip(output, _greedy_per_image(prediction, 0.1, 0.5)):
+        assert len(detections) > 0
+        assert torch.allclose(detections, expected)
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("method", ["greedy", "cluster", "matrix"])
+def test_batched_equals_single_images(seed, method):
+    prediction = _random_batch(seed)
+    output = non_max_suppression(prediction.clone(), 0.1, 0.5, method=method)
+    for image, detections in zip(prediction, output):
+        expected, = non_max_suppression(image[None].clone(), 0.1, 0.5, method=method)
+        assert torch.allclose(detections, expected)
+
+
+def test_matrix_without_overlaps_equals_greedy():
+    # Matrix NMS only decays the scores of overlapping boxes, the candidates of an image are set apart on a grid
+    prediction = _random_batch(0)
+    grid = torch.stack(torch.meshgrid(torch.arange(15), torch.arange(15), indexing="ij"), 2).view(-1, 2) * 20
+    prediction[..., :2] = grid[:prediction.shape[1]].float()
+    prediction[..., 2:4] = 10
+    greedy = non_max_suppression(prediction.clone(), 0.1, 0.5)
+    matrix = non_max_suppression(prediction.clone(), 0.1, 0.5, method="matrix")
+    for expected, detections in zip(greedy, matrix):
+        assert len(detections) > 0
+        order = detections[:, 4].argsort(descending=True)
+        assert torch.allclose(detections[order], expected)
@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from pytorchyolo.utils.tta import dihedral_batch, dihedral_transforms, invert_dihedral, weighted_box_fusion
+
+
+def _bright_box(img):
+    """Returns the (x1, y1, x2, y2) box around the bright pixels of an image (C, H, W)"""
+    ys, xs = torch.nonzero(img[0] > 0.5, as_tuple=True)
+    return torch.tensor([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1], dtype=torch.float)
+
+
+@pytest.mark.parametrize("height, width", [(64, 64), (48, 80)])
+def test_invert_dihedral_restores_box(height, width):
+    imgs = torch.zeros(2, 3, height, width)
+    imgs[0, :, 5:20, 30:42] = 1
+    imgs[1, :, 30:47, 2:9] = 1
+    variants, transforms = dihedral_batch(imgs)
+    assert transforms == dihedral_transforms(height, width)
+    assert len(variants) == len(transforms) * 2
+
+    boxes = torch.stack([_bright_box(img) for img in variants])
+    box_transforms = torch.tensor(transforms).repeat_interleave(2, 0)
+    restored = invert_dihedral(boxes, box_transforms, height, width)
+    expected = torch.stack([_bright_box(img) for img in imgs]).repeat(len(transforms), 1)
+    assert torch.equal(restored, expected)
+
+
+def test_weighted_box_fusion_single_variant_without_overlaps():
+    detections = torch.tensor([[0, 0, 10, 10, 0.9, 0],
+                               [20, 20, 30, 30, 0.8, 0],
+                               [2, 2, 12, 12, 0.7, 1],
+                               [40, 0, 50, 15, 0.6, 0]])
+    assert torch.allclose(weighted_box_fusion(detections, 1), detections)
+
+
+def test_weighted_box_fusion_merges_variants():
+    detections = torch.tensor([[0, 0, 10, 10, 0.9, 0],
+                               [1, 1, 11, 11, 0.3, 0]])
+    fused = weighted_box_fusion(detections, 2)
+    assert fused.shape == (1, 6)
+    assert torch.allclose(fused[0, :4], torch.tensor([0.25, 0.25, 10.25, 10.25]))
+    assert torch.isclose(fused[0, 4], torch.tensor(0.6))